@@ -1,17 +1,28 @@
 import logging
 import filecmp
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
 
 import vtk
 import numpy
+import pytest
 from plumbum import local
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
+from . import util
 from . import TEST_DATA
 
 
 log = logging.getLogger(__name__)
 
 
+def _check_error(algorithm, action):
+    error_code = algorithm.GetErrorCode()
+    if error_code:
+        raise Exception(f'Failed to {action}: '
+                        f'{vtk.vtkErrorCode.GetStringFromErrorCode(error_code)}')
+
+
 def activate_tensors(input_vtk, output_vtk):
     """
     Replaces the tensor data's nan's with 0 and inf's with large finite
@@ -22,6 +33,7 @@ def activate_tensors(input_vtk, output_vtk):
     poly_data_reader = vtk.vtkPolyDataReader()
     poly_data_reader.SetFileName(input_vtk)
     poly_data_reader.Update()
+    _check_error(poly_data_reader, f'read {input_vtk}')
     output = poly_data_reader.GetOutput()
     point_data = output.GetPointData()
 
@@ -46,6 +58,7 @@ def activate_tensors(input_vtk, output_vtk):
     poly_data_writer.SetInputData(output)
     poly_data_writer.Write()
     poly_data_writer.Update()
+    _check_error(poly_data_writer, f'write {output_vtk}')
 
 
 def test_activate_tensors():
@@ -55,3 +68,69 @@ def test_activate_tensors():
         output_vtk = tmpdir / 'cc.vtk'
         activate_tensors(input_vtk, output_vtk)
         assert filecmp.cmp(output_vtk, expected_output_vtk)
+
+
+def _timed_activate_tensors(files):
+    input_vtk, output_vtk = files
+    start = timer()
+    try:
+        activate_tensors(input_vtk, output_vtk)
+    except Exception as e:
+        raise Exception(f'Failed to activate the tensors of {input_vtk}: {e}') from e
+    seconds = timer() - start
+    log.info(f'Made {output_vtk} in {seconds:.2f} seconds')
+    return seconds
+
+
+def activate_tensors_batch(files, num_proc=None):
+    """
+    Runs activate_tensors on each (input_vtk, output_vtk) pair of files on a
+    pool of num_proc threads (default: the available cpus); VTK releases the
+    GIL while reading and writing.  The first failure is raised once all files
+    are done.
+
+    Returns the number of seconds each pair took, in order.
+    """
+    files = list(files)
+    if not files:
+        return []
+    num_proc = min(num_proc or util.available_cpus(), len(files))
+    start = timer()
+    with ThreadPool(num_proc) as pool:
+        seconds = pool.map(_timed_activate_tensors, files)
+    log.info(f'Activated the tensors of {len(files)} files in {timer() - start:.2f} seconds '
+             f'using {num_proc} threads (slowest file: {max(seconds):.2f} seconds)')
+    return seconds
+
+
+def _write_test_vtk(output_vtk, tensors):
+    points = vtk.vtkPoints()
+    for i in range(len(tensors)):
+        points.InsertNextPoint(i, 0, 0)
+    lines = vtk.vtkCellArray()
+    lines.InsertNextCell(len(tensors))
+    for i in range(len(tensors)):
+        lines.InsertCellPoint(i)
+    array = numpy_to_vtk(tensors, deep=True)
+    array.SetName('tensor1')
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetLines(lines)
+    polydata.GetPointData().AddArray(array)
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileName(str(output_vtk))
+    writer.SetInputData(polydata)
+    writer.Write()
+
+
+def test_activate_tensors_batch():
+    tensors = numpy.arange(3 * 9, dtype=numpy.float32).reshape(3, 9)
+    tensors[1, 4] = numpy.nan
+    with local.tempdir() as tmpdir:
+        for i in range(5):
+            _write_test_vtk(tmpdir / f'in{i}.vtk', tensors + i)
+        files = [(tmpdir / f'in{i}.vtk', tmpdir / f'out{i}.vtk') for i in range(5)]
+        assert len(activate_tensors_batch(files, num_proc=3)) == 5
+        assert all(b'TENSORS tensor1 float' in output.read_bytes() for (_, output) in files)
+        with pytest.raises(Exception, match='missing.vtk'):
+            activate_tensors_batch(files + [(tmpdir / 'missing.vtk', tmpdir / 'out.vtk')])
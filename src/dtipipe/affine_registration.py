@@ -0,0 +1,178 @@
+import logging
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage, optimize
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PYRAMID = (4, 2, 1)
+# Maximum number of voxels the cost function is evaluated at, per pyramid level
+MAX_SAMPLES = 20000
+
+# Size of a unit step of each parameter: translations (mm), rotations
+# (radians), scales and shears
+PARAMETER_SCALES = np.array([1.0] * 3 + [0.02] * 3 + [0.02] * 3 + [0.02] * 3)
+
+
+def fsl_scaled_voxel_matrix(img):
+    """
+    Maps voxel indices to FSL's scaled voxel coordinates, the space in which
+    flirt expresses its matrices (x is flipped for neurological images).
+    """
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    matrix = np.diag(np.append(zooms, 1))
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        matrix[0, 0] = -zooms[0]
+        matrix[0, 3] = (img.shape[0] - 1) * zooms[0]
+    return matrix
+
+
+def params_to_matrix(params, center):
+    """
+    Builds a 4x4 affine from translation, rotation, scale and shear
+    parameters, with rotations, scales and shears about center.
+    """
+    params = params * PARAMETER_SCALES
+    tx, ty, tz, rx, ry, rz = params[:6]
+    scales = 1 + params[6:9]
+    shx, shy, shz = params[9:12]
+    cx, sx, cy, sy, cz, sz = np.cos(rx), np.sin(rx), np.cos(ry), np.sin(ry), np.cos(rz), np.sin(rz)
+    rotation = (np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]]) @
+                np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]]) @
+                np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]]))
+    shear = np.array([[1, shx, shy], [0, 1, shz], [0, 0, 1]])
+    linear = rotation @ np.diag(scales) @ shear
+    matrix = np.identity(4)
+    matrix[:3, :3] = linear
+    matrix[:3, 3] = np.array([tx, ty, tz]) + center - linear @ center
+    return matrix
+
+
+def _downsample(data, factor):
+    if factor == 1:
+        return data
+    return ndimage.gaussian_filter(data, factor / 2.0)[::factor, ::factor, ::factor]
+
+
+def _grid(shape):
+    return np.indices(shape).reshape(3, -1).astype(float)
+
+
+def resample(moving, matrix, shape, zooms, order=3):
+    """
+    Resamples moving onto a grid of the given shape, where matrix maps the
+    grid's mm coordinates (voxel index * zooms) to moving's mm coordinates.
+    Points outside moving take the value of its nearest edge voxel.
+    """
+    zooms = np.asarray(zooms, dtype=float)
+    voxel_matrix = np.diag(np.append(1 / zooms, 1)) @ matrix @ np.diag(np.append(zooms, 1))
+    coords = voxel_matrix[:3, :3] @ _grid(shape) + voxel_matrix[:3, 3:]
+    return ndimage.map_coordinates(moving, coords, order=order, mode='nearest').reshape(shape)
+
+
+def normalized_correlation(a, b):
+    a = a - a.mean()
+    b = b - b.mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    return (a * b).sum() / denom if denom > 0 else 0.0
+
+
+def fixed_pyramid(fixed, zooms, pyramid=DEFAULT_PYRAMID):
+    """
+    Downsamples fixed for each pyramid level and picks the (at most
+    MAX_SAMPLES) points the cost function is evaluated at.  Returns a list of
+    (factor, level zooms, sample mm coordinates, fixed values at them), which
+    affine_register can reuse for every volume registered to the same fixed
+    image.
+    """
+    zooms = np.asarray(zooms, dtype=float)
+    levels = []
+    for factor in pyramid:
+        level_fixed = _downsample(np.asarray(fixed, dtype=np.float32), factor)
+        level_zooms = zooms * factor
+        grid = _grid(level_fixed.shape) * level_zooms[:, None]
+        fixed_values = level_fixed.ravel()
+        if len(fixed_values) > MAX_SAMPLES:
+            samples = np.random.RandomState(0).choice(len(fixed_values), MAX_SAMPLES,
+                                                      replace=False)
+            grid, fixed_values = grid[:, samples], fixed_values[samples]
+        levels.append((factor, level_zooms, grid, fixed_values))
+    return levels
+
+
+def affine_register(moving, fixed, zooms, pyramid=DEFAULT_PYRAMID, init=None,
+                    fixed_levels=None):
+    """
+    Finds the 12 parameter affine that best aligns moving to fixed (two 3D
+    arrays on grids with the same voxel size) by maximizing their normalized
+    correlation, coarse to fine over a multi-resolution pyramid.
+
+    fixed_levels is fixed_pyramid(fixed, zooms, pyramid), if already computed.
+
+    Returns the 4x4 matrix that maps fixed's mm coordinates (voxel index *
+    zooms) to moving's.
+    """
+    zooms = np.asarray(zooms, dtype=float)
+    center = (np.array(fixed.shape) - 1) * zooms / 2
+    params = np.zeros(12) if init is None else np.asarray(init, dtype=float)
+    if fixed_levels is None:
+        fixed_levels = fixed_pyramid(fixed, zooms, pyramid)
+    for factor, level_zooms, grid, fixed_values in fixed_levels:
+        level_moving = _downsample(np.asarray(moving, dtype=np.float32), factor)
+
+        def cost(p):
+            matrix = params_to_matrix(p, center)
+            coords = (matrix[:3, :3] @ grid + matrix[:3, 3:]) / level_zooms[:, None]
+            values = ndimage.map_coordinates(level_moving, coords, order=1, cval=np.nan)
+            inside = ~np.isnan(values)
+            return -normalized_correlation(fixed_values[inside], values[inside])
+
+        result = optimize.minimize(cost, params, method='Powell',
+                                   options=dict(xtol=1e-2, ftol=1e-6))
+        params = result.x
+        log.debug(f'Pyramid level {factor}: normalized correlation {-result.fun}')
+    return params_to_matrix(params, center)
+
+
+def register_volume(moving_img, fixed_img, pyramid=DEFAULT_PYRAMID, fixed_levels=None):
+    """
+    Registers a 3D image to another on the same grid, returning the resampled
+    moving image data and the matrix in flirt's convention (mapping moving to
+    fixed in FSL scaled voxel coordinates).  fixed_levels is as for
+    affine_register.
+    """
+    zooms = fixed_img.header.get_zooms()[:3]
+    moving = np.asanyarray(moving_img.dataobj, dtype=np.float32)
+    fixed = np.asanyarray(fixed_img.dataobj, dtype=np.float32)
+    fixed_to_moving = affine_register(moving, fixed, zooms, pyramid=pyramid,
+                                      fixed_levels=fixed_levels)
+    resampled = resample(moving, fixed_to_moving, fixed.shape, zooms)
+    # convert from (unflipped) mm coordinates to FSL scaled voxel coordinates
+    to_mm = np.diag(np.append(zooms, 1))
+    to_fsl = fsl_scaled_voxel_matrix(fixed_img) @ np.linalg.inv(to_mm)
+    matrix = to_fsl @ np.linalg.inv(fixed_to_moving) @ np.linalg.inv(to_fsl)
+    return resampled, matrix
+
+
+def test_affine_register():
+    fixed = np.pad(ndimage.gaussian_filter(np.random.RandomState(0).rand(48, 48, 32), 2), 8)
+    zooms = np.array([2.0, 2.0, 2.5])
+    expected = params_to_matrix(np.array([1.5, -1, 0.5, 2, -1, 1.5, 1, 0, -1, 0.5, 0, 0]),
+                                (np.array(fixed.shape) - 1) * zooms / 2)
+    moving = resample(fixed, np.linalg.inv(expected), fixed.shape, zooms)
+    matrix = affine_register(moving, fixed, zooms)
+    assert np.allclose(matrix[:3, :3], expected[:3, :3], atol=0.005)
+    assert np.allclose(matrix[:3, 3], expected[:3, 3], atol=0.2)
+    # the same with the fixed pyramid computed once up front
+    levels = fixed_pyramid(fixed, zooms)
+    assert np.array_equal(affine_register(moving, fixed, zooms, fixed_levels=levels), matrix)
+
+
+def test_register_volume_convention():
+    data = ndimage.gaussian_filter(np.random.RandomState(0).rand(30, 30, 20), 3)
+    img = nib.Nifti1Image(data, np.diag([2, 2, 2, 1]))
+    resampled, matrix = register_volume(img, img, pyramid=(2,))
+    assert np.allclose(matrix, np.identity(4), atol=1e-2)
+    assert np.allclose(resampled, data, atol=1e-3)
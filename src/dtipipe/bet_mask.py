@@ -1,23 +1,142 @@
 import logging
 import filecmp
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
 
 from plumbum import local, cli
+import numpy as np
 import nibabel as nib
+import pandas as pd
+from scipy import ndimage
 import coloredlogs
+import pytest
 
 from . import util
 from . import bse
 from . import TEST_DATA
+from .dwi_volume import DwiVolume
+from .gradients import GradientTable
 
 
 log = logging.getLogger(__name__)
 
 DEFAULT_BET_THRESHOLD = 0.1
+BACKENDS = ['bet', 'otsu']
+DEFAULT_MEDIAN_RADIUS = 4
+DEFAULT_NUM_PASSES = 4
 
 
-def bet_mask(input_file, output_file, bet_threshold=DEFAULT_BET_THRESHOLD, fsldir=None):
+def _bet(image, output_file, bet_threshold):
     """
-    Create a mask using FSL's bet.
+    Runs bet on a 3D image and copies its mask to output_file.  Expects to be
+    called inside a util.fsl_env() context.
+    """
+    with local.tempdir() as tmpdir:
+        local['bet'](image, tmpdir / 'img', '-m', '-n', '-f', bet_threshold)
+        log.debug(f'Output files: {tmpdir // "*"}')
+        local.path(output_file).parent.mkdir()
+        (tmpdir / 'img_mask.nii.gz').copy(output_file)
+
+
+def otsu_threshold(data, bins=256):
+    """
+    Returns the threshold that maximizes the between class variance of the
+    histogram of data.
+    """
+    counts, edges = np.histogram(data, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(counts)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(counts * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_low = sum_low / weight_low
+        mean_high = (sum_low[-1] - sum_low) / weight_high
+        variance = weight_low * weight_high * (mean_low - mean_high)**2
+    return centers[np.nanargmax(variance[:-1])]
+
+
+def otsu_mask(data, median_radius=DEFAULT_MEDIAN_RADIUS, num_passes=DEFAULT_NUM_PASSES):
+    """
+    Brain mask of a 3D image: the image is median filtered num_passes times,
+    thresholded with Otsu's method, cleaned up with a binary opening, reduced to
+    its largest connected component and its holes filled.
+    """
+    filtered = np.asarray(data, dtype=np.float32)
+    size = 2 * median_radius + 1
+    for _ in range(num_passes):
+        filtered = ndimage.median_filter(filtered, size=size)
+    mask = filtered > otsu_threshold(filtered)
+    mask = ndimage.binary_opening(mask, structure=ndimage.generate_binary_structure(3, 1))
+    labels, num_labels = ndimage.label(mask)
+    if num_labels > 1:
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        mask = labels == np.argmax(sizes)
+    return ndimage.binary_fill_holes(mask)
+
+
+def test_otsu_mask():
+    shape = np.array([40, 40, 30])
+    coords = np.indices(shape) - (shape[:, None, None, None] - 1) / 2
+    brain = ((coords / np.array([14, 16, 11])[:, None, None, None])**2).sum(axis=0) <= 1
+    # dark ventricle, and a bright blob away from the brain
+    data = np.where(brain, 100.0, 5.0)
+    data[(coords**2).sum(axis=0) <= 9] = 10
+    data[2:4, 2:4, 2:4] = 150
+    data += np.random.RandomState(0).normal(0, 5, shape)
+    mask = otsu_mask(data, median_radius=1, num_passes=2)
+    assert dice(mask, brain) > 0.95
+    assert mask[20, 20, 15]
+    assert not mask[2:4, 2:4, 2:4].any()
+
+
+def _otsu(input_file, output_file):
+    """
+    Makes an otsu_mask of a 3D image, or of the mean B0 of a 4D DWI.  Like
+    bet's, the mask keeps the input's header (e.g. its qform and sform codes
+    and units).
+    """
+    img = DwiVolume(input_file, dtype=np.float32)
+    if len(img.shape) == 3:
+        data = img.volume(0)
+    else:
+        data = img.mean(GradientTable.for_dwi(input_file).b0_indices())
+    mask = otsu_mask(data)
+    output_file.parent.mkdir()
+    mask_img = nib.Nifti1Image(mask.astype(np.uint8), img.affine, img.header)
+    mask_img.set_data_dtype(np.uint8)
+    mask_img.header.set_slope_inter(1, 0)
+    mask_img.to_filename(str(output_file))
+
+
+def test_otsu_header():
+    data = np.zeros((20, 20, 20, 2), dtype=np.int16)
+    data[5:15, 5:15, 5:15] = 1000
+    data += np.random.RandomState(0).randint(0, 50, data.shape).astype(np.int16)
+    img = nib.Nifti1Image(data, np.diag([2, 2, 2, 1]))
+    img.set_qform(img.affine, code=1)
+    img.set_sform(img.affine, code=2)
+    img.header.set_xyzt_units('mm', 'sec')
+    img.header.set_slope_inter(2, 0)
+    with local.tempdir() as tmpdir:
+        img.to_filename(str(tmpdir / 'dwi.nii.gz'))
+        (tmpdir / 'dwi.bval').write('0 1000')
+        (tmpdir / 'dwi.bvec').write('0 1\n0 0\n0 0\n')
+        _otsu(tmpdir / 'dwi.nii.gz', tmpdir / 'mask' / 'dwi_otsumask.nii.gz')
+        mask = nib.load(str(tmpdir / 'mask' / 'dwi_otsumask.nii.gz'))
+        assert mask.shape == (20, 20, 20)
+        assert mask.get_data_dtype() == np.uint8
+        assert mask.header['qform_code'] == 1 and mask.header['sform_code'] == 2
+        assert mask.header.get_xyzt_units() == ('mm', 'sec')
+        assert np.allclose(mask.affine, img.affine)
+        assert set(np.unique(mask.get_fdata())) == {0, 1}
+
+
+def bet_mask(input_file, output_file, bet_threshold=DEFAULT_BET_THRESHOLD, fsldir=None,
+             backend='bet'):
+    """
+    Create a mask using FSL's bet, or with backend='otsu', with otsu_mask (on
+    the mean B0 of a DWI), which doesn't need FSL and ignores bet_threshold.
 
     Can be used on 3D volumes and 4D DWI's.
     """
@@ -26,28 +145,150 @@ def bet_mask(input_file, output_file, bet_threshold=DEFAULT_BET_THRESHOLD, fsldi
     input_file = local.path(input_file)
     output_file = local.path(output_file)
 
+    if backend not in BACKENDS:
+        raise Exception(f'Unknown bet_mask backend: {backend}, expected one of {BACKENDS}')
+
+    if len(shape) not in (3, 4):
+        raise Exception(f'Expected a 3D or 4D input image, got: {shape}')
+
+    if backend == 'otsu':
+        log.info(f'Make otsu mask for input image: {input_file}')
+        _otsu(input_file, output_file)
+        log.info(f'Made {output_file}')
+        return
+
     with util.fsl_env(fsldir), local.tempdir() as tmpdir:
-        bet = local['bet']
 
         if len(shape) == 3:
             log.info(f'Make BSL bet mask for 3D input image: {input_file}')
-            bet(input_file, tmpdir / 'img', '-m', '-n', '-f', bet_threshold)
-            log.debug(f'Output files: {tmpdir // "*"}')
-            output_file.parent.mkdir()
-            (tmpdir / 'img_mask.nii.gz').copy(output_file)
+            _bet(input_file, output_file, bet_threshold)
 
         elif len(shape) == 4:
             log.info(f'Make BSL bet mask for input DWI: {input_file}')
             bse.bse(input_file, tmpdir / 'bse.nii.gz', extract_type='first')
-            bet(tmpdir / 'bse.nii.gz', tmpdir / 'bse', '-m', '-n', '-f', bet_threshold)
-            log.debug(f'Output files: {tmpdir // "*"}')
-            local.path(output_file).parent.mkdir()
-            (tmpdir / 'bse_mask.nii.gz').copy(output_file)
+            _bet(tmpdir / 'bse.nii.gz', output_file, bet_threshold)
+
+        log.info(f'Made {output_file}')
+
+
+def dice(mask1, mask2):
+    total = np.count_nonzero(mask1) + np.count_nonzero(mask2)
+    return 2.0 * np.count_nonzero(mask1 & mask2) / total if total else 1.0
+
+
+def mask_stats(mask_file, reference=None):
+    """
+    Returns the voxel count and volume (mm^3) of a mask, and if a reference
+    mask (array) is given, the Dice coefficient and the fraction of the
+    reference covered by the mask.
+    """
+    img = nib.load(str(mask_file))
+    mask = np.asanyarray(img.dataobj) > 0
+    voxels = int(np.count_nonzero(mask))
+    stats = dict(voxels=voxels,
+                 volume=voxels * float(np.prod(img.header.get_zooms()[:3])))
+    if reference is not None:
+        if reference.shape != mask.shape:
+            raise Exception(f'Mask {mask_file} has shape {mask.shape} but reference '
+                            f'has shape {reference.shape}')
+        overlap = np.count_nonzero(mask & reference)
+        reference_voxels = np.count_nonzero(reference)
+        stats['dice'] = dice(mask, reference)
+        stats['overlap'] = overlap / reference_voxels if reference_voxels else 1.0
+    return stats
+
+
+def sweep_output_name(output_dir, input_file, bet_threshold):
+    input_file = local.path(input_file)
+    return local.path(output_dir) / f'{input_file.name[:-7]}_betmask-{bet_threshold}.nii.gz'
+
+
+def bet_mask_sweep(input_file, output_dir, bet_thresholds, reference=None,
+                   num_proc=None, fsldir=None):
+    """
+    Makes one bet mask per threshold, extracting the B0 of a 4D input once and
+    running the bet calls concurrently on num_proc threads (default: the
+    available cpus).  Masks are saved in output_dir as
+    <input>_betmask-<threshold>.nii.gz.
 
+    Returns a DataFrame with each threshold's mask and its statistics (see
+    mask_stats), compared to the reference mask if one is given.
+    """
+    bet_thresholds = list(bet_thresholds)
+    if not bet_thresholds:
+        raise Exception('Expected at least one bet threshold')
+    if len(set(bet_thresholds)) != len(bet_thresholds):
+        raise Exception(f'Got duplicate bet thresholds: {bet_thresholds}')
+    for bet_threshold in bet_thresholds:
+        if not 0 <= bet_threshold <= 1:
+            raise Exception(f'Expected bet thresholds between 0 and 1, got: {bet_threshold}')
+    input_file = local.path(input_file)
+    output_dir = local.path(output_dir)
+    shape = nib.load(str(input_file)).shape
+    num_proc = num_proc or util.available_cpus()
+    if reference is not None:
+        reference = np.asanyarray(nib.load(str(reference)).dataobj) > 0
+
+    with util.fsl_env(fsldir), local.tempdir() as tmpdir:
+        if len(shape) == 3:
+            image = input_file
+        elif len(shape) == 4:
+            image = tmpdir / 'bse.nii.gz'
+            bse.bse(input_file, image, extract_type='first')
         else:
             raise Exception(f'Expected a 3D or 4D input image, got: {shape}')
 
-        log.info(f'Made {output_file}')
+        def run(bet_threshold):
+            output_file = sweep_output_name(output_dir, input_file, bet_threshold)
+            _bet(image, output_file, bet_threshold)
+            log.info(f'Made {output_file}')
+            return dict(threshold=bet_threshold, mask=str(output_file),
+                        **mask_stats(output_file, reference))
+
+        log.info(f'Make bet masks for {len(bet_thresholds)} thresholds using '
+                 f'{num_proc} threads: {input_file}')
+        output_dir.mkdir()
+        with ThreadPool(min(num_proc, len(bet_thresholds))) as pool:
+            rows = pool.map(run, bet_thresholds)
+
+    return pd.DataFrame(rows)
+
+
+def test_bet_mask_sweep(monkeypatch):
+    data = np.zeros((10, 10, 10, 3))
+    data[2:8, 2:8, 2:8] = np.arange(1, 4)
+    bse_calls = []
+
+    def fake_bse(dwi, output, **kwargs):
+        bse_calls.append(dwi)
+        nib.Nifti1Image(data[..., 0], np.identity(4)).to_filename(str(output))
+
+    def fake_bet(image, output_file, bet_threshold):
+        img = nib.load(str(image))
+        # grow the mask as the threshold decreases, as bet does
+        margin = int(bet_threshold * 10)
+        mask = np.zeros(img.shape, dtype=np.uint8)
+        mask[margin:10 - margin, margin:10 - margin, margin:10 - margin] = 1
+        nib.Nifti1Image(mask, img.affine).to_filename(str(output_file))
+
+    monkeypatch.setattr(bse, 'bse', fake_bse)
+    monkeypatch.setattr(util, 'fsl_env', lambda fsldir: local.env())
+    monkeypatch.setitem(globals(), '_bet', fake_bet)
+    with local.tempdir() as tmpdir:
+        nib.Nifti1Image(data, np.identity(4)).to_filename(str(tmpdir / 'dwi.nii.gz'))
+        nib.Nifti1Image((data[..., 0] > 0).astype(np.uint8),
+                        np.identity(4)).to_filename(str(tmpdir / 'ref.nii.gz'))
+        stats = bet_mask_sweep(tmpdir / 'dwi.nii.gz', tmpdir / 'masks', [0.1, 0.2, 0.3],
+                               reference=tmpdir / 'ref.nii.gz', num_proc=2)
+        assert len(bse_calls) == 1
+        assert (tmpdir / 'masks' / 'dwi_betmask-0.2.nii.gz').exists()
+    assert stats['threshold'].tolist() == [0.1, 0.2, 0.3]
+    assert stats['voxels'].tolist() == [512, 216, 64]
+    assert stats['dice'].tolist() == [2 * 216 / (512 + 216), 1.0, 2 * 64 / (64 + 216)]
+    assert stats['overlap'].tolist() == [1.0, 1.0, 64 / 216]
+    for bet_thresholds in [[], [0.1, 0.1], [1.5]]:
+        with pytest.raises(Exception, match='bet threshold'):
+            bet_mask_sweep(tmpdir / 'dwi.nii.gz', tmpdir / 'masks', bet_thresholds)
 
 
 # TODO add test for 3D
@@ -60,6 +301,22 @@ def test_bet_mask(fsldir):
         assert filecmp.cmp(output_file, expected_output_file)
 
 
+@pytest.mark.slow
+def test_otsu_vs_bet(fsldir):
+    input_file = TEST_DATA / 'dwi.nii.gz'
+    with local.tempdir() as tmpdir:
+        times = {}
+        for backend in BACKENDS:
+            start = timer()
+            bet_mask(input_file, tmpdir / f'{backend}.nii.gz', fsldir=fsldir, backend=backend)
+            times[backend] = timer() - start
+        masks = {backend: np.asanyarray(nib.load(str(tmpdir / f'{backend}.nii.gz')).dataobj) > 0
+                 for backend in BACKENDS}
+    overlap = dice(masks['bet'], masks['otsu'])
+    log.info(f'bet: {times["bet"]} seconds, otsu: {times["otsu"]} seconds, dice: {overlap}')
+    assert overlap > 0.9
+
+
 class Cli(cli.Application):
 
     input_file = cli.SwitchAttr(
@@ -71,7 +328,7 @@ class Cli(cli.Application):
     output_file = cli.SwitchAttr(
         ['-o', '--output'],
         mandatory=True,
-        help='path of output mask')
+        help='path of output mask (output directory with --sweep)')
 
     bet_threshold = cli.SwitchAttr(
         '-f',
@@ -79,6 +336,28 @@ class Cli(cli.Application):
         default=DEFAULT_BET_THRESHOLD,
         help='threshold for fsl bet mask')
 
+    backend = cli.SwitchAttr(
+        ['--backend'],
+        argtype=cli.Set(*BACKENDS),
+        default='bet',
+        help="masking method: FSL's bet, or otsu thresholding (doesn't need FSL, ignores -f)")
+
+    sweep = cli.SwitchAttr(
+        ['--sweep'],
+        argtype=str,
+        help='comma separated list of bet thresholds; makes one mask per threshold in '
+        'the output directory and saves their statistics in its masks.csv')
+
+    reference = cli.SwitchAttr(
+        ['--reference'],
+        argtype=cli.ExistingFile,
+        help='reference mask the --sweep masks are compared to')
+
+    num_proc = cli.SwitchAttr(
+        ['-n', '--nproc'],
+        argtype=int,
+        help='number of concurrent bet runs for --sweep (default: available cpus)')
+
     fsldir = cli.SwitchAttr(
         ['--fsldir'],
         argtype=cli.ExistingDirectory,
@@ -93,7 +372,19 @@ class Cli(cli.Application):
 
     def main(self):
         coloredlogs.install(level=self.log_level)
+        if self.sweep:
+            stats = bet_mask_sweep(self.input_file,
+                                   self.output_file,
+                                   [float(t) for t in self.sweep.split(',')],
+                                   reference=self.reference,
+                                   num_proc=self.num_proc,
+                                   fsldir=self.fsldir)
+            stats_csv = local.path(self.output_file) / 'masks.csv'
+            stats.to_csv(stats_csv, index=False)
+            log.info(f'Made {stats_csv}:\n{stats.to_string(index=False)}')
+            return
         bet_mask(self.input_file,
                  self.output_file,
                  bet_threshold=self.bet_threshold,
-                 fsldir=self.fsldir)
+                 fsldir=self.fsldir,
+                 backend=self.backend)
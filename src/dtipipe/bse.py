@@ -8,6 +8,8 @@ import nibabel as nib
 import coloredlogs
 
 from . import util
+from .gradients import GradientTable
+from .dwi_volume import DwiVolume
 from . import TEST_DATA
 
 
@@ -16,29 +18,51 @@ log = logging.getLogger(__name__)
 DEFAULT_B0_THRESHOLD = 45.0
 
 
+BACKENDS = ['fsl', 'nibabel']
+
+
 def bse(dwi, output=None, dwi_mask=None, b0_threshold=DEFAULT_B0_THRESHOLD, extract_type=None,
-        fsldir=None):
+        fsldir=None, backend='fsl', gradients=None):
     """
     Extracts the baseline (B0) from a nifti DWI.
 
     Assumes the diffusion volumes are indexed by the last axis. Chooses the
     first B0 as the baseline image by default, with option to specify one.
+
+    The 'fsl' backend uses fslroi and fslmaths, the 'nibabel' backend reads
+    only the needed volumes in-process and masks them with numpy.
+
+    The DWI's gradient table is read from its .bval/.bvec files unless
+    already parsed and given as gradients.
     """
 
+    dwi = local.path(dwi)
     if not dwi.endswith('.nii.gz'):
         raise Exception(f'Expected .nii.gz file, got: {dwi}')
+    if backend not in BACKENDS:
+        raise Exception(f'backend must be one of {BACKENDS}, got: {backend}')
 
     if not output:
         output = str(dwi)[:-9] + '_bse.nii.gz'
 
-    bval_file = local.path(dwi.with_suffix('.bval', depth=2))
-    bvals = [float(i) for i in bval_file.read().strip().split()]
-    b0_idx = np.flatnonzero(np.array(bvals) < b0_threshold)
+    if gradients is None:
+        gradients = GradientTable.for_dwi(dwi)
+    bvals = gradients.bvals
+    b0_idx = gradients.b0_indices(b0_threshold)
 
     log.debug(f'Found B0\'s at indices: {b0_idx}')
 
     if len(b0_idx) == 0:
-        raise Exception(f'No B0 image found. Check {bval_file}')
+        raise Exception(f'No B0 image found. Check {dwi.with_suffix(".bval", depth=2)}')
+
+    if backend == 'fsl' and extract_type == 'all' and np.any(np.diff(b0_idx) != 1):
+        log.info('B0\'s are not contiguous, extract them in-process')
+        backend = 'nibabel'
+
+    if backend == 'nibabel':
+        _bse_nibabel(dwi, output, dwi_mask, bvals, b0_idx, extract_type)
+        log.info(f'Made {output}')
+        return
 
     with util.fsl_env(fsldir), local.tempdir() as tmpdir:
 
@@ -51,18 +75,17 @@ def bse(dwi, output=None, dwi_mask=None, b0_threshold=DEFAULT_B0_THRESHOLD, extr
 
         elif extract_type == 'average':
             log.info('Extract average B0')
-            img = nib.load(str(dwi))
-            hdr = img.header
-            avg_bse = np.mean(img.get_data()[:, :, :, b0_idx], axis=3)
-            util.save_nifti(tmp_output, avg_bse, img.affine, hdr)
+            img = DwiVolume(dwi, dtype=np.float64)
+            avg_bse = img.mean(b0_idx)
+            util.save_nifti(tmp_output, avg_bse, img.affine, img.header)
 
         elif extract_type == 'all':
             log.info('Extract all B0\'s')
-            fslroi(dwi, tmp_output, b0_idx, len(b0_idx))  # BUG valid for contiguous b0's only?
+            fslroi(dwi, tmp_output, b0_idx[0], len(b0_idx))
 
         else:  # default is 'first'
             log.info('Extract first B0')
-            fslroi(dwi, tmp_output, b0_idx, 1)
+            fslroi(dwi, tmp_output, b0_idx[0], 1)
 
         if dwi_mask:
             log.info(f'Mask {output} with {dwi_mask}')
@@ -73,6 +96,43 @@ def bse(dwi, output=None, dwi_mask=None, b0_threshold=DEFAULT_B0_THRESHOLD, extr
     log.info(f'Made {output}')
 
 
+def _bse_nibabel(dwi, output, dwi_mask, bvals, b0_idx, extract_type):
+    img = nib.load(str(dwi))
+    header = img.header.copy()
+    scaled = img.dataobj.slope != 1 or img.dataobj.inter != 0
+
+    if extract_type == 'minimum':
+        log.info('Extract minimum B0')
+        data = img.dataobj[..., int(np.argsort(bvals)[0])]
+
+    elif extract_type == 'average':
+        log.info('Extract average B0')
+        data = DwiVolume(dwi, dtype=np.float64).mean(b0_idx)
+        scaled = True
+
+    elif extract_type == 'all':
+        log.info('Extract all B0\'s')
+        data = np.stack([img.dataobj[..., i] for i in b0_idx], axis=-1)
+
+    else:  # default is 'first'
+        log.info('Extract first B0')
+        data = img.dataobj[..., int(b0_idx[0])]
+
+    if dwi_mask:
+        log.info(f'Mask {output} with {dwi_mask}')
+        mask = np.asanyarray(nib.load(str(dwi_mask)).dataobj)
+        if data.ndim == 4:
+            mask = mask[..., np.newaxis]
+        data = data * mask
+
+    if scaled:
+        header.set_data_dtype(np.float32)
+    header.set_data_shape(data.shape)
+    header.set_slope_inter(1, 0)
+    data = data.astype(header.get_data_dtype())
+    nib.Nifti1Image(data, img.affine, header).to_filename(str(output))
+
+
 @pytest.mark.parametrize("extract_type", ['minimum', 'average', 'all', 'first'])
 @pytest.mark.parametrize("dwi_mask", [None, TEST_DATA / 'dwi_mask.nii.gz'])
 def test_bse(extract_type, dwi_mask, fsldir):
@@ -90,6 +150,34 @@ def test_bse(extract_type, dwi_mask, fsldir):
             assert filecmp.cmp(output, expected_output)
 
 
+@pytest.mark.parametrize("extract_type", ['minimum', 'average', 'all', 'first'])
+@pytest.mark.parametrize("masked", [False, True])
+def test_bse_nibabel(extract_type, masked):
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 1000, size=(4, 5, 6, 6)).astype(np.int16)
+    mask = (rng.rand(4, 5, 6) > 0.5).astype(np.uint8)
+    b0_idx = [1, 4]
+    with local.tempdir() as tmpdir:
+        dwi = tmpdir / 'dwi.nii.gz'
+        nib.Nifti1Image(data, np.identity(4)).to_filename(str(dwi))
+        (tmpdir / 'dwi.bval').write('1000 5 1000 1000 0 1000')
+        util.write_bvecs(np.ones((6, 3)), tmpdir / 'dwi.bvec')
+        nib.Nifti1Image(mask, np.identity(4)).to_filename(str(tmpdir / 'mask.nii.gz'))
+        output = tmpdir / 'bse.nii.gz'
+        bse(dwi, output, dwi_mask=tmpdir / 'mask.nii.gz' if masked else None,
+            extract_type=extract_type, backend='nibabel')
+        img = nib.load(str(output))
+        expected = {'minimum': data[..., 4],
+                    'average': data[..., b0_idx].mean(axis=-1),
+                    'all': data[..., b0_idx],
+                    'first': data[..., 1]}[extract_type]
+        if masked:
+            expected = expected * (mask if expected.ndim == 3 else mask[..., np.newaxis])
+        assert np.allclose(img.get_fdata(), expected)
+        if extract_type != 'average':
+            assert img.get_data_dtype() == np.int16
+
+
 class Cli(cli.Application):
 
     __doc__ = bse.__doc__
@@ -126,6 +214,12 @@ class Cli(cli.Application):
         default="first",
         mandatory=False)
 
+    backend = cli.SwitchAttr(
+        ['--backend'],
+        argtype=cli.Set(*BACKENDS),
+        default='fsl',
+        help='Extract with fslroi/fslmaths ("fsl") or in-process ("nibabel")')
+
     fsldir = cli.SwitchAttr(
         ['--fsldir'],
         argtype=cli.ExistingDirectory,
@@ -145,4 +239,5 @@ class Cli(cli.Application):
             dwi_mask=self.dwi_mask,
             b0_threshold=self.b0_threshold,
             extract_type=self.extract_type,
-            fsldir=self.fsldir)
+            fsldir=self.fsldir,
+            backend=self.backend)
@@ -0,0 +1,133 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nib
+from plumbum import local
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_BYTES = 512 * 1024**2
+
+
+class DwiVolume(object):
+    """
+    Lazy access to a 3D or 4D nifti through nibabel's array proxy, one volume
+    (or slab of volumes along the last axis) at a time, so that memory use
+    does not depend on the size of the image.
+
+    Volumes read with volume() are kept in an LRU cache of at most
+    cache_bytes.  Data is returned as dtype, which defaults to the image's
+    on-disk type (float32 if the image has scaling).
+    """
+
+    def __init__(self, nifti, dtype=None, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.img = nib.load(str(nifti))
+        self.shape = self.img.shape
+        self.affine = self.img.affine
+        self.header = self.img.header
+        self.scaled = self.img.dataobj.slope != 1 or self.img.dataobj.inter != 0
+        if dtype is None:
+            dtype = np.float32 if self.scaled else self.img.get_data_dtype()
+        self.dtype = np.dtype(dtype).newbyteorder('=')
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+
+    @property
+    def num_volumes(self):
+        return self.shape[3] if len(self.shape) > 3 else 1
+
+    @property
+    def volume_shape(self):
+        return self.shape[:3]
+
+    @property
+    def volume_bytes(self):
+        return int(np.prod(self.volume_shape)) * self.dtype.itemsize
+
+    def _read(self, slicer):
+        return np.asarray(self.img.dataobj[slicer]).astype(self.dtype, copy=False)
+
+    def volume(self, i):
+        """
+        Returns the i'th volume as a 3D array.
+        """
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        data = self._read((Ellipsis, i)) if len(self.shape) > 3 else self._read(Ellipsis)
+        if data.nbytes <= self.cache_bytes:
+            data.setflags(write=False)
+            self._cache[i] = data
+            self._cache_size += data.nbytes
+            while self._cache_size > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= evicted.nbytes
+        return data
+
+    def volumes(self, indices=None):
+        """
+        Yields the volumes with the given indices (default all), one at a time.
+        """
+        indices = range(self.num_volumes) if indices is None else indices
+        for i in indices:
+            yield self.volume(i)
+
+    def slab(self, start, stop):
+        """
+        Returns the slices start:stop along the image's last axis (volumes of
+        a 4D image, z slices of a 3D one).
+        """
+        return self._read((Ellipsis, slice(start, stop)))
+
+    def iter_slabs(self, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        Yields consecutive slabs along the last axis, each at most max_bytes
+        (but at least one slice).
+        """
+        slice_bytes = int(np.prod(self.shape[:-1])) * self.dtype.itemsize
+        step = max(1, int(max_bytes // slice_bytes))
+        for start in range(0, self.shape[-1], step):
+            yield self.slab(start, min(start + step, self.shape[-1]))
+
+    def array(self):
+        """
+        Reads the whole image as dtype, one volume at a time, so no full size
+        copy in another type is made.
+        """
+        result = np.empty(self.shape, dtype=self.dtype)
+        for i in range(self.num_volumes):
+            if len(self.shape) > 3:
+                result[..., i] = self._read((Ellipsis, i))
+            else:
+                result[...] = self._read(Ellipsis)
+        return result
+
+    def mean(self, indices=None):
+        """
+        Mean of the given volumes (default all), accumulated one volume at a time.
+        """
+        indices = list(range(self.num_volumes) if indices is None else indices)
+        total = np.zeros(self.volume_shape)
+        for i in indices:
+            total += self.volume(i)
+        return total / len(indices)
+
+
+def test_dwi_volume():
+    data = np.random.RandomState(0).rand(4, 5, 6, 7) * 100
+    with local.tempdir() as tmpdir:
+        nifti = tmpdir / 'dwi.nii.gz'
+        nib.Nifti1Image(data.astype(np.float64), np.identity(4)).to_filename(str(nifti))
+        dwi = DwiVolume(nifti, dtype=np.float32, cache_bytes=2 * 4 * 5 * 6 * 4)
+        assert dwi.volume(3).dtype == np.float32
+        assert np.allclose(dwi.volume(3), data[..., 3])
+        dwi.volume(4)
+        dwi.volume(5)
+        assert list(dwi._cache) == [4, 5]
+        assert np.allclose(np.concatenate(list(dwi.iter_slabs(3 * 4 * 5 * 6 * 4)), axis=-1), data)
+        assert [slab.shape[-1] for slab in dwi.iter_slabs(3 * 4 * 5 * 6 * 4)] == [3, 3, 1]
+        assert np.allclose(dwi.mean([1, 2]), data[..., 1:3].mean(axis=-1))
+        assert DwiVolume(nifti, dtype='int16').array().dtype == np.int16
@@ -1,27 +1,46 @@
+import os
 import sys
+import json
 import logging
 import filecmp
 from os import getpid
+from contextlib import contextmanager
+from timeit import default_timer as timer
 from multiprocessing import Pool
 
 import coloredlogs
 import pytest
 import numpy as np
+import pandas as pd
+import nibabel as nib
 from plumbum import local, cli
 
 from . import bse
 from . import util
+from . import affine_registration
+from .gradients import GradientTable
 from . import TEST_DATA
 
 
 NUM_PROC_EDDY = 10
+# Rough peak memory of one flirt process: a multiple of the volume size in
+# float32 (input, reference, resampled output and work arrays) plus overhead
+FLIRT_MEMORY_PER_VOXEL = 10 * 4
+FLIRT_MEMORY_OVERHEAD = 100 * 1024**2
+SPLIT_MERGE_TYPES = ['fsl', 'nibabel']
+REGISTRATION_BACKENDS = ['flirt', 'numpy']
+MANIFEST = 'manifest.json'
+MERGED_DWI = 'EddyCorrect-DWI.nii.gz'
 
 log = logging.getLogger(__name__)
 
 
 def register(source_nii, target_nii, output, fsldir=None):
     log.info(f'Run FSL flirt affine registration: {source_nii} -> {target_nii}')
-    with util.fsl_env(fsldir):
+    output = local.path(output)
+    compressed = output.endswith('.gz')
+    output_type = 'NIFTI_GZ' if compressed else 'NIFTI'
+    with util.fsl_env(fsldir), local.env(FSLOUTPUTTYPE=output_type, OMP_NUM_THREADS='1'):
         local['flirt']('-interp', 'sinc',
                        '-sincwidth', '7',
                        '-sincwindow', 'blackman',
@@ -29,7 +48,7 @@ def register(source_nii, target_nii, output, fsldir=None):
                        '-ref', target_nii,
                        '-nosearch',
                        '-o', output,
-                       '-omat', output.with_suffix('.txt', depth=2),
+                       '-omat', output.with_suffix('.txt', depth=2 if compressed else 1),
                        '-paddingsize', '1')
 
 
@@ -45,73 +64,379 @@ def test_register(fsldir):
         assert filecmp.cmp(expected_output, test_output)
 
 
+@pytest.mark.slow
+def test_registration_backends(fsldir):
+    dwi0 = TEST_DATA / 'dwi_split' / 'vol0000.nii.gz'
+    dwi10 = TEST_DATA / 'dwi_split' / 'vol0010.nii.gz'
+    with local.tempdir() as tmpdir:
+        start = timer()
+        register(dwi10, dwi0, tmpdir / 'flirt.nii.gz', fsldir=fsldir)
+        flirt_time = timer() - start
+        start = timer()
+        _, matrix = affine_registration.register_volume(nib.load(str(dwi10)), nib.load(str(dwi0)))
+        numpy_time = timer() - start
+        log.info(f'flirt: {flirt_time} seconds, numpy: {numpy_time} seconds')
+        flirt_rotation, numpy_rotation = util.polar_rotations([np.loadtxt(tmpdir / 'flirt.txt'),
+                                                               matrix])
+        angle = np.degrees(np.arccos((np.trace(flirt_rotation.T @ numpy_rotation) - 1) / 2))
+        assert angle < 0.5
+
+
+def auto_num_proc(dwi):
+    """
+    Number of flirt processes to run at once for dwi: as many as there are
+    usable CPUs and volumes, limited by the memory available for each flirt
+    given the DWI's volume size (read from its header).
+    """
+    shape = nib.load(str(dwi)).shape
+    num_vols = shape[3] if len(shape) > 3 else 1
+    volume_memory = int(np.prod(shape[:3])) * FLIRT_MEMORY_PER_VOXEL + FLIRT_MEMORY_OVERHEAD
+    num_proc = min(util.available_cpus(), num_vols)
+    memory = util.available_memory()
+    if memory is not None:
+        num_proc = min(num_proc, memory // volume_memory)
+    num_proc = max(1, int(num_proc))
+    log.info(f'Using {num_proc} processes for registration (~{volume_memory / 1024**2:.0f} MB '
+             f'per volume, {util.available_cpus()} CPUs, '
+             f'{"unknown" if memory is None else f"{memory / 1024**2:.0f} MB"} memory available)')
+    return num_proc
+
+
+def test_auto_num_proc(monkeypatch):
+    with local.tempdir() as tmpdir:
+        dwi = tmpdir / 'dwi.nii.gz'
+        nib.Nifti1Image(np.zeros((128, 128, 64, 30), dtype=np.int16),
+                        np.identity(4)).to_filename(str(dwi))
+        monkeypatch.setattr(util, 'available_cpus', lambda: 64)
+        monkeypatch.setattr(util, 'available_memory', lambda: 1024**4)
+        assert auto_num_proc(dwi) == 30
+        monkeypatch.setattr(util, 'available_memory', lambda: 300 * 1024**2)
+        assert auto_num_proc(dwi) == 2
+        monkeypatch.setattr(util, 'available_memory', lambda: 0)
+        assert auto_num_proc(dwi) == 1
+
+
+def split_volumes(dwi, output_dir):
+    """
+    Writes each volume of a 4D nifti to an uncompressed 'volNNNN.nii' in
+    output_dir, reading one volume at a time through nibabel's array proxy.
+    """
+    output_dir = local.path(output_dir)
+    img = nib.load(str(dwi))
+    header = img.header.copy()
+    header.set_data_shape(img.shape[:3])
+    if img.dataobj.slope != 1 or img.dataobj.inter != 0:
+        header.set_data_dtype(np.float32)
+    vols = []
+    for i in range(img.shape[3]):
+        vol = output_dir / f'vol{i:04}.nii'
+        util.write_nifti_chunks(vol, header, [img.dataobj[..., i]])
+        vols.append(vol)
+    return vols
+
+
+def merge_volumes(vols, output, template=None):
+    """
+    Stacks 3D niftis along a 4th axis in a single streaming pass, reading
+    one volume at a time (uncompressed volumes are memory mapped).  The
+    output's 4th dimension voxel size is taken from the template, if given.
+    """
+    vols = list(vols)
+    first = nib.load(str(vols[0]))
+    header = first.header.copy()
+    header.set_data_shape(first.shape + (len(vols),))
+    tr = nib.load(str(template)).header.get_zooms()[3] if template else 1.0
+    header.set_zooms(first.header.get_zooms()[:3] + (tr,))
+    util.write_nifti_chunks(output, header, (nib.load(str(vol)).dataobj for vol in vols))
+
+
+def test_split_merge_volumes():
+    data = np.random.RandomState(0).randint(0, 1000, size=(4, 5, 6, 3)).astype(np.int16)
+    with local.tempdir() as tmpdir:
+        dwi = tmpdir / 'dwi.nii.gz'
+        nib.Nifti1Image(data, np.diag([2, 2, 2, 1])).to_filename(str(dwi))
+        vols = split_volumes(dwi, tmpdir)
+        assert [vol.name for vol in vols] == ['vol0000.nii', 'vol0001.nii', 'vol0002.nii']
+        assert np.array_equal(nib.load(str(vols[1])).get_fdata(), data[..., 1])
+        merged = tmpdir / 'merged.nii.gz'
+        merge_volumes(vols, merged, template=dwi)
+        img = nib.load(str(merged))
+        assert img.get_data_dtype() == np.int16
+        assert np.array_equal(img.get_fdata(), data)
+        assert np.allclose(img.affine, np.diag([2, 2, 2, 1]))
+
+
+def _registration_outputs(source_nii):
+    """
+    Returns the registered volume and transform that flirt makes for source_nii.
+    """
+    if source_nii.endswith('.nii.gz'):
+        output = source_nii.with_suffix('.inb0.nii.gz', depth=2)
+        return output, output.with_suffix('.txt', depth=2)
+    output = source_nii.with_suffix('.inb0.nii')
+    return output, output.with_suffix('.txt')
+
+
 def _multiprocessing_register(source_nii):
-    output = source_nii.with_suffix('.inb0.nii.gz', depth=2)
+    output, _ = _registration_outputs(source_nii)
     register(source_nii=source_nii,
              target_nii='b0.nii.gz',
              output=output)
-    return output
+    return source_nii, None
+
+
+_numpy_target = None
+_numpy_target_levels = None
+
+
+def _init_numpy_register(target_nii):
+    # Load and downsample the target once per worker, for all the volumes it
+    # registers
+    global _numpy_target, _numpy_target_levels
+    img = nib.load(str(target_nii))
+    data = np.asanyarray(img.dataobj, dtype=np.float32)
+    _numpy_target = nib.Nifti1Image(data, img.affine, img.header)
+    _numpy_target_levels = affine_registration.fixed_pyramid(data, img.header.get_zooms()[:3])
+
+
+def _multiprocessing_numpy_register(source_nii):
+    log.info(f'Run affine registration: {source_nii} -> B0')
+    output, transform = _registration_outputs(source_nii)
+    resampled, matrix = affine_registration.register_volume(nib.load(str(source_nii)),
+                                                            _numpy_target,
+                                                            fixed_levels=_numpy_target_levels)
+    util.save_nifti(output, resampled, _numpy_target.affine, _numpy_target.header.copy())
+    np.savetxt(transform, matrix, fmt='%.10f')
+    return source_nii, matrix
+
+
+def save_transforms(output, transforms, bvals, center):
+    """
+    Saves the per-volume transforms as a single .npz archive, holding the
+    (N,4,4) 'transforms', the volume 'indices', their 'bvals' and the 'center'
+    of the volume grid in the transforms' (FSL scaled voxel) coordinates.
+    """
+    transforms = np.asarray(transforms, dtype=float)
+    np.savez(str(output),
+             transforms=transforms,
+             indices=np.arange(len(transforms)),
+             bvals=np.asarray(bvals, dtype=float),
+             center=np.asarray(center, dtype=float))
+
+
+def read_transform_archive(archive):
+    """
+    Reads an archive made by save_transforms into a dict of arrays.
+    """
+    with np.load(str(archive)) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def motion_parameters(transforms, center=(0, 0, 0), head_radius=50.0):
+    """
+    Derives motion parameters from (N,4,4) transforms: the translation of the
+    center (mm), the x, y and z rotation angles (radians) and the framewise
+    displacement (the sum of the absolute changes in translation and in
+    rotation, converted to mm of arc on a sphere of head_radius).
+    """
+    transforms = np.asarray(transforms, dtype=float)
+    center = np.asarray(center, dtype=float)
+    translation = (transforms[:, :3, :3] @ center + transforms[:, :3, 3]) - center
+    rotation = util.polar_rotations(transforms)
+    angles = np.stack([np.arctan2(-rotation[:, 1, 2], rotation[:, 2, 2]),
+                       np.arcsin(np.clip(rotation[:, 0, 2], -1, 1)),
+                       np.arctan2(-rotation[:, 0, 1], rotation[:, 0, 0])], axis=1)
+    displacement = np.abs(np.diff(translation, axis=0)).sum(axis=1) + \
+        head_radius * np.abs(np.diff(angles, axis=0)).sum(axis=1)
+    return dict(translation=translation,
+                rotation=angles,
+                framewise_displacement=np.concatenate([[0], displacement]))
+
+
+def motion_summary(archive):
+    """
+    Returns a data frame of the motion parameters of each volume in a
+    transforms archive (see save_transforms).
+    """
+    xfms = read_transform_archive(archive)
+    motion = motion_parameters(xfms['transforms'], xfms['center'])
+    df = pd.DataFrame(np.column_stack([motion['translation'], motion['rotation']]),
+                      columns=['tx', 'ty', 'tz', 'rx', 'ry', 'rz'])
+    df.insert(0, 'bval', xfms['bvals'])
+    df.insert(0, 'volume', xfms['indices'])
+    df['framewise_displacement'] = motion['framewise_displacement']
+    return df
+
+
+def test_motion_summary():
+    rotation = affine_registration.params_to_matrix(np.array([0, 0, 0, 0, 0, 5] + [0] * 6),
+                                                    center=np.array([10.0, 10, 10]))
+    transforms = np.stack([np.identity(4), rotation, rotation])
+    transforms[2, :3, 3] += [1, -2, 0]
+    with local.tempdir() as tmpdir:
+        save_transforms(tmpdir / 'xfms.npz', transforms, [0, 1000, 1000], center=[10, 10, 10])
+        df = motion_summary(tmpdir / 'xfms.npz')
+    assert df.volume.tolist() == [0, 1, 2]
+    assert df.bval.tolist() == [0, 1000, 1000]
+    assert np.allclose(df[['tx', 'ty', 'tz']].values, [[0, 0, 0], [0, 0, 0], [1, -2, 0]])
+    assert np.allclose(df.rz, [0, 0.1, 0.1])
+    assert np.allclose(df[['rx', 'ry']].values, 0)
+    assert np.allclose(df.framewise_displacement, [0, 5, 3])
 
 
-def eddy_pnl(dwi, output, num_proc=NUM_PROC_EDDY, fsldir=None, debug=False):
+def read_manifest(work_dir):
+    """
+    Reads the record of completed steps in an eddy_pnl work directory.
+    """
+    manifest_file = local.path(work_dir) / MANIFEST
+    if not manifest_file.exists():
+        return {}
+    return json.loads(manifest_file.read())
+
+
+def write_manifest(work_dir, manifest):
+    manifest_file = local.path(work_dir) / MANIFEST
+    tmp_manifest_file = manifest_file.with_suffix(f'.{getpid()}')
+    tmp_manifest_file.write(json.dumps(manifest, indent=2))
+    os.replace(tmp_manifest_file, manifest_file)
+
+
+def remove_run(work_dir, manifest):
+    """
+    Deletes the files of the run recorded in a work directory's manifest
+    (its split and registered volumes, B0, merged DWI and the manifest
+    itself), leaving any other files alone.
+    """
+    work_dir = local.path(work_dir)
+    files = [MERGED_DWI, manifest.get('b0'), MANIFEST]
+    for vol in manifest.get('volumes', []):
+        files.append(vol)
+        files.extend(f.name for f in _registration_outputs(work_dir / vol))
+    for name in filter(None, files):
+        (work_dir / name).delete()
+
+
+@contextmanager
+def _eddy_work_dir(work_dir=None):
+    if not work_dir:
+        with local.tempdir() as tmpdir:
+            yield tmpdir
+    else:
+        work_dir = local.path(work_dir)
+        work_dir.mkdir()
+        yield work_dir
+
+
+def eddy_pnl(dwi, output, num_proc=NUM_PROC_EDDY, fsldir=None, debug=False, split_merge='fsl',
+             work_dir=None, registration='flirt'):
     """
     Eddy current correction.
+
+    Each volume is affinely registered to the first B0, either with FSL's
+    flirt (registration='flirt') or in-process by
+    affine_registration.register_volume (registration='numpy').
+
+    With split_merge='nibabel' the DWI is split into uncompressed volumes and
+    the registered volumes are merged in-process rather than by fslsplit and
+    fslmerge, avoiding compressing and decompressing every volume.
+
+    num_proc='auto' sizes the registration pool from the available CPUs and
+    memory (see auto_num_proc).
+
+    If work_dir is given, intermediate files are kept there rather than in a
+    temporary directory, and completed registrations are recorded in its
+    manifest so that a rerun only registers the missing volumes.
     """
 
+    if split_merge not in SPLIT_MERGE_TYPES:
+        raise Exception(f'split_merge must be one of {SPLIT_MERGE_TYPES}, got: {split_merge}')
+    if registration not in REGISTRATION_BACKENDS:
+        raise Exception(f'registration must be one of {REGISTRATION_BACKENDS}, '
+                        f'got: {registration}')
+
     dwi_file = local.path(dwi)
-    bvec_file = dwi_file.with_suffix('.bvec', depth=2)
+    gradients = GradientTable.for_dwi(dwi_file)
     bval_file = dwi_file.with_suffix('.bval', depth=2)
     output = local.path(output)
     output_bvec = output.with_suffix('.bvec', depth=2)
     output_bval = output.with_suffix('.bval', depth=2)
     output_transforms_tar = str(output)[:-7] + '-xfms.tar.gz'
+    output_transforms_npz = str(output)[:-7] + '-xfms.npz'
     output_debug = output.parent / f"eddy-debug-{getpid()}"
 
-    with local.tempdir() as tmpdir, local.cwd(tmpdir), util.fsl_env(fsldir):
-
-        fslsplit = local['fslsplit']
-        fslmerge = local['fslmerge']
-
-        log.info('Dice the DWI')
-        fslsplit(dwi_file)
-        vols = sorted(tmpdir // ('vol*.nii.gz'))
+    with _eddy_work_dir(work_dir) as tmpdir, local.cwd(tmpdir), util.fsl_env(fsldir):
+
+        manifest = read_manifest(tmpdir)
+        dwi_stat = dwi_file.stat()
+        settings = dict(dwi=str(dwi_file), dwi_mtime=dwi_stat.st_mtime, dwi_size=dwi_stat.st_size,
+                        split_merge=split_merge, registration=registration)
+        if any(manifest.get(key) != value for (key, value) in settings.items()):
+            if manifest:
+                log.info(f'The DWI or settings changed, removing the previous run from {tmpdir}')
+                remove_run(tmpdir, manifest)
+            manifest = dict(settings, registered=[])
+
+        if 'volumes' in manifest:
+            log.info(f'Using the DWI volumes already split in {tmpdir}')
+            vols = [tmpdir / vol for vol in manifest['volumes']]
+        else:
+            log.info('Dice the DWI')
+            if split_merge == 'nibabel':
+                vols = split_volumes(dwi_file, tmpdir)
+            else:
+                local['fslsplit'](dwi_file)
+                vols = [tmpdir / f'vol{i:04}.nii.gz' for i in range(len(gradients))]
+            manifest['volumes'] = [vol.name for vol in vols]
+            write_manifest(tmpdir, manifest)
         log.debug(f'Split volumes: {vols}')
 
-        log.info('Extract the B0')
-        bse.bse(dwi_file, 'b0.nii.gz')
-
-        pool = Pool(int(num_proc))
-        res = pool.map_async(_multiprocessing_register, vols)
-        registered_vols = res.get()
+        if not manifest.get('b0'):
+            log.info('Extract the B0')
+            bse.bse(dwi_file, 'b0.nii.gz', gradients=gradients)
+            manifest['b0'] = 'b0.nii.gz'
+            write_manifest(tmpdir, manifest)
+
+        registered = set(manifest['registered'])
+        pending_vols = [vol for vol in vols if vol.name not in registered or
+                        not all(f.exists() for f in _registration_outputs(vol))]
+        if len(pending_vols) < len(vols):
+            log.info(f'Skipping {len(vols) - len(pending_vols)} volumes already registered')
+
+        if num_proc == 'auto':
+            num_proc = auto_num_proc(dwi_file)
+        if registration == 'numpy':
+            pool = Pool(int(num_proc), _init_numpy_register, ('b0.nii.gz',))
+            register_vol = _multiprocessing_numpy_register
+        else:
+            pool = Pool(int(num_proc))
+            register_vol = _multiprocessing_register
+        matrices = {}
+        for vol, matrix in pool.imap_unordered(register_vol, pending_vols):
+            if matrix is not None:
+                matrices[vol.name] = matrix
+            registered.add(vol.name)
+            manifest['registered'] = sorted(registered)
+            write_manifest(tmpdir, manifest)
         pool.close()
         pool.join()
 
-        fslmerge('-t', 'EddyCorrect-DWI.nii.gz', registered_vols)
-        transforms = sorted(tmpdir.glob('vol*.txt'))
+        registered_vols, transforms = map(list, zip(*[_registration_outputs(vol) for vol in vols]))
+        xfms = np.stack([matrices[vol.name] if vol.name in matrices else np.loadtxt(transform)
+                         for (vol, transform) in zip(vols, transforms)])
+
+        if split_merge == 'nibabel':
+            merge_volumes(registered_vols, MERGED_DWI, template=dwi_file)
+        else:
+            local['fslmerge']('-t', MERGED_DWI, registered_vols)
 
         log.info('Extract the rotations and realign the gradients')
-        bvecs = util.read_bvecs(bvec_file)
-        bvecs_new = bvecs.copy()
-        for i, t in enumerate(transforms):
-            log.info('Apply ' + t)
-            tra = np.loadtxt(t)
-            # remove the translation
-            aff = np.matrix(tra[0:3, 0:3])  # FIXME Use ndarray to suppress warning
-            # compute the finite strain of aff to get the rotation
-            rot = aff*aff.T
-            # compute the square root of rot
-            [el, ev] = np.linalg.eig(rot)
-            eL = np.identity(3)*np.sqrt(el)
-            sq = ev*eL*ev.I
-            # finally the rotation is defined as
-            rot = sq.I*aff
-            bvecs_new[i] = np.dot(rot, bvecs[i]).tolist()[0]
-
-        log.info(f'Copy EddyCorrect-DWI.nii.gz to {output}')
-        local.path('EddyCorrect-DWI.nii.gz').copy(output)
+        rotated_gradients = gradients.rotated(xfms)
+
+        log.info(f'Copy {MERGED_DWI} to {output}')
+        local.path(MERGED_DWI).copy(output)
 
         log.info(f'Make {output_bvec}')
-        util.write_bvecs(bvecs_new, output_bvec)
+        rotated_gradients.write_bvecs(output_bvec)
 
         log.info(f'Make {output_bval}')
         bval_file.copy(output_bval)
@@ -119,6 +444,11 @@ def eddy_pnl(dwi, output, num_proc=NUM_PROC_EDDY, fsldir=None, debug=False):
         log.info(f'Make {output_transforms_tar}')
         local['tar']('cvzf', output_transforms_tar, transforms)
 
+        log.info(f'Make {output_transforms_npz}')
+        b0 = nib.load('b0.nii.gz')
+        center = (np.array(b0.shape[:3]) - 1) * b0.header.get_zooms()[:3] / 2
+        save_transforms(output_transforms_npz, xfms, gradients.bvals, center)
+
         if debug:
             tmpdir.copy(output_debug)
 
@@ -136,6 +466,89 @@ def test_eddy_pnl(fsldir):
                                expected_output.with_suffix(suffix, depth=2))
 
 
+def test_eddy_pnl_resume(monkeypatch):
+
+    def fake_register(source_nii, target_nii, output, fsldir=None):
+        if source_nii.name == fail_vol:
+            raise Exception(f'Failed to register {source_nii}')
+        with open('registered.txt', 'a') as f:
+            f.write(source_nii.name + '\n')
+        source_nii.copy(output)
+        np.savetxt(_registration_outputs(source_nii)[1], np.identity(4))
+
+    def first_volume(dwi, output, **kwargs):
+        nib.Nifti1Image(data[..., 0], np.identity(4)).to_filename(str(output))
+
+    monkeypatch.setattr(sys.modules[__name__], 'register', fake_register)
+    monkeypatch.setattr(bse, 'bse', first_volume)
+    data = np.random.RandomState(0).randint(0, 1000, size=(4, 5, 6, 4)).astype(np.int16)
+    with local.tempdir() as tmpdir:
+        dwi = tmpdir / 'dwi.nii.gz'
+        nib.Nifti1Image(data, np.identity(4)).to_filename(str(dwi))
+        util.write_bvecs(np.identity(3)[[0, 1, 2, 0]], tmpdir / 'dwi.bvec')
+        (tmpdir / 'dwi.bval').write('0 1000 1000 1000')
+        work_dir = tmpdir / 'work'
+        output = tmpdir / 'dwi_eddy.nii.gz'
+
+        fail_vol = 'vol0002.nii'
+        with pytest.raises(Exception):
+            eddy_pnl(dwi, output, num_proc=1, split_merge='nibabel', work_dir=work_dir)
+        assert 'vol0002.nii' not in read_manifest(work_dir)['registered']
+
+        fail_vol = None
+        eddy_pnl(dwi, output, num_proc=1, split_merge='nibabel', work_dir=work_dir)
+        registered = (work_dir / 'registered.txt').read().split()
+        assert registered.count('vol0000.nii') == registered.count('vol0001.nii') == 1
+        assert set(registered) == {'vol0000.nii', 'vol0001.nii', 'vol0002.nii', 'vol0003.nii'}
+        assert len(read_manifest(work_dir)['registered']) == 4
+        assert np.array_equal(nib.load(str(output)).get_fdata(), data)
+
+        # a DWI regenerated at the same path is split and registered again, and
+        # only the previous run's own files are removed
+        (work_dir / 'notes.txt').write('not from eddy_pnl')
+        (work_dir / 'registered.txt').delete()
+        data = data[..., [1, 0, 2, 3]]
+        nib.Nifti1Image(data, np.identity(4)).to_filename(str(dwi))
+        os.utime(dwi, (0, 0))
+        eddy_pnl(dwi, output, num_proc=1, split_merge='nibabel', work_dir=work_dir)
+        assert sorted((work_dir / 'registered.txt').read().split()) == \
+            ['vol0000.nii', 'vol0001.nii', 'vol0002.nii', 'vol0003.nii']
+        assert np.array_equal(nib.load(str(output)).get_fdata(), data)
+        assert (work_dir / 'notes.txt').read() == 'not from eddy_pnl'
+
+
+def num_proc_arg(value):
+    return value if value == 'auto' else int(value)
+
+
+def test_eddy_pnl_numpy_registration(monkeypatch):
+
+    def first_volume(dwi, output, **kwargs):
+        img = nib.load(str(dwi))
+        nib.Nifti1Image(img.dataobj[..., 0], img.affine).to_filename(str(output))
+
+    monkeypatch.setattr(bse, 'bse', first_volume)
+    volume = np.pad(np.random.RandomState(0).rand(16, 16, 12), 4)
+    volume = np.round(1000 * affine_registration.ndimage.gaussian_filter(volume, 2))
+    data = np.stack([volume, volume, np.roll(volume, 1, axis=0)], axis=-1).astype(np.int16)
+    with local.tempdir() as tmpdir:
+        dwi = tmpdir / 'dwi.nii.gz'
+        nib.Nifti1Image(data, np.diag([2, 2, 2, 1])).to_filename(str(dwi))
+        bvecs = np.array([[0, 0, 0], [1, 0, 0], [0, 0.6, 0.8]])
+        util.write_bvecs(bvecs, tmpdir / 'dwi.bvec')
+        (tmpdir / 'dwi.bval').write('0 1000 1000')
+        output = tmpdir / 'dwi_eddy.nii.gz'
+        eddy_pnl(dwi, output, num_proc=2, split_merge='nibabel', registration='numpy')
+        output_data = nib.load(str(output)).get_fdata()
+        assert output_data.shape == data.shape
+        assert np.abs(output_data[..., 2] - volume).mean() < 0.05 * volume.mean()
+        gradients = GradientTable.from_files(output.with_suffix('.bval', depth=2),
+                                             output.with_suffix('.bvec', depth=2))
+        assert np.allclose(gradients.bvecs, bvecs, atol=0.01)
+        motion = motion_summary(tmpdir / 'dwi_eddy-xfms.npz')
+        assert np.allclose(motion.tx, [0, 0, 2], atol=0.1)
+
+
 class Cli(cli.Application):
 
     __doc__ = eddy_pnl.__doc__
@@ -161,16 +574,35 @@ class Cli(cli.Application):
 
     num_proc = cli.SwitchAttr(
         ['-n', '--num-proc'],
-        argtype=int,
+        argtype=num_proc_arg,
         default=NUM_PROC_EDDY,
         help=('number of threads to use, if other processes in your computer '
-              'becomes sluggish/you run into memory error, reduce number'))
+              'becomes sluggish/you run into memory error, reduce number. '
+              '"auto" picks it from the available CPUs and memory'))
 
     debug = cli.Flag(
         ['-d', '--debug'],
         default=False,
         help='saves registrations to eddy-debug-<pid>')
 
+    registration = cli.SwitchAttr(
+        ['-r', '--registration'],
+        argtype=cli.Set(*REGISTRATION_BACKENDS),
+        default='flirt',
+        help='Register the volumes with FSL\'s flirt ("flirt") or in-process ("numpy")')
+
+    work_dir = cli.SwitchAttr(
+        ['-w', '--work-dir'],
+        help=('Keep intermediate files in this directory so that an interrupted run '
+              'can be resumed by running again with the same directory'))
+
+    split_merge = cli.SwitchAttr(
+        ['--split-merge'],
+        argtype=cli.Set(*SPLIT_MERGE_TYPES),
+        default='fsl',
+        help=('Split and merge the DWI with fslsplit/fslmerge ("fsl") or in-process '
+              'through uncompressed volumes ("nibabel")'))
+
     fsldir = cli.SwitchAttr(
         ['--fsldir'],
         argtype=cli.ExistingDirectory,
@@ -195,4 +627,7 @@ class Cli(cli.Application):
         eddy_pnl(dwi=self.dwi,
                  output=self.output,
                  num_proc=self.num_proc,
-                 fsldir=self.fsldir)
+                 fsldir=self.fsldir,
+                 split_merge=self.split_merge,
+                 work_dir=self.work_dir,
+                 registration=self.registration)
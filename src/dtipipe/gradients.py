@@ -0,0 +1,136 @@
+import logging
+
+import numpy as np
+from plumbum import local
+
+from . import util
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_B0_THRESHOLD = 45.0
+DEFAULT_SHELL_TOLERANCE = 100.0
+
+
+class GradientTable(object):
+    """
+    The b-values (N) and b-vectors (Nx3) of a DWI, parsed once and held as
+    numpy arrays.
+    """
+
+    def __init__(self, bvals, bvecs):
+        self.bvals = np.asarray(bvals, dtype=float).ravel()
+        self.bvecs = np.asarray(bvecs, dtype=float)
+        if not self.bvecs.size:
+            self.bvecs = self.bvecs.reshape(0, 3)
+        self.validate()
+
+    @classmethod
+    def from_files(cls, bval_file, bvec_file):
+        bvals = np.loadtxt(str(bval_file), ndmin=1)
+        bvecs = np.loadtxt(str(bvec_file), ndmin=2)
+        # bvec_file can be 3xN or Nx3
+        if bvecs.shape[0] == 3:
+            bvecs = bvecs.T
+        return cls(bvals, bvecs)
+
+    @classmethod
+    def for_dwi(cls, dwi):
+        """
+        Reads the .bval and .bvec files next to a '.nii.gz' DWI.
+        """
+        dwi = local.path(dwi)
+        return cls.from_files(dwi.with_suffix('.bval', depth=2), dwi.with_suffix('.bvec', depth=2))
+
+    def validate(self):
+        if self.bvecs.ndim != 2 or self.bvecs.shape[1] != 3:
+            raise Exception(f'Expected Nx3 b-vectors, got shape {self.bvecs.shape}')
+        if len(self.bvals) != len(self.bvecs):
+            raise Exception(f'Got {len(self.bvals)} b-values but {len(self.bvecs)} b-vectors')
+        if not (np.all(np.isfinite(self.bvals)) and np.all(np.isfinite(self.bvecs))):
+            raise Exception('Gradient table has non-finite values')
+        if np.any(self.bvals < 0):
+            raise Exception('Gradient table has negative b-values')
+
+    def __len__(self):
+        return len(self.bvals)
+
+    def norms(self):
+        return np.linalg.norm(self.bvecs, axis=1)
+
+    def normalized(self):
+        """
+        Returns a table with unit b-vectors (zero b-vectors stay zero).
+        """
+        norms = self.norms()
+        bvecs = np.zeros_like(self.bvecs)
+        nonzero = norms > 0
+        bvecs[nonzero] = self.bvecs[nonzero] / norms[nonzero, np.newaxis]
+        return GradientTable(self.bvals, bvecs)
+
+    def scaled_bvecs(self, b_max=None):
+        """
+        Returns the b-vectors scaled by sqrt(bval / b_max), for formats like
+        NRRD that encode the b-values in the b-vector lengths.
+        """
+        b_max = self.bvals.max() if b_max is None else b_max
+        factors = np.sqrt(self.bvals / b_max)
+        scale = (self.bvals != 0) & (self.norms() != factors)
+        return np.where(scale[:, np.newaxis], self.bvecs * factors[:, np.newaxis], self.bvecs)
+
+    def rotated(self, transforms):
+        """
+        Returns a table with each b-vector rotated by the rotation part of its
+        (N,4,4) transform.
+        """
+        return GradientTable(self.bvals, util.rotate_bvecs(self.bvecs, transforms))
+
+    def b0_mask(self, b0_threshold=DEFAULT_B0_THRESHOLD):
+        return self.bvals < b0_threshold
+
+    def b0_indices(self, b0_threshold=DEFAULT_B0_THRESHOLD):
+        return np.flatnonzero(self.b0_mask(b0_threshold))
+
+    def shells(self, tolerance=DEFAULT_SHELL_TOLERANCE, b0_threshold=DEFAULT_B0_THRESHOLD):
+        """
+        Groups the volumes by b-value, starting a new shell wherever the sorted
+        b-values jump by more than tolerance or cross b0_threshold.  Shells
+        are numbered in order of b-value, so any B0's are shell 0.
+
+        Returns the mean b-value of each shell and the shell index of each
+        volume.
+        """
+        order = np.argsort(self.bvals, kind='stable')
+        sorted_bvals = self.bvals[order]
+        is_b0 = sorted_bvals < b0_threshold
+        new_shell = (np.diff(sorted_bvals) > tolerance) | (is_b0[:-1] != is_b0[1:])
+        labels = np.empty(len(self), dtype=int)
+        labels[order] = np.concatenate([[0], np.cumsum(new_shell)])
+        shell_bvals = np.bincount(labels, weights=self.bvals) / np.bincount(labels)
+        return shell_bvals, labels
+
+    def write_bvals(self, bval_file):
+        with open(bval_file, 'w') as f:
+            f.write(' '.join(f'{b:g}' for b in self.bvals))
+
+    def write_bvecs(self, bvec_file):
+        util.write_bvecs(self.bvecs, bvec_file)
+
+
+def test_gradient_table():
+    with local.tempdir() as tmpdir:
+        (tmpdir / 'dwi.bval').write('0 1000 1000 5 2000 2010\n')
+        (tmpdir / 'dwi.bvec').write('0 2 0 0 0 0.6\n0 0 1 0 1 0\n0 0 0 0 0 0.8\n')
+        gradients = GradientTable.for_dwi(tmpdir / 'dwi.nii.gz')
+    assert gradients.bvecs.shape == (6, 3)
+    assert gradients.b0_indices().tolist() == [0, 3]
+    assert np.allclose(gradients.normalized().bvecs[1], [1, 0, 0])
+    assert np.allclose(gradients.normalized().bvecs[0], [0, 0, 0])
+    shell_bvals, labels = gradients.shells()
+    assert labels.tolist() == [0, 1, 1, 0, 2, 2]
+    assert np.allclose(shell_bvals, [2.5, 1000, 2005])
+    scaled = gradients.normalized().scaled_bvecs()
+    assert np.allclose(scaled[1], [np.sqrt(1000 / 2010), 0, 0])
+    assert np.allclose(scaled[5], [0.6, 0, 0.8])
+    rotation = np.identity(4)[[1, 0, 2, 3]]
+    assert np.allclose(gradients.rotated(np.tile(rotation, (6, 1, 1))).bvecs[2], [1, 0, 0])
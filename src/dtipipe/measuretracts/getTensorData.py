@@ -4,35 +4,37 @@
 Right now this only gets all in the volume tensors;
 plan on it getting individual fibers eventually.  This is just to
 get David started"""
+import logging
+
 import vtk
-import sys
+from vtk.util.numpy_support import vtk_to_numpy
+
+from .. import polydata
+
+log = logging.getLogger(__name__)
+
+TENSOR_NAMES = ['tensor1', 'tensor2', 'FreeWater']
+
+def _is_binary(filename):
+    """Whether a legacy VTK file is binary (which polydata reads) or ASCII"""
+    with open(str(filename), 'rb') as f:
+        return [f.readline() for _ in range(3)][2].strip() == b'BINARY'
 
 def get_num_fibers(filename):
-    #reader = vtk.vtkDataSetReader()
+    if _is_binary(filename):
+        return polydata.read_num_lines(filename)
     reader = vtk.vtkPolyDataReader()
-    reader.SetFileName(filename)
+    reader.SetFileName(str(filename))
     reader.Update()
     nlines = reader.GetOutput().GetNumberOfLines()
     return nlines
 
-def get_tensor_array(filename):
-    """Returns vtk tensor array object which can have 'GetTuple9(i)' called on it."""
-    print("Reading " + filename)
-    reader = vtk.vtkDataSetReader()
-    reader.SetFileName(filename)
-    reader.Update()
-
-    output = reader.GetOutput()
-    print('npoints:', output.GetNumberOfPoints())
-    print('ncells:', output.GetNumberOfCells())
-    print('nscalars:', reader.GetNumberOfScalarsInFile())
-    print('ntensors:', reader.GetNumberOfTensorsInFile())
-    print('ScalarName:', reader.GetScalarsNameInFile(0))
-    print('TensorName:', reader.GetTensorsNameInFile(0))
-
-    output = reader.GetOutput()
-    pointdata = output.GetPointData()
-    #scalar_array = pointdata.GetArray('scalar')
+def _find_tensor_array(pointdata, filename, name=None):
+    if name is not None:
+        tensor_array = pointdata.GetArray(name)
+        if not tensor_array:
+            raise KeyError("Cannot find '%s' in %s" % (name, filename))
+        return tensor_array
     tensor_array = pointdata.GetTensors()
     if not tensor_array:
         tensor_array = pointdata.GetArray('tensor')
@@ -43,18 +45,119 @@ def get_tensor_array(filename):
     if not tensor_array:
         tensor_array = pointdata.GetArray('tensor1')
     if not tensor_array:
-        print("Cannot find tensors in %s" % filename)
-        sys.exit(1)
+        raise KeyError("Cannot find tensors in %s" % filename)
     return tensor_array
 
-def get_all_tensors(filename):
-    """Returns a list of 9-tuples representing the tensor at each vtk point"""
-    tensor_array = get_tensor_array(filename)
-    num_tensors = tensor_array.GetNumberOfTuples()
-    output = []
-    for i in range(num_tensors):
-        output.append(tensor_array.GetTuple9(i))
-    return output
+def get_tensor_array(filename, name=None):
+    """Returns vtk tensor array object which can have 'GetTuple9(i)' called on it.
+    name selects a point data array (e.g. 'tensor2' or 'FreeWater'), by default
+    the file's tensors are used."""
+    log.debug("Reading %s", filename)
+    reader = vtk.vtkDataSetReader()
+    reader.SetFileName(filename)
+    reader.Update()
+
+    output = reader.GetOutput()
+    log.debug('npoints: %s', output.GetNumberOfPoints())
+    log.debug('ncells: %s', output.GetNumberOfCells())
+    log.debug('nscalars: %s', reader.GetNumberOfScalarsInFile())
+    log.debug('ntensors: %s', reader.GetNumberOfTensorsInFile())
+    log.debug('ScalarName: %s', reader.GetScalarsNameInFile(0))
+    log.debug('TensorName: %s', reader.GetTensorsNameInFile(0))
+
+    return _find_tensor_array(output.GetPointData(), filename, name)
+
+def tensor_array_name(filename, name=None):
+    """The name of the point data array _find_tensor_array picks, found from
+    the file's headers only"""
+    headers = polydata.read_point_array_headers(filename)
+    names = [arrayName for (_, arrayName) in headers]
+    if name is not None:
+        if name not in names:
+            raise KeyError("Cannot find '%s' in %s" % (name, filename))
+        return name
+    attributes = [arrayName for (kind, arrayName) in headers if kind == 'TENSORS']
+    for arrayName in attributes[-1:] + ['tensor', 'tensors', 'Tensors_', 'tensor1']:
+        if arrayName in names:
+            return arrayName
+    raise KeyError("Cannot find tensors in %s" % filename)
+
+def read_tensors(filename, name=None):
+    """Returns the tensors of a tract file as a read only (N,9) memory map
+    (see polydata.read_polydata), and its number of fibers, without decoding
+    its lines or other arrays.  name selects a point data array instead of
+    the tensors, e.g. 'tensor2' or 'FreeWater' (which is (N,)).
+
+    ASCII files are read with VTK."""
+    if not _is_binary(filename):
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(str(filename))
+        reader.Update()
+        output = reader.GetOutput()
+        tensor_array = _find_tensor_array(output.GetPointData(), filename, name)
+        return vtk_to_numpy(tensor_array), output.GetNumberOfLines()
+    name = tensor_array_name(filename, name)
+    tracts = polydata.read_polydata(filename, arrays=[name], cells=False)
+    return tracts.point_array(name), polydata.read_num_lines(filename)
+
+def get_all_tensors(filename, name=None):
+    """Returns an (N,9) numpy array of the tensor at each vtk point (a read
+    only memory map of the file)"""
+    return read_tensors(filename, name)[0]
+
+def test_read_tensors():
+    import numpy as np
+    import pytest
+    from plumbum import local
+    from vtk.util.numpy_support import numpy_to_vtk
+
+    rng = np.random.RandomState(0)
+    points = vtk.vtkPoints()
+    points.SetData(numpy_to_vtk(rng.rand(5, 3).astype(np.float32), deep=True))
+    lines = vtk.vtkCellArray()
+    for line in [[0, 1], [2, 3, 4]]:
+        lines.InsertNextCell(len(line))
+        for i in line:
+            lines.InsertCellPoint(i)
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetLines(lines)
+    arrays = {'tensor1': rng.rand(5, 9), 'tensor2': rng.rand(5, 9), 'FreeWater': rng.rand(5)}
+    for name in TENSOR_NAMES:
+        array = numpy_to_vtk(arrays[name].astype(np.float32), deep=True)
+        array.SetName(name)
+        polydata.GetPointData().AddArray(array)
+    polydata.GetPointData().SetActiveTensors('tensor1')
+    with local.tempdir() as tmpdir:
+        for binary in [False, True]:
+            writer = vtk.vtkPolyDataWriter()
+            writer.SetFileName(str(tmpdir / 'tract.vtk'))
+            if binary:
+                writer.SetFileTypeToBinary()
+            writer.SetInputData(polydata)
+            writer.Write()
+            tensors, num_fibers = read_tensors(tmpdir / 'tract.vtk')
+            assert num_fibers == get_num_fibers(tmpdir / 'tract.vtk') == 2
+            assert np.allclose(tensors, arrays['tensor1'])
+            for name in TENSOR_NAMES:
+                assert np.allclose(read_tensors(tmpdir / 'tract.vtk', name)[0], arrays[name])
+            with pytest.raises(KeyError, match='missing'):
+                read_tensors(tmpdir / 'tract.vtk', 'missing')
+            # no tensors at all
+            untensored = vtk.vtkPolyData()
+            untensored.SetPoints(points)
+            untensored.SetLines(lines)
+            writer.SetFileName(str(tmpdir / 'untensored.vtk'))
+            writer.SetInputData(untensored)
+            writer.Write()
+            with pytest.raises(KeyError, match='Cannot find tensors'):
+                read_tensors(tmpdir / 'untensored.vtk')
+        # the same tensors as VTK's reader, even with activate_tensors's two tensor1 arrays
+        from .. import activate_tensors
+        activate_tensors.activate_tensors(tmpdir / 'tract.vtk', tmpdir / 'activated.vtk')
+        assert np.array_equal(read_tensors(tmpdir / 'activated.vtk')[0],
+                              vtk_to_numpy(get_tensor_array(str(tmpdir / 'activated.vtk'))))
+        assert get_num_fibers(tmpdir / 'activated.vtk') == 2
 
 if __name__ == '__main__':
     import sys
@@ -2,6 +2,7 @@ import numpy as np
 import os.path
 
 from . import getTensorData
+from .. import polydata
 
 
 def tracer(currentTensor):
@@ -50,9 +51,96 @@ def computeFAFromTensorEigenvalues(ev):
         ret = float(((ev[1]-ev[2])**2+(ev[2]-ev[0])**2+(ev[1]-ev[0])**2)**0.5)/denom
     return ret
 
+MEASURES = ['Linear', 'Planar', 'Spherical', 'RA', 'FA', 'trace', 'mode', 'axial', 'radial']
+
+
+def computeEigenvalues(tensors):
+    """Eigenvalues of an (N,3,3) or (N,9) tensor array, in decreasing order.
+
+    Like getData always has, negative eigenvalues are set to 0, except the
+    first one returned by np.linalg.eig.  Symmetric tensors with no negative
+    eigenvalues (nearly all of them) use the symmetric solver; the rest use
+    eig so that the same eigenvalues are clamped as before."""
+    tensors = np.asarray(tensors, dtype=float).reshape(-1, 3, 3)
+    ev = np.linalg.eigvalsh(tensors)
+    symmetric = np.all(tensors == tensors.transpose(0, 2, 1), axis=(1, 2))
+    fallback = ~symmetric | np.any(ev < 0, axis=1)
+    if fallback.any():
+        evEig = np.linalg.eig(tensors[fallback])[0].real
+        evEig[:, 1:] = np.where(evEig[:, 1:] < 0, 0, evEig[:, 1:])
+        ev[fallback] = evEig
+    return np.sort(ev, axis=1)[:, ::-1]
+
+
+def computeModes(tensors):
+    """Mode of each tensor of an (N,3,3) array (see computeModeFromTensor)"""
+    trace = np.trace(tensors, axis1=1, axis2=2)
+    AT = tensors - (trace / 3.0)[:, np.newaxis, np.newaxis] * np.eye(3)
+    normAT = (AT[:, 0, 0]**2 + 2*AT[:, 0, 1]**2 + 2*AT[:, 0, 2]**2 + AT[:, 1, 1]**2 +
+              2*AT[:, 1, 2]**2 + AT[:, 2, 2]**2)**0.5
+    mode = np.zeros(len(tensors))
+    positive = normAT > 0
+    mode[positive] = 3*(6**0.5)*np.linalg.det(AT[positive] /
+                                              normAT[positive, np.newaxis, np.newaxis])
+    return mode
+
+
+def computeMeasures(tensors):
+    """Returns a dict of the values of each of MEASURES at each tensor of an
+    (N,3,3) or (N,9) array, computed as getData's per tensor functions do.
+    RA is not computed and is 0."""
+    tensors = np.asarray(tensors, dtype=float).reshape(-1, 3, 3)
+    ev = computeEigenvalues(tensors)
+    nonzero = ev[:, 0] != 0
+    ev0 = np.where(nonzero, ev[:, 0], 1)
+    faDenom = (2*(ev**2).sum(axis=1))**0.5
+    faNum = ((ev[:, 1]-ev[:, 2])**2 + (ev[:, 2]-ev[:, 0])**2 + (ev[:, 1]-ev[:, 0])**2)**0.5
+    return {'Linear': np.where(nonzero, (ev[:, 0]-ev[:, 1])/ev0, 0),
+            'Planar': np.where(nonzero, (ev[:, 1]-ev[:, 2])/ev0, 0),
+            'Spherical': np.where(nonzero, ev[:, 2]/ev0, 1),
+            'RA': np.zeros(len(tensors)),
+            'FA': np.where(faDenom == 0, 0, faNum/np.where(faDenom == 0, 1, faDenom)),
+            'trace': np.trace(tensors, axis1=1, axis2=2),
+            'mode': computeModes(tensors),
+            'axial': 1000*ev[:, 0],
+            'radial': 1000*(ev[:, 1]+ev[:, 2])/2}
+
+
+def test_computeMeasures():
+    rng = np.random.RandomState(0)
+    A = rng.randn(200, 3, 3)
+    tensors = A @ A.transpose(0, 2, 1) * 1e-3
+    # some tensors with negative eigenvalues, a zero tensor and an isotropic one
+    tensors[:20] -= 2e-3 * np.eye(3)
+    tensors[20] = 0
+    tensors[21] = 1e-3 * np.eye(3)
+    measures = computeMeasures(tensors.reshape(-1, 9))
+    for (i, currentTensor) in enumerate(tensors):
+        ev = np.linalg.eig(currentTensor)[0]
+        for num in range(1, len(ev)):
+            if ev[num] < 0:
+                ev[num] = 0
+        ev = np.sort(ev)[::-1]
+        expected = dict(zip(['Linear', 'Planar', 'Spherical'],
+                            computeLPSFromTensorEigenvalues(ev)))
+        expected.update({'RA': 0,
+                         'FA': computeFAFromTensorEigenvalues(ev),
+                         'trace': tracer(currentTensor),
+                         'mode': computeModeFromTensor(currentTensor),
+                         'axial': 1000*ev[0],
+                         'radial': 1000*(ev[1]+ev[2])/2})
+        for measure in MEASURES:
+            assert np.isclose(measures[measure][i], expected[measure], rtol=1e-9, atol=1e-12), \
+                (i, measure)
+
+
 #print "Enter the file name you want to import"
     #VTK=raw_input()
-def getData(nodeID):
+def getData(nodeID, tensor_name=None, chunk_size=None):
+    """Computes the statistics of the tensor measures of a tract file, or of a
+    Slicer fiber bundle node.  tensor_name selects the tensors to use (e.g.
+    'tensor2'), by default the file's tensors.  If chunk_size is given, a tract
+    file is measured chunk_size points at a time (see getDataStreaming)."""
 
     if 'MRMLFiberBundle' in nodeID:
         Slicer = __import__ ( "Slicer" ) #weird import
@@ -62,135 +150,236 @@ def getData(nodeID):
 
         data = node.GetPolyData()
         points = data.GetPointData()
-        tensors = points.GetTensors()
-        length = data.GetNumberOfPoints()
+        tensors = points.GetArray(tensor_name) if tensor_name else points.GetTensors()
         num_fibers = data.GetNumberOfLines()
-
-        pTract = np.zeros([length, 9])
-        for num in range(length):
-            pTract[num] = np.array(tensors.GetTuple9(num))
+        pTract = getTensorData.vtk_to_numpy(tensors)
+    elif chunk_size:
+        return getDataStreaming(nodeID, tensor_name, chunk_size)
     else:
-        pTract = getTensorData.get_all_tensors(nodeID)
-        length = len(pTract)
-        num_fibers = getTensorData.get_num_fibers(nodeID)
-
-    results = {'Linear':{},'Planar':{},'Spherical':{},'RA':{},'FA':{},
-               'trace':{},'mode':{},'axial':{},'radial':{}}
-
-    for num in results.keys():
-        results[num]['values'] = np.zeros(length)
-
-#    fileName = 'slicerMeasureTest.csv'
-    retLi = np.zeros(length)
-    retSp = np.zeros(length)
-    retPl = np.zeros(length)
-
-    for i in range(length):
-
-            currentTensor=np.array(pTract[i]).reshape((3,3))
-            ev=np.linalg.eig(currentTensor)[0]
-
-            for num in range(1,len(ev)):#eliminate negative numbers
-                if ev[num]<0:
-                    ev[num]=0
-
-            ev.sort()
-            ev2=np.copy(ev)
-            ev[0]=ev2[2]
-            ev[2]=ev2[0]
-
-            results['mode']['values'][i]=computeModeFromTensor(currentTensor)
-            results['trace']['values'][i]=tracer(currentTensor)
-            [retLi[i], retPl[i], retSp[i]]=computeLPSFromTensorEigenvalues(ev)
-            results['Linear']['values'][i]=retLi[i]
-            results['Planar']['values'][i]=retPl[i]
-            results['Spherical']['values'][i]=retSp[i]
-            #results['RA']['values'][i]=computeRAFromTensorEigenvalues(ev)
-            results['FA']['values'][i]=computeFAFromTensorEigenvalues(ev)
-            results['axial']['values'][i]=1000*ev[0]
-            results['radial']['values'][i]=1000*(ev[1]+ev[2])/2
-    i=0
-    for measure in results.keys():
-            data=results[measure]['values']
-            results[measure]['mean'] = 1000*sum(data)/length
-            results[measure]['minimum'] = 1000*min(data)
-            results[measure]['maximum'] = 1000*max(data)
-            results[measure]['stDev'] = 1000*data.std()
-
-    rawValues = {}
-    for measure in results.keys():
-        rawValues = results[measure]['values']
-        del results[measure]['values']
+        pTract, num_fibers = getTensorData.read_tensors(nodeID, tensor_name)
+    length = len(pTract)
+
+    measures = computeMeasures(pTract)
+    results = {}
+    for measure in MEASURES:
+            data=measures[measure]
+            results[measure] = {'mean': 1000*data.sum()/length,
+                                'minimum': 1000*data.min(),
+                                'maximum': 1000*data.max(),
+                                'stDev': 1000*data.std()}
 
     #if not 'MRMLFiberBundle' in nodeID:
     results['num_fibers'] = {'num_fibers': num_fibers}
     return results
 
-def printToCSV(nodes,fileName,extra_header=[],extra_values=[]):
-    """files is the list of VTKs that will be analyzed, fileName is the name that the CSV will be saved as"""
+DEFAULT_CHUNK_SIZE = 1000000
+DEFAULT_RESERVOIR_SIZE = 100000
+
+
+class RunningStats(object):
+    """Count, mean, population variance, minimum and maximum of a stream of
+    values that is seen one chunk at a time.  Chunks are merged with Chan et
+    al.'s parallel form of Welford's algorithm, so the variance stays accurate
+    however many values there are.
+
+    If reservoir_size is given, a uniform random sample of at most that many
+    values is kept to approximate quantiles."""
+
+    def __init__(self, reservoir_size=None, seed=0):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.reservoir_size = reservoir_size
+        self._rng = np.random.RandomState(seed)
+        self._sample = np.zeros(0)
+        self._keys = np.zeros(0)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        if not len(values):
+            return
+        count = self.count + len(values)
+        mean = values.mean()
+        delta = mean - self.mean
+        self.m2 += ((values - mean)**2).sum() + delta**2 * self.count * len(values) / count
+        self.mean += delta * len(values) / count
+        self.count = count
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        if self.reservoir_size:
+            # keeping the values with the smallest random keys is a uniform sample
+            self._sample = np.concatenate([self._sample, values])
+            self._keys = np.concatenate([self._keys, self._rng.rand(len(values))])
+            if len(self._sample) > self.reservoir_size:
+                keep = np.argpartition(self._keys, self.reservoir_size)[:self.reservoir_size]
+                self._sample, self._keys = self._sample[keep], self._keys[keep]
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def quantiles(self, q):
+        """Approximate quantiles (q in [0,1]) from the reservoir sample"""
+        if not self.reservoir_size:
+            raise Exception('RunningStats needs a reservoir_size for quantiles')
+        if not len(self._sample):
+            return np.full(np.shape(q), np.nan)
+        return np.quantile(self._sample, q)
+
+
+def quantileTag(q):
+    return 'p%g' % (100*q)
+
+
+def _streamTensorArray(filename, tensor_name=None):
+    """The tensors of a binary tract file as a read only memory map, chosen as
+    getTensorData.read_tensors does, and its number of fibers.  The lines and
+    other arrays aren't read.  ASCII files can't be mapped, and are read
+    whole by getTensorData.read_tensors."""
+    if not getTensorData._is_binary(filename):
+        return getTensorData.read_tensors(filename, tensor_name)
+    tensor_name = getTensorData.tensor_array_name(filename, tensor_name)
+    tracts = polydata.read_polydata(filename, arrays=[tensor_name], cells=False)
+    return tracts.point_array(tensor_name), polydata.read_num_lines(filename)
+
+
+def getDataStreaming(filename, tensor_name=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                     quantiles=None, reservoir_size=DEFAULT_RESERVOIR_SIZE):
+    """getData for tract files too big to measure in memory, e.g. whole brain
+    tractography.  The tensors are memory mapped and measured chunk_size
+    points at a time, so memory use does not depend on the size of the file.
+
+    The results are getData's (up to floating point error).  If quantiles
+    (e.g. [0.05, 0.5, 0.95]) are given, each measure also gets approximate
+    quantiles, keyed by quantileTag, from a sample of reservoir_size values."""
+    tensors, num_fibers = _streamTensorArray(filename, tensor_name)
+    stats = dict((measure, RunningStats(reservoir_size if quantiles else None))
+                 for measure in MEASURES)
+    for start in range(0, len(tensors), chunk_size):
+        measures = computeMeasures(tensors[start:start + chunk_size])
+        for measure in MEASURES:
+            stats[measure].update(measures[measure])
+
+    results = {}
+    for measure in MEASURES:
+        stat = stats[measure]
+        results[measure] = {'mean': 1000*stat.mean if stat.count else np.nan,
+                            'minimum': 1000*stat.minimum,
+                            'maximum': 1000*stat.maximum,
+                            'stDev': 1000*stat.std}
+        if quantiles:
+            for (q, value) in zip(quantiles, stat.quantiles(quantiles)):
+                results[measure][quantileTag(q)] = 1000*value
+    results['num_fibers'] = {'num_fibers': num_fibers}
+    return results
+
+
+def test_getDataStreaming():
+    from plumbum import local
+
+    rng = np.random.RandomState(0)
+    A = rng.randn(1000, 3, 3)
+    tensors = (A @ A.transpose(0, 2, 1) * 1e-3).astype(np.float32)
+    tracts = polydata.PolyData(rng.rand(1000, 3).astype(np.float32),
+                               {'LINES': (np.array([0, 400, 1000]), np.arange(1000))},
+                               [polydata.DataArray('tensor1', tensors.reshape(-1, 9), 'TENSORS')])
+    with local.tempdir() as tmpdir:
+        polydata.write_polydata(tmpdir / 'tract.vtk', tracts)
+        expected = getData(str(tmpdir / 'tract.vtk'))
+        assert isinstance(_streamTensorArray(tmpdir / 'tract.vtk')[0], np.memmap)
+        results = getDataStreaming(tmpdir / 'tract.vtk', chunk_size=77, quantiles=[0.5],
+                                   reservoir_size=2000)
+    assert np.allclose(measureRow(results), measureRow(expected), rtol=1e-9)
+    # the reservoir holds every value, so the quantile is exact
+    assert np.isclose(results['FA']['p50'],
+                      1000*np.median(computeMeasures(tensors)['FA']))
+
+    import vtk
+    with local.tempdir() as tmpdir:
+        polydata.write_polydata(tmpdir / 'tract.vtk', tracts)
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(str(tmpdir / 'tract.vtk'))
+        reader.Update()
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileName(str(tmpdir / 'ascii.vtk'))
+        writer.SetInputData(reader.GetOutput())
+        writer.Write()
+        assert not getTensorData._is_binary(tmpdir / 'ascii.vtk')
+        expected = getData(str(tmpdir / 'ascii.vtk'))
+        results = getDataStreaming(tmpdir / 'ascii.vtk', chunk_size=77)
+    assert np.allclose(measureRow(results), measureRow(expected), rtol=1e-9)
+
+    stats = RunningStats(reservoir_size=100)
+    values = 1e6 + rng.rand(10000)
+    for chunk in np.array_split(values, 13):
+        stats.update(chunk)
+    assert stats.count == 10000
+    assert np.isclose(stats.variance, values.var(), rtol=1e-6)
+    assert (stats.minimum, stats.maximum) == (values.min(), values.max())
+    assert len(stats._sample) == 100
+
+
+STATISTICS = ['mean', 'minimum', 'maximum', 'stDev']
+
+
+def measureTags():
+    """The CSV column names of getData's results, in the order of measureRow"""
+    return [measure+'_'+statistic for measure in MEASURES for statistic in STATISTICS] + ['num']
+
+def measureRow(results):
+    """getData's results as a list of values, in the order of measureTags"""
+    return [results[measure][statistic] for measure in MEASURES for statistic in STATISTICS] + \
+        [results['num_fibers']['num_fibers']]
+
+def _measureRow(args):
+    node, tensor_name, chunk_size = args
+    row = measureRow(getData(node, tensor_name, chunk_size))
+    print("Finished computing measures for '%s'\n" % node)
+    return row
+
+def getDataRows(nodes, num_proc=1, processes=True, tensor_name=None, chunk_size=None):
+    """Computes the measure row (see measureRow) of each node, on a pool of
+    num_proc processes (or threads if processes is False).  The rows are
+    returned in the order of nodes."""
+    jobs = [(node, tensor_name, chunk_size) for node in nodes]
+    num_proc = max(1, min(num_proc, len(jobs)))
+    if num_proc == 1:
+        return [_measureRow(job) for job in jobs]
+    from multiprocessing import Pool
+    from multiprocessing.pool import ThreadPool
+    poolClass = Pool if processes else ThreadPool
+    with poolClass(num_proc) as pool:
+        return pool.map(_measureRow, jobs)
+
+def printToCSV(nodes,fileName,extra_header=[],extra_values=[],num_proc=1,processes=True,chunk_size=None):
+    """files is the list of VTKs that will be analyzed, fileName is the name that the CSV will be saved as.
+    The files are measured num_proc at a time (see getDataRows), and their rows
+    written in the order of files.  Give a chunk_size to measure files too big
+    for memory, e.g. whole brain tractography (see getDataStreaming)."""
 
     import csv
     import os
-    if os.path.exists(fileName):
-        fileOut=csv.writer(open(fileName, 'a+'), delimiter=',', quoting=csv.QUOTE_NONNUMERIC, quotechar='"')
-        WRITE_HDR= False
-    else:
-        fileOut=csv.writer(open(fileName, 'w'), delimiter=',', quoting=csv.QUOTE_NONNUMERIC, quotechar='"')
-        WRITE_HDR= True
-
-    nodeID=nodes[0]
-    firstNode=getData(nodeID)
-
-    operation=[]
-    data=[]
-
-    for tag in firstNode.keys():
-        for key in firstNode[tag].keys():
-            operation.append(key)
-            data.append(tag)
-    length=len(data)
-    measureTags = [0]*length
-    for num in range(length):
-        if operation[num] == "num_fibers":
-            measureTags[num] = "num"
-        else:
-            measureTags[num] = data[num]+'_'+operation[num]
-    import re
-    #printTags=re.sub('\[', '',str(measureTags),count=0)
-    #printTags=re.sub('\]', '',str(printTags),count=0)
-    #printTags = ','.join(measureTags)
+    WRITE_HDR = not os.path.exists(fileName)
+
+    measureTags_ = measureTags()
     print("Computing the following measures")
-    print(','.join(measureTags))
-
-    header = extra_header + ['tract'] + measureTags
-    if WRITE_HDR:
-        fileOut.writerow(header)
-
-    measureNums = [0]*length
-    numberOfInputs=len(nodes)
-    import numpy
-    #rows=[]
-    lineNum=0
-    for node in nodes:
-        results=getData(node)
-        tally=0
-        measureNums = [0]*length
-        for tag in results.keys():
-            for key in results[tag].keys():
-                measureNums[tally] = results[tag][key]
-                tally=tally+1
-
-        #rows.append([node, measureNums])
-        #printNums=re.sub('\]', '',str(rows[lineNum]),count=0)
-        #printNums=re.sub('\[', '',str(rows[lineNum]),count=0)
-        #printNums = ','.join(map(str,rows[lineNum]))
-        #fileOut.writerow(printNums)
-        basename = os.path.basename(node)
-        basename = os.path.splitext(basename)[0]
-        #row = extra_values + ['"' + basename + '"'] + measureNums
-        row = extra_values + [basename] + measureNums
-        fileOut.writerow(row)
-        lineNum=lineNum+1
-        print("Finished computing measures for '%s'\n" % node)
+    print(','.join(measureTags_))
+
+    rows = getDataRows(nodes, num_proc=num_proc, processes=processes, chunk_size=chunk_size)
+
+    with open(fileName, 'w' if WRITE_HDR else 'a+') as f:
+        fileOut=csv.writer(f, delimiter=',', quoting=csv.QUOTE_NONNUMERIC, quotechar='"')
+        if WRITE_HDR:
+            fileOut.writerow(extra_header + ['tract'] + measureTags_)
+        for (node, measureNums) in zip(nodes, rows):
+            basename = os.path.basename(node)
+            basename = os.path.splitext(basename)[0]
+            fileOut.writerow(extra_values + [basename] + measureNums)
 
     print("Made " + fileName)
@@ -1,8 +1,10 @@
 import os
-import sys
+import glob
 import warnings
 import logging
 import filecmp
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 import coloredlogs
 import pytest
@@ -10,6 +12,7 @@ from plumbum import local, cli
 import nibabel as nib
 import numpy as np
 
+from .gradients import GradientTable
 from . import util
 from . import TEST_DATA
 
@@ -21,6 +24,19 @@ PRECISION = 17
 
 np.set_printoptions(precision=PRECISION, suppress=True, floatmode='maxprec')
 
+NUMPY_TO_NRRD_DTYPE = {
+    'int8': 'int8',
+    'int16': 'short',
+    'int32': 'int',
+    'int64': 'longlong',
+    'uint8': 'uchar',
+    'uint16': 'ushort',
+    'uint32': 'uint',
+    'uint64': 'ulonglong',
+    'float32': 'float',
+    'float64': 'double'
+}
+
 
 def matrix_string(A):
     A = str(A.tolist())
@@ -41,13 +57,12 @@ def find_mf(F):
     return R.T
 
 
-def nifti2nhdr(nifti, bval, bvec, nhdr):
+def nhdr_string(nifti, bval=None, bvec=None, data_file=None):
     """
-    Convert a nifti to nrrd by creating an nhdr header.
+    Returns the nhdr header of a nifti as a string.  Only the nifti's header
+    is read.
     """
 
-    print('Converting ', nifti)
-
     if nifti.endswith('.nii.gz'):
         encoding = 'gzip'
     elif nifti.endswith('.nii'):
@@ -58,58 +73,37 @@ def nifti2nhdr(nifti, bval, bvec, nhdr):
     img = nib.load(str(nifti))
     hdr = img.header
 
-    if not nhdr:
-        nhdr = os.path.abspath(nifti).split('.')[0] + '.nhdr'
-    elif not nhdr.endswith('nhdr'):
-        raise AttributeError('Output file must be nhdr')
-    else:
-        nhdr = os.path.abspath(nhdr)
-
     dim = hdr['dim'][0]
     # if bval/bvec provided but nifti is 3D, raise warning
     if dim == 3 and (bval or bvec):
         warnings.warn('nifti image is 3D, ignoring bval/bvec files')
 
     dtype = hdr.get_data_dtype()
-    numpy_to_nrrd_dtype = {
-        'int8': 'int8',
-        'int16': 'short',
-        'int32': 'int',
-        'int64': 'longlong',
-        'uint8': 'uchar',
-        'uint16': 'ushort',
-        'uint32': 'uint',
-        'uint64': 'ulonglong',
-        'float32': 'float',
-        'float64': 'double'
-    }
-
-    f = open(nhdr, 'w')
-    console = sys.stdout
-    sys.stdout = f
-
-    print(f'NRRD0005\n# NIFTI-->NHDR transform by Tashrif Billah\n\
+
+    lines = [f'NRRD0005\n# NIFTI-->NHDR transform by Tashrif Billah\n\
 # See https://github.com/pnlbwh/conversion for more info\n\
 # Complete NRRD file format specification at:\n\
 # http://teem.sourceforge.net/nrrd/format.html\n\
-type: {numpy_to_nrrd_dtype[dtype.name]}\ndimension: {dim}\nspace: right-anterior-superior')
+type: {NUMPY_TO_NRRD_DTYPE[dtype.name]}\ndimension: {dim}\nspace: right-anterior-superior']
 
     sizes = hdr['dim'][1:dim + 1]
-    print('sizes: {}'.format((' ').join(str(x) for x in sizes)))
+    lines.append('sizes: {}'.format((' ').join(str(x) for x in sizes)))
 
     spc_dir = hdr.get_best_affine()[0:3, 0:3]
 
-    # most important key
-    print('byteskip: -1')
+    # most important key: a gzipped nifti's data is at the end of the
+    # decompressed stream, a raw nifti's starts at vox_offset
+    byteskip = -1 if encoding == 'gzip' else int(img.dataobj.offset)
+    lines.append(f'byteskip: {byteskip}')
 
     endian = 'little' if dtype.byteorder == '<' else 'big'
-    print(f'endian: {endian}')
-    print(f'encoding: {encoding}')
-    print('space units: "mm" "mm" "mm"')
+    lines.append(f'endian: {endian}')
+    lines.append(f'encoding: {encoding}')
+    lines.append('space units: "mm" "mm" "mm"')
 
     spc_orig = hdr.get_qform()[0:3, 3]
-    print('space origin: ({})'.format((',').join(str(x) for x in spc_orig)))
-    print(f'data file: {os.path.basename(nifti)}')
+    lines.append('space origin: ({})'.format((',').join(str(x) for x in spc_orig)))
+    lines.append(f'data file: {data_file or os.path.basename(nifti)}')
 
     # define oldmin and oldmax when scl_slope and scl_inter are present
     scl_slope = img.dataobj.slope
@@ -118,45 +112,127 @@ type: {numpy_to_nrrd_dtype[dtype.name]}\ndimension: {dim}\nspace: right-anterior
         info = np.iinfo(dtype)
         oldmin = info.min*scl_slope+scl_inter
         oldmax = info.max*scl_slope+scl_inter
-        print(f'old min: {oldmin}')
-        print(f'old max: {oldmax}')
+        lines.append(f'old min: {oldmin}')
+        lines.append(f'old max: {oldmax}')
 
     # print description
     if img.header['descrip']:
-        print('# {}'.format(np.char.decode(img.header['descrip'])))
+        lines.append('# {}'.format(np.char.decode(img.header['descrip'])))
 
     if dim == 4:
-        print(f'space directions: {matrix_string(spc_dir.T)} none')
-        print('centerings: cell cell cell ???')
-        print('kinds: space space space list')
+        lines.append(f'space directions: {matrix_string(spc_dir.T)} none')
+        lines.append('centerings: cell cell cell ???')
+        lines.append('kinds: space space space list')
 
         if bval and bvec:
 
             mf = find_mf(spc_dir)
-            print(f'measurement frame: {matrix_string(mf)}')
+            lines.append(f'measurement frame: {matrix_string(mf)}')
 
-            bvecs = util.read_bvecs(bvec, normalize=True)
-            bvals = util.read_bvals(bval)
+            gradients = GradientTable.from_files(bval, bvec).normalized()
 
-            print('modality:=DWMRI')
+            lines.append('modality:=DWMRI')
 
-            b_max = max(bvals)
-            print(f'DWMRI_b-value:={b_max}')
-            for ind in range(len(bvals)):
-                scaled_bvec = util.bvec_scaling(bvals[ind], bvecs[ind], b_max)
-                print(f'DWMRI_gradient_{ind:04}:={scaled_bvec}')
+            b_max = gradients.bvals.max()
+            lines.append(f'DWMRI_b-value:={b_max}')
+            for ind, scaled_bvec in enumerate(gradients.scaled_bvecs(b_max)):
+                scaled_bvec = ('   ').join(str(x) for x in scaled_bvec)
+                lines.append(f'DWMRI_gradient_{ind:04}:={scaled_bvec}')
 
         else:
             warnings.warn('nifti image is 4D, but bval/bvec files are not provided, '
                           'assuming not a DWMRI')
 
     else:
-        print(f'space directions: {matrix_string(spc_dir.T)}')
-        print('centerings: cell cell cell')
-        print('kinds: space space space')
+        lines.append(f'space directions: {matrix_string(spc_dir.T)}')
+        lines.append('centerings: cell cell cell')
+        lines.append('kinds: space space space')
+
+    return '\n'.join(lines) + '\n'
+
+
+def nhdr_name(nifti):
+    """
+    The basename of the nhdr of a nifti: its basename with the .nii or .nii.gz
+    suffix replaced by .nhdr.
+    """
+    name = os.path.basename(str(nifti))
+    for suffix in ['.nii.gz', '.nii']:
+        if name.endswith(suffix):
+            return name[:-len(suffix)] + '.nhdr'
+    return os.path.splitext(name)[0] + '.nhdr'
+
 
-    f.close()
-    sys.stdout = console
+def nifti2nhdr(nifti, bval, bvec, nhdr, data_file=None):
+    """
+    Convert a nifti to nrrd by creating an nhdr header.  The header's 'data
+    file' is data_file, or by default the nifti's basename.
+    """
+
+    log.info(f'Converting {nifti}')
+
+    if not nhdr:
+        nhdr = os.path.join(os.path.dirname(os.path.abspath(nifti)), nhdr_name(nifti))
+    elif not nhdr.endswith('nhdr'):
+        raise AttributeError('Output file must be nhdr')
+    else:
+        nhdr = os.path.abspath(nhdr)
+
+    header = nhdr_string(nifti, bval, bvec, data_file=data_file)
+    with open(nhdr, 'w') as f:
+        f.write(header)
+    return nhdr
+
+
+def sidecars(nifti):
+    """
+    Returns the .bval and .bvec files next to a nifti, or (None, None) if
+    they don't both exist.
+    """
+    nifti = local.path(nifti)
+    depth = 2 if nifti.name.endswith('.nii.gz') else 1
+    bval, bvec = nifti.with_suffix('.bval', depth=depth), nifti.with_suffix('.bvec', depth=depth)
+    return (bval, bvec) if bval.exists() and bvec.exists() else (None, None)
+
+
+def _batch_convert(args):
+    nifti, nhdr = args
+    bval, bvec = sidecars(nifti)
+    data_file = nhdr and os.path.relpath(os.path.abspath(nifti), os.path.dirname(nhdr))
+    return nifti2nhdr(nifti, bval, bvec, nhdr, data_file=data_file)
+
+
+def nifti2nhdr_batch(niftis, output_dir=None, num_proc=None, processes=False):
+    """
+    Makes an nhdr header for each nifti (a list of files and glob patterns),
+    using their .bval/.bvec sidecars if they exist.  The headers are saved next
+    to the niftis, or in output_dir with relative 'data file' paths to them.
+
+    Files are converted concurrently on a pool of num_proc threads (default:
+    the available cpus), or of processes if processes=True.  Returns the
+    nhdr paths in the order of the expanded inputs.
+    """
+    paths = []
+    for pattern in niftis:
+        matches = sorted(glob.glob(str(pattern)))
+        if not matches:
+            raise Exception(f'No files found for: {pattern}')
+        paths.extend(matches)
+    jobs = [(path, None if output_dir is None else
+             str(local.path(output_dir) / nhdr_name(path)))
+            for path in paths]
+    if output_dir is not None:
+        local.path(output_dir).mkdir()
+        names = [nhdr for _, nhdr in jobs]
+        if len(set(names)) != len(names):
+            raise Exception('Input niftis in different directories have the same name')
+
+    num_proc = min(num_proc or util.available_cpus(), max(1, len(jobs)))
+    log.info(f'Converting {len(jobs)} niftis using {num_proc} '
+             f'{"processes" if processes else "threads"}')
+    pool_class = Pool if processes else ThreadPool
+    with pool_class(num_proc) as pool:
+        return pool.map(_batch_convert, jobs)
 
 
 @pytest.mark.parametrize("input_basename_nii", ["dwi_eddy.nii.gz", "dwi_mask.nii.gz"])
@@ -172,6 +248,56 @@ def test_nifti2nhdr(input_basename_nii):
         assert filecmp.cmp(output, expected_output)
 
 
+def test_nifti2nhdr_gradients():
+    with local.tempdir() as tmpdir:
+        nifti = tmpdir / 'dwi.nii.gz'
+        nib.Nifti1Image(np.zeros((2, 2, 2, 3), dtype=np.int16), np.identity(4)) \
+            .to_filename(str(nifti))
+        (tmpdir / 'dwi.bval').write('0 1000 250')
+        (tmpdir / 'dwi.bvec').write('0 2 0\n0 0 0\n0 0 1\n')
+        nifti2nhdr(nifti, tmpdir / 'dwi.bval', tmpdir / 'dwi.bvec', str(tmpdir / 'dwi.nhdr'))
+        lines = (tmpdir / 'dwi.nhdr').read().splitlines()
+    assert 'DWMRI_b-value:=1000.0' in lines
+    assert 'DWMRI_gradient_0000:=0.0   0.0   0.0' in lines
+    assert 'DWMRI_gradient_0001:=1.0   0.0   0.0' in lines
+    assert 'DWMRI_gradient_0002:=0.0   0.0   0.5' in lines
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_nifti2nhdr_batch(processes):
+    with local.tempdir() as tmpdir:
+        for name, shape in [('dwi', (2, 2, 2, 3)), ('mask', (2, 2, 2))]:
+            nib.Nifti1Image(np.zeros(shape, dtype=np.int16), np.identity(4)) \
+                .to_filename(str(tmpdir / f'{name}.nii.gz'))
+        (tmpdir / 'dwi.bval').write('0 1000 250')
+        (tmpdir / 'dwi.bvec').write('0 2 0\n0 0 0\n0 0 1\n')
+        expected = [nhdr_string(tmpdir / 'dwi.nii.gz', tmpdir / 'dwi.bval', tmpdir / 'dwi.bvec'),
+                    nhdr_string(tmpdir / 'mask.nii.gz')]
+        nhdrs = nifti2nhdr_batch([tmpdir / 'dwi.nii.gz', tmpdir / 'm*.nii.gz'],
+                                 num_proc=2, processes=processes)
+        assert nhdrs == [tmpdir / 'dwi.nhdr', tmpdir / 'mask.nhdr']
+        assert [local.path(nhdr).read() for nhdr in nhdrs] == expected
+        nhdrs = nifti2nhdr_batch([tmpdir / '*.nii.gz'], output_dir=tmpdir / 'nhdr',
+                                 processes=processes)
+        assert 'data file: ../dwi.nii.gz' in local.path(nhdrs[0]).read().splitlines()
+
+        # dots in the directory or before the suffix are kept
+        (tmpdir / 'sub.01').mkdir()
+        (tmpdir / 'dwi.nii.gz').copy(tmpdir / 'sub.01' / 'dwi.run.1.nii.gz')
+        nib.load(str(tmpdir / 'mask.nii.gz')).to_filename(str(tmpdir / 'sub.01' / 'mask.nii'))
+        nhdrs = nifti2nhdr_batch([tmpdir / 'sub.01' / '*.nii*'], processes=processes)
+        assert nhdrs == [tmpdir / 'sub.01' / 'dwi.run.1.nhdr', tmpdir / 'sub.01' / 'mask.nhdr']
+
+
+def test_nhdr_string_raw():
+    with local.tempdir() as tmpdir:
+        nib.Nifti1Image(np.zeros((2, 2, 2), dtype=np.int16), np.identity(4)) \
+            .to_filename(str(tmpdir / 'mask.nii'))
+        lines = nhdr_string(tmpdir / 'mask.nii').splitlines()
+    assert 'encoding: raw' in lines
+    assert 'byteskip: 352' in lines
+
+
 class Cli(cli.Application):
 
     input_nifti = cli.SwitchAttr(
@@ -201,3 +327,38 @@ class Cli(cli.Application):
                    bval=bval,
                    bvec=bvec,
                    nhdr=self.output_nhdr)
+
+
+class BatchCli(cli.Application):
+    """
+    Makes nhdr headers for many niftis concurrently.
+    """
+
+    output_dir = cli.SwitchAttr(
+        ['-o', '--output-dir'],
+        help='Directory to save the nhdr headers in (default: next to each nifti)')
+
+    num_proc = cli.SwitchAttr(
+        ['-n', '--nproc'],
+        argtype=int,
+        help='Number of files to convert at once (default: available cpus)')
+
+    processes = cli.Flag(
+        ['--processes'],
+        help='Use a process pool instead of a thread pool')
+
+    log_level = cli.SwitchAttr(
+        ['--log-level'],
+        argtype=cli.Set("CRITICAL", "ERROR", "WARNING",
+                        "INFO", "DEBUG", "NOTSET", case_sensitive=False),
+        default='INFO',
+        help='Python log level')
+
+    def main(self, *niftis):
+        if not niftis:
+            raise cli.SwitchError('Expected nifti files or glob patterns')
+        coloredlogs.install(level=self.log_level)
+        nifti2nhdr_batch(niftis,
+                         output_dir=self.output_dir,
+                         num_proc=self.num_proc,
+                         processes=self.processes)
@@ -1,10 +1,10 @@
 import logging
 
 from plumbum import local
-import pandas as pd
 import luigi.util
 from luigi import Parameter
 
+from dtipipe.gradients import GradientTable
 from .. import standard_pnl
 from ..BaseTask import BaseTask
 
@@ -44,7 +44,7 @@ class Dti(BaseTask):
 
     @staticmethod
     def make_gradient_matrix(bvec, bval, output):
-        bvals = local.path(bval).read().strip().split(' ')
-        df = pd.read_csv(bvec, sep=' ', header=None)
-        df['bval'] = bvals
-        df.to_csv(output, header=False, index=False)
+        gradients = GradientTable.from_files(bval, bvec)
+        with open(output, 'w') as f:
+            for (bvec, bval) in zip(gradients.bvecs, gradients.bvals):
+                f.write(','.join([str(x) for x in bvec] + [f'{bval:g}']) + '\n')
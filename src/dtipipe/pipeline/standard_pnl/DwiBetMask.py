@@ -1,5 +1,5 @@
 import luigi.util
-from luigi import OptionalParameter, FloatParameter
+from luigi import OptionalParameter, FloatParameter, ChoiceParameter
 from plumbum import local
 
 from ..BaseTask import BaseTask
@@ -13,17 +13,21 @@ from dtipipe import util
 class DwiBetMask(BaseTask):
 
     dwi_bet_mask_threshold = FloatParameter()
+    dwi_mask_backend = ChoiceParameter(choices=bet_mask.BACKENDS, default='bet')
     fsldir = OptionalParameter(default=None)
 
     def output(self):
         input_dwi = self.input()['nii.gz']
+        if self.dwi_mask_backend == 'otsu':
+            return local.path(str(input_dwi)[:-7] + '_otsumask.nii.gz')
         return local.path(str(input_dwi)[:-7] + f'_betmask-{self.dwi_bet_mask_threshold}.nii.gz')
 
     def run(self):
         bet_mask.bet_mask(input_file=self.input()['nii.gz'],
                           output_file=self.output(),
                           bet_threshold=self.dwi_bet_mask_threshold,
-                          fsldir=self.fsldir)
+                          fsldir=self.fsldir,
+                          backend=self.dwi_mask_backend)
 
     def qc(self):
         with util.fsl_env(self.fsldir):
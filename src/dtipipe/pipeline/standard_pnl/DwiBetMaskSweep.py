@@ -0,0 +1,35 @@
+import luigi.util
+from luigi import OptionalParameter, ListParameter, IntParameter
+from plumbum import local
+
+from ..BaseTask import BaseTask
+from .DwiEddy import DwiEddy
+
+from dtipipe import bet_mask
+
+
+@luigi.util.requires(DwiEddy)
+class DwiBetMaskSweep(BaseTask):
+    """
+    Makes a bet mask for each of dwi_bet_mask_thresholds, to help choose
+    dwi_bet_mask_threshold.  The masks are named like DwiBetMask's outputs and
+    their statistics are saved in a csv.
+    """
+
+    dwi_bet_mask_thresholds = ListParameter()
+    dwi_bet_mask_reference = OptionalParameter(default=None)
+    num_proc_bet = IntParameter(default=0, significant=False)  # 0: available cpus
+    fsldir = OptionalParameter(default=None)
+
+    def output(self):
+        input_dwi = self.input()['nii.gz']
+        return local.path(str(input_dwi)[:-7] + '_betmask-sweep.csv')
+
+    def run(self):
+        stats = bet_mask.bet_mask_sweep(input_file=self.input()['nii.gz'],
+                                        output_dir=self.output().parent,
+                                        bet_thresholds=list(self.dwi_bet_mask_thresholds),
+                                        reference=self.dwi_bet_mask_reference,
+                                        num_proc=self.num_proc_bet or None,
+                                        fsldir=self.fsldir)
+        stats.to_csv(self.output(), index=False)
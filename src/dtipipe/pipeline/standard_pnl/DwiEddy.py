@@ -1,5 +1,5 @@
 import luigi.util
-from luigi import OptionalParameter, IntParameter
+from luigi import OptionalParameter, Parameter, ChoiceParameter
 from plumbum import local
 
 from dtipipe import eddy_pnl
@@ -11,15 +11,25 @@ from .DwiNifti import DwiNifti
 class DwiEddy(BaseTask):
 
     fsldir = OptionalParameter(default=None)
-    num_proc_eddy = IntParameter(significant=False)
+    num_proc_eddy = Parameter(significant=False)  # int or 'auto'
+    eddy_work_dir = OptionalParameter(default=None, significant=False)
+    eddy_registration = ChoiceParameter(choices=eddy_pnl.REGISTRATION_BACKENDS, default='flirt')
 
     def output(self):
+        # outputs of the non default registration backend don't overwrite the default's
+        backend = '' if self.eddy_registration == 'flirt' else '_' + self.eddy_registration
         return {suffix: local.path(self.output_session_dir,
-                                   self.output_basename + '-ed.' + suffix) for
+                                   self.output_basename + '-ed' + backend + '.' + suffix) for
                 suffix in ['nii.gz', 'bval', 'bvec']}
 
     def run(self):
         eddy_pnl.eddy_pnl(dwi=self.input()['nii.gz'],
                           output=self.output()['nii.gz'],
                           num_proc=self.num_proc_eddy,
-                          fsldir=self.fsldir)
+                          fsldir=self.fsldir,
+                          work_dir=self.eddy_work_dir,
+                          registration=self.eddy_registration)
+
+    def read_motion(self):
+        xfms_npz = str(self.output()['nii.gz'])[:-7] + '-xfms.npz'
+        return eddy_pnl.motion_summary(xfms_npz)
@@ -1,4 +1,5 @@
 import luigi.util
+from luigi import IntParameter
 import pandas as pd
 
 from plumbum import local
@@ -11,12 +12,17 @@ from .TractQuerier import TractQuerier
 @luigi.util.requires(TractQuerier)
 class TractMeasures(BaseTask):
 
+    num_proc_measures = IntParameter(default=1, significant=False)
+    measures_chunk_size = IntParameter(default=0, significant=False)
+
     def output(self):
         return local.path(str(self.input()) + '.csv')
 
     def run(self):
         vtks = self.input() // '*.vtk'
-        measureTractsFunctions.printToCSV([str(vtk) for vtk in vtks], self.output().__str__())
+        measureTractsFunctions.printToCSV([str(vtk) for vtk in vtks], self.output().__str__(),
+                                          num_proc=self.num_proc_measures,
+                                          chunk_size=self.measures_chunk_size or None)
 
     def read(self):
         df = pd.read_csv(str(self.output()))
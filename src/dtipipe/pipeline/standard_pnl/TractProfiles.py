@@ -0,0 +1,24 @@
+import luigi.util
+from luigi import IntParameter
+
+from plumbum import local
+
+from dtipipe import tract_profiles
+from ..BaseTask import BaseTask
+from .TractQuerier import TractQuerier
+
+
+@luigi.util.requires(TractQuerier)
+class TractProfiles(BaseTask):
+
+    tract_profile_positions = IntParameter(default=tract_profiles.DEFAULT_NUM_POSITIONS)
+    num_proc_measures = IntParameter(default=1, significant=False)
+
+    def output(self):
+        return local.path(str(self.input()) + '-profiles.csv')
+
+    def run(self):
+        vtks = self.input() // '*.vtk'
+        tract_profiles.tract_profiles(vtks, self.output(),
+                                      num_positions=self.tract_profile_positions,
+                                      num_proc=self.num_proc_measures)
@@ -1,5 +1,5 @@
 import luigi.util
-from luigi import Parameter, DictParameter
+from luigi import Parameter, DictParameter, BoolParameter, IntParameter
 from plumbum import local
 
 from dtipipe import ukf
@@ -14,18 +14,22 @@ class Ukf(BaseTask):
 
     ukf_tractography_bin = Parameter()
     ukf_params = DictParameter()
+    ukf_raw_inputs = BoolParameter(default=False, significant=False)
+    ukf_num_partitions = IntParameter(default=1, significant=False)
 
     def requires(self):
         return dict(dwi_eddy=self.clone(DwiEddy),
                     dwi_mask=self.clone(DwiBetMask))
 
     def output(self):
-        output_basename = self.input()['dwi_eddy']['nii.gz'].stem
-        return local.path(self.output_session_dir) / f'{output_basename}.vtk'
+        return local.path(self.output_session_dir) / ukf.ukf_output_name(
+            self.input()['dwi_eddy']['nii.gz'], dict(self.ukf_params))
 
     def run(self):
         ukf.ukf(dwi_file=self.input()['dwi_eddy']['nii.gz'],
                 dwi_mask_file=self.input()['dwi_mask'],
                 output_vtk=self.output(),
                 ukf_tractography_bin=self.ukf_tractography_bin,
-                **self.ukf_params)
+                raw=self.ukf_raw_inputs,
+                num_partitions=self.ukf_num_partitions,
+                ukf_params=dict(self.ukf_params))
@@ -32,7 +32,7 @@ class WmparcInDwi(BaseTask):
     freesurfer_home = OptionalParameter(default=None)
 
     # Control
-    num_proc_eddy = IntParameter(significant=False)
+    num_proc_eddy = Parameter(significant=False)  # int or 'auto'
     num_proc_ants = IntParameter(significant=False)
 
     def requires(self):
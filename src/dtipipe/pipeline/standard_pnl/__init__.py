@@ -3,10 +3,12 @@ from .DicomDir import DicomDir
 from .DwiNifti import DwiNifti
 from .DwiEddy import DwiEddy
 from .DwiBetMask import DwiBetMask
+from .DwiBetMaskSweep import DwiBetMaskSweep
 from .WmparcInDwi import WmparcInDwi
 from .Ukf import Ukf
 from .TractQuerier import TractQuerier
 from .TractMeasures import TractMeasures
+from .TractProfiles import TractProfiles
 
 from .CaminoDti import CaminoDti
 
@@ -0,0 +1,636 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from plumbum import local
+
+
+log = logging.getLogger(__name__)
+
+VERSION = '5.1'
+
+# Legacy VTK files store binary data big endian
+VTK_TYPES = {'float': '>f4',
+             'double': '>f8',
+             'char': '>i1',
+             'unsigned_char': '>u1',
+             'short': '>i2',
+             'unsigned_short': '>u2',
+             'int': '>i4',
+             'unsigned_int': '>u4',
+             'long': '>i8',
+             'unsigned_long': '>u8',
+             'vtkIdType': '>i4',
+             'vtktypeint8': '>i1',
+             'vtktypeuint8': '>u1',
+             'vtktypeint16': '>i2',
+             'vtktypeuint16': '>u2',
+             'vtktypeint32': '>i4',
+             'vtktypeuint32': '>u4',
+             'vtktypeint64': '>i8',
+             'vtktypeuint64': '>u8'}
+
+# The type names VTK's writer uses for arrays made from numpy arrays
+NUMPY_TO_VTK_TYPE = {'float32': 'float',
+                     'float64': 'double',
+                     'int8': 'char',
+                     'uint8': 'unsigned_char',
+                     'int16': 'short',
+                     'uint16': 'unsigned_short',
+                     'int32': 'int',
+                     'uint32': 'unsigned_int',
+                     'int64': 'long',
+                     'uint64': 'unsigned_long'}
+
+CELL_TYPES = ['VERTICES', 'LINES', 'POLYGONS', 'TRIANGLE_STRIPS']
+LEGACY_CELL_TYPES = {'VERTS': 'VERTICES', 'POLYS': 'POLYGONS', 'TRIANGLE_STRIPS': 'TRIANGLE_STRIPS',
+                     'LINES': 'LINES'}
+
+# Number of components of the attribute arrays that don't give it in their header
+ATTRIBUTE_COMPONENTS = {'VECTORS': 3, 'NORMALS': 3, 'TENSORS': 9, 'TENSORS6': 6,
+                        'GLOBAL_IDS': 1, 'PEDIGREE_IDS': 1}
+
+
+class DataArray(object):
+    """
+    A named point, cell or field data array of a VTK file.  kind is 'FIELD'
+    for a field data array, or the attribute it is (e.g. 'SCALARS',
+    'TENSORS').  values has one row per tuple, or is 1D for single component
+    arrays (like vtk_to_numpy).
+
+    metadata is the raw text VTK writes after an array's data (e.g. its
+    component names), kept so that files can be written back unchanged.
+    """
+
+    def __init__(self, name, values, kind='FIELD', vtk_type=None, metadata=b''):
+        self.name = name
+        self.values = values
+        self.kind = kind
+        self.vtk_type = vtk_type or NUMPY_TO_VTK_TYPE[np.dtype(values.dtype).name]
+        self.metadata = metadata
+
+    @property
+    def num_components(self):
+        return 1 if self.values.ndim == 1 else self.values.shape[1]
+
+    def __repr__(self):
+        return f'DataArray({self.name!r}, kind={self.kind!r}, shape={self.values.shape})'
+
+
+class PolyData(object):
+    """
+    The points (Nx3), cells and data arrays of a legacy VTK polydata file, as
+    numpy arrays.
+
+    cells maps each cell type (e.g. 'LINES') to its (offsets, connectivity)
+    arrays: cell i is connectivity[offsets[i]:offsets[i + 1]].  point_data,
+    cell_data and field_data are lists of DataArray's, in file order.
+    """
+
+    def __init__(self, points, cells=None, point_data=None, cell_data=None, field_data=None,
+                 title='vtk output'):
+        self.points = points
+        self.cells = OrderedDict(cells or {})
+        self.point_data = list(point_data or [])
+        self.cell_data = list(cell_data or [])
+        self.field_data = list(field_data or [])
+        self.title = title
+
+    @property
+    def lines(self):
+        return self.cells.get('LINES', (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)))
+
+    @property
+    def num_lines(self):
+        return len(self.lines[0]) - 1
+
+    def line_points(self, i):
+        offsets, connectivity = self.lines
+        return self.points[connectivity[offsets[i]:offsets[i + 1]]]
+
+    def line_lengths(self):
+        """
+        Returns the length of each line (the sum of its segment lengths).
+        """
+        offsets, connectivity = self.lines
+        offsets = np.asarray(offsets, dtype=np.int64)
+        connectivity = np.asarray(connectivity, dtype=np.int64)
+        # the file's (big endian) points are converted once, in line order, to
+        # their own precision; the lengths are summed in double precision
+        dtype = np.float32 if np.dtype(self.points.dtype).itemsize <= 4 else np.float64
+        if np.array_equal(connectivity, np.arange(len(self.points))):
+            points = np.asarray(self.points, dtype=dtype)
+        else:
+            points = np.asarray(self.points)[connectivity].astype(dtype)
+        lengths = np.zeros(len(offsets) - 1)
+        if len(connectivity) < 2:
+            return lengths
+        steps = np.subtract(points[1:], points[:-1])
+        np.multiply(steps, steps, out=steps)
+        segments = steps[:, 0] + steps[:, 1]
+        segments += steps[:, 2]
+        np.sqrt(segments, out=segments)
+        # segments[i] ends at point i + 1, and the first point of each line
+        # doesn't continue the line before it
+        segments = np.concatenate([[0], segments]).astype(np.float64)
+        starts = offsets[:-1]
+        nonempty = starts < offsets[1:]
+        segments[starts[nonempty]] = 0
+        lengths[nonempty] = np.add.reduceat(segments, starts[nonempty])
+        return lengths
+
+    def select_lines(self, keep):
+        """
+        Returns a PolyData with only the lines where the boolean array keep is
+        True, and only their points and point data.  Other cell types and
+        cell data aren't supported.
+        """
+        if set(self.cells) - {'LINES'}:
+            raise Exception(f'select_lines only supports lines, got {list(self.cells)}')
+        keep = np.asarray(keep, dtype=bool)
+        offsets, connectivity = self.lines
+        counts = np.diff(offsets)
+        point_ids = connectivity[np.repeat(keep, counts)]
+        keep_points = np.zeros(len(self.points), dtype=bool)
+        keep_points[point_ids] = True
+        new_ids = np.cumsum(keep_points) - 1
+        cells = OrderedDict(LINES=(np.concatenate([[0], np.cumsum(counts[keep])]).astype(np.int64),
+                                   new_ids[point_ids].astype(np.int64)))
+        point_data = [DataArray(array.name, array.values[keep_points], array.kind, array.vtk_type,
+                                array.metadata)
+                      for array in self.point_data]
+        cell_data = [DataArray(array.name, array.values[keep], array.kind, array.vtk_type,
+                               array.metadata)
+                     for array in self.cell_data]
+        return PolyData(self.points[keep_points], cells, point_data, cell_data, self.field_data,
+                        title=self.title)
+
+    def point_array(self, name):
+        """
+        Returns the values of the named point data array.  As with VTK's
+        reader, if more than one array has the name, the last one is returned.
+        """
+        matches = [array for array in self.point_data if array.name == name]
+        if not matches:
+            raise KeyError(f'No point data array named {name}')
+        return matches[-1].values
+
+    def point_array_names(self):
+        return list(OrderedDict.fromkeys(array.name for array in self.point_data))
+
+
+class _Reader(object):
+
+    def __init__(self, filename, arrays, mmap, cells=True):
+        self.filename = str(filename)
+        self.arrays = None if arrays is None else set(arrays)
+        self.mmap = mmap
+        self.load_cells = cells
+        self.point_array_headers = []
+        self.section = None
+        self.f = open(self.filename, 'rb')
+
+    def close(self):
+        self.f.close()
+
+    def line(self):
+        """
+        Returns the next non-blank line, or None at the end of the file.
+        """
+        while True:
+            line = self.f.readline()
+            if not line:
+                return None
+            if line.strip():
+                return line.decode('ascii').strip()
+
+    def data(self, vtk_type, shape, load=True):
+        """
+        Maps (or reads) the binary data that starts at the current position,
+        and moves past it and its line ending.
+        """
+        if vtk_type not in VTK_TYPES:
+            raise Exception(f'{self.filename}: unsupported data type {vtk_type}')
+        dtype = np.dtype(VTK_TYPES[vtk_type])
+        count = int(np.prod(shape))
+        offset = self.f.tell()
+        self.f.seek(offset + count * dtype.itemsize)
+        if self.f.read(1) not in (b'\n', b''):
+            raise Exception(f'{self.filename}: expected a line ending after the data at '
+                            f'byte {offset}')
+        if not load:
+            return None
+        if count == 0:
+            return np.zeros(shape, dtype=dtype)
+        if self.mmap:
+            return np.memmap(self.filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            return np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+    def metadata(self):
+        """
+        Returns the raw METADATA block (and blank lines) after an array.
+        """
+        start = self.f.tell()
+        line = self.f.readline()
+        if line.strip() == b'METADATA':
+            while self.f.readline().strip():
+                pass
+        else:
+            self.f.seek(start)
+        while True:
+            position = self.f.tell()
+            line = self.f.readline()
+            if not line or line.strip():
+                self.f.seek(position)
+                break
+        self.f.seek(start)
+        return self.f.read(position - start)
+
+    def wanted(self, name):
+        return self.arrays is None or name in self.arrays
+
+    def array(self, kind, name, vtk_type, num_tuples, num_components):
+        load = self.wanted(name)
+        if self.section == 'POINT_DATA':
+            self.point_array_headers.append((kind, name))
+        shape = (num_tuples,) if num_components == 1 else (num_tuples, num_components)
+        values = self.data(vtk_type, shape, load=load)
+        metadata = self.metadata()
+        return DataArray(name, values, kind, vtk_type, metadata) if load else None
+
+    def field(self, num_arrays):
+        arrays = []
+        for _ in range(num_arrays):
+            words = self.line().split()
+            if words[0] == 'NULL_ARRAY':
+                continue
+            name, num_components, num_tuples, vtk_type = words
+            arrays.append(self.array('FIELD', name, vtk_type, int(num_tuples),
+                                     int(num_components)))
+        return [array for array in arrays if array is not None]
+
+    def attribute(self, words, num_tuples):
+        kind, name = words[0], words[1]
+        if kind == 'SCALARS':
+            vtk_type = words[2]
+            num_components = int(words[3]) if len(words) > 3 else 1
+            lookup_table = self.line().split()
+            if lookup_table[:2] != ['LOOKUP_TABLE', 'default']:
+                raise Exception(f'{self.filename}: unsupported scalars lookup table '
+                                f'{" ".join(lookup_table)}')
+        elif kind == 'TEXTURE_COORDINATES':
+            num_components, vtk_type = int(words[2]), words[3]
+        elif kind in ATTRIBUTE_COMPONENTS:
+            num_components, vtk_type = ATTRIBUTE_COMPONENTS[kind], words[2]
+        else:
+            raise Exception(f'{self.filename}: unsupported data attribute {kind}')
+        return self.array(kind, name, vtk_type, num_tuples, num_components)
+
+    def cells(self, words, version):
+        load = self.load_cells
+        if version >= 5:
+            num_offsets = int(words[1])
+            offsets_type = self.line().split()
+            offsets = self.data(offsets_type[1], (num_offsets,), load)
+            connectivity_type = self.line().split()
+            connectivity = self.data(connectivity_type[1], (int(words[2]),), load)
+            return offsets, connectivity
+        # before version 5, cells are stored as [n, id_1, ..., id_n, ...] 32 bit ints
+        legacy = self.data('int', (int(words[2]),), load)
+        return decode_legacy_cells(legacy, int(words[1])) if load else (None, None)
+
+    def read(self, num_lines_only=False):
+        header = self.f.readline().decode('ascii').strip()
+        if not header.startswith('# vtk DataFile Version'):
+            raise Exception(f'{self.filename} is not a legacy VTK file')
+        version = float(header.split()[-1])
+        title = self.f.readline().decode('ascii').rstrip('\n')
+        if self.line() != 'BINARY':
+            raise Exception(f'{self.filename}: only binary VTK files are supported')
+        if self.line() != 'DATASET POLYDATA':
+            raise Exception(f'{self.filename}: expected POLYDATA')
+
+        polydata = PolyData(None, title=title)
+        data = polydata.field_data
+        num_tuples = None
+        while True:
+            line = self.line()
+            if line is None:
+                break
+            words = line.split()
+            keyword = words[0]
+            if keyword == 'FIELD':
+                data.extend(self.field(int(words[2])))
+            elif keyword == 'POINTS':
+                polydata.points = self.data(words[2], (int(words[1]), 3))
+            elif keyword in LEGACY_CELL_TYPES or keyword in CELL_TYPES:
+                cell_type = LEGACY_CELL_TYPES.get(keyword, keyword)
+                if num_lines_only and cell_type == 'LINES':
+                    return int(words[1]) - (1 if version >= 5 else 0)
+                cells = self.cells(words, version)
+                if self.load_cells:
+                    polydata.cells[cell_type] = cells
+            elif keyword in ('POINT_DATA', 'CELL_DATA'):
+                if num_lines_only:
+                    break
+                self.section = keyword
+                num_tuples = int(words[1])
+                data = polydata.point_data if keyword == 'POINT_DATA' else polydata.cell_data
+            elif num_tuples is not None:
+                array = self.attribute(words, num_tuples)
+                if array is not None:
+                    data.append(array)
+            else:
+                raise Exception(f'{self.filename}: unexpected {line}')
+        if num_lines_only:
+            return 0
+        if polydata.points is None:
+            polydata.points = np.zeros((0, 3), dtype=np.float32)
+        return polydata
+
+
+def _are_cell_starts(legacy, starts, num_cells):
+    """
+    Whether starts are the positions of the counts of num_cells legacy cells:
+    the first is at 0, and each cell ends where the next one starts.
+    """
+    ends = starts + legacy[starts].astype(np.int64) + 1
+    return (len(starts) == num_cells and starts[0] == 0 and
+            np.array_equal(starts[1:], ends[:-1]) and ends[-1] == len(legacy))
+
+
+def decode_legacy_cells(legacy, num_cells):
+    """
+    Returns the offsets and connectivity of num_cells cells stored in the
+    pre-5.1 layout [n, id_1, ..., id_n, n, ...].
+    """
+    legacy = np.asarray(legacy)
+    legacy = legacy.astype(legacy.dtype.newbyteorder('='), copy=False)
+    size = len(legacy)
+    starts = None
+    if num_cells and size % num_cells == 0:
+        # cells of equal length have their counts at a fixed stride
+        starts = np.arange(num_cells) * (size // num_cells)
+        if not np.all(legacy[starts] == size // num_cells - 1):
+            starts = None
+    if starts is None and num_cells and size > 2:
+        # Files written by VTK and UKF number the points of the lines in order,
+        # so the ids run on by one across each count: guess the counts there
+        runs_on = np.zeros(size, dtype=bool)
+        runs_on[1:-1] = np.subtract(legacy[2:], legacy[:-2]) == 1
+        runs_on[0] = True
+        starts = np.flatnonzero(runs_on)
+    if starts is not None and not _are_cell_starts(legacy, starts, num_cells):
+        starts = None
+    if starts is None:
+        # the counts can only be found one after another
+        starts = np.zeros(num_cells, dtype=np.int64)
+        start = 0
+        for i in range(num_cells):
+            starts[i] = start
+            start += int(legacy[start]) + 1
+    offsets = np.concatenate([[0], np.cumsum(legacy[starts] if num_cells else [])]).astype(np.int64)
+    is_id = np.ones(size, dtype=bool)
+    is_id[starts] = False
+    return offsets, legacy[is_id].astype(np.int64)
+
+
+def read_polydata(filename, arrays=None, mmap=True, cells=True):
+    """
+    Reads a binary legacy VTK polydata file (e.g. written by UKFTractography,
+    tract_querier or activate_tensors) without going through VTK.
+
+    The points, cells and data arrays are memory mapped (read only), or read
+    if mmap is False.  If arrays is given, only the point, cell and field data
+    arrays with those names are kept.  If cells is False, the cells are
+    skipped (so legacy cells aren't decoded).
+    """
+    reader = _Reader(filename, arrays, mmap, cells)
+    try:
+        return reader.read()
+    finally:
+        reader.close()
+
+
+def read_point_array_headers(filename):
+    """
+    Returns the (kind, name) of each point data array of a VTK polydata
+    file, in order, reading only its headers.
+    """
+    reader = _Reader(filename, [], False, cells=False)
+    try:
+        reader.read()
+        return reader.point_array_headers
+    finally:
+        reader.close()
+
+
+def read_num_lines(filename):
+    """
+    Returns the number of lines (e.g. fibers) in a VTK polydata file, reading
+    only its headers.
+    """
+    reader = _Reader(filename, [], False)
+    try:
+        return reader.read(num_lines_only=True)
+    finally:
+        reader.close()
+
+
+def _big_endian(values, vtk_type):
+    return np.ascontiguousarray(values, dtype=VTK_TYPES[vtk_type]).tobytes()
+
+
+def _write_array(f, array, num_tuples):
+    if array.values.shape[0] != num_tuples:
+        raise Exception(f'Array {array.name} has {array.values.shape[0]} tuples, '
+                        f'expected {num_tuples}')
+    if array.kind == 'FIELD':
+        header = f'{array.name} {array.num_components} {num_tuples} {array.vtk_type}\n'
+    elif array.kind == 'SCALARS':
+        num_components = '' if array.num_components == 1 else array.num_components
+        header = (f'SCALARS {array.name} {array.vtk_type} {num_components}\n'
+                  'LOOKUP_TABLE default\n')
+    elif array.kind == 'TEXTURE_COORDINATES':
+        header = f'TEXTURE_COORDINATES {array.name} {array.num_components} {array.vtk_type}\n'
+    else:
+        header = f'{array.kind} {array.name} {array.vtk_type}\n'
+    f.write(header.encode('ascii'))
+    f.write(_big_endian(array.values, array.vtk_type))
+    f.write(b'\n')
+    f.write(array.metadata)
+
+
+def _write_data(f, arrays, num_tuples):
+    """
+    Writes arrays in order, grouping consecutive field arrays in FIELD
+    blocks.
+    """
+    i = 0
+    while i < len(arrays):
+        if arrays[i].kind != 'FIELD':
+            _write_array(f, arrays[i], num_tuples)
+            i += 1
+            continue
+        field = []
+        while i < len(arrays) and arrays[i].kind == 'FIELD':
+            field.append(arrays[i])
+            i += 1
+        f.write(f'FIELD FieldData {len(field)}\n'.encode('ascii'))
+        for array in field:
+            _write_array(f, array, array.values.shape[0] if num_tuples is None else num_tuples)
+
+
+def write_polydata(filename, polydata):
+    """
+    Writes a PolyData as a binary legacy VTK file, laid out as VTK 9's
+    vtkPolyDataWriter does, so files read with read_polydata are written
+    back unchanged.
+    """
+    points_type = NUMPY_TO_VTK_TYPE[np.dtype(polydata.points.dtype).name]
+    with open(str(filename), 'wb') as f:
+        f.write(f'# vtk DataFile Version {VERSION}\n{polydata.title}\nBINARY\n'
+                'DATASET POLYDATA\n'.encode('ascii'))
+        if polydata.field_data:
+            _write_data(f, polydata.field_data, None)
+        f.write(f'POINTS {len(polydata.points)} {points_type}\n'.encode('ascii'))
+        f.write(_big_endian(polydata.points, points_type))
+        f.write(b'\n')
+        for cell_type in CELL_TYPES:
+            if cell_type not in polydata.cells:
+                continue
+            offsets, connectivity = polydata.cells[cell_type]
+            f.write(f'{cell_type} {len(offsets)} {len(connectivity)}\n'.encode('ascii'))
+            for (name, values) in [('OFFSETS', offsets), ('CONNECTIVITY', connectivity)]:
+                f.write(f'{name} vtktypeint64\n'.encode('ascii'))
+                f.write(_big_endian(values, 'vtktypeint64'))
+                f.write(b'\n')
+        if polydata.cell_data:
+            num_cells = sum(len(offsets) - 1 for (offsets, _) in polydata.cells.values())
+            f.write(f'CELL_DATA {num_cells}\n'.encode('ascii'))
+            _write_data(f, polydata.cell_data, num_cells)
+        if polydata.point_data:
+            f.write(f'POINT_DATA {len(polydata.points)}\n'.encode('ascii'))
+            _write_data(f, polydata.point_data, len(polydata.points))
+
+
+def _vtk_test_polydata():
+    import vtk
+    from vtk.util.numpy_support import numpy_to_vtk
+
+    def named(values, name):
+        array = numpy_to_vtk(values, deep=True)
+        array.SetName(name)
+        return array
+
+    rng = np.random.RandomState(0)
+    points = vtk.vtkPoints()
+    points.SetData(numpy_to_vtk(rng.rand(9, 3).astype(np.float32), deep=True))
+    lines = vtk.vtkCellArray()
+    for line in [[0, 1, 2], [3, 4, 5, 6], [7, 8]]:
+        lines.InsertNextCell(len(line))
+        for i in line:
+            lines.InsertCellPoint(i)
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetLines(lines)
+    point_data = polydata.GetPointData()
+    tensors = rng.rand(9, 9).astype(np.float32)
+    tensors[2, 3] = np.nan
+    point_data.AddArray(named(tensors, 'tensor1'))
+    point_data.AddArray(named(rng.rand(9, 9).astype(np.float32), 'tensor2'))
+    point_data.AddArray(named(rng.rand(9).astype(np.float32), 'FreeWater'))
+    point_data.SetScalars(named(rng.rand(9, 2), 'FA'))
+    ids = named(np.arange(18, dtype=np.int32).reshape(9, 2), 'ids')
+    ids.SetComponentName(0, 'first')
+    point_data.AddArray(ids)
+    polydata.GetCellData().AddArray(named(np.arange(3, dtype=np.int64), 'line_ids'))
+    polydata.GetFieldData().AddArray(named(np.ones(2, dtype=np.float64), 'info'))
+    return polydata, tensors
+
+
+def test_polydata_round_trip():
+    import vtk
+    from . import activate_tensors
+
+    vtk_polydata, tensors = _vtk_test_polydata()
+    with local.tempdir() as tmpdir:
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileTypeToBinary()
+        writer.SetFileName(str(tmpdir / 'vtk.vtk'))
+        writer.SetInputData(vtk_polydata)
+        writer.Write()
+        activate_tensors.activate_tensors(tmpdir / 'vtk.vtk', tmpdir / 'activated.vtk')
+        for name in ['vtk.vtk', 'activated.vtk']:
+            write_polydata(tmpdir / f'numpy_{name}', read_polydata(tmpdir / name))
+            assert (tmpdir / f'numpy_{name}').read_bytes() == (tmpdir / name).read_bytes()
+
+        polydata = read_polydata(tmpdir / 'activated.vtk')
+        assert polydata.num_lines == 3
+        assert read_num_lines(tmpdir / 'activated.vtk') == 3
+        assert np.array_equal(polydata.line_points(1),
+                              np.asarray(vtk_polydata.GetPoints().GetData())[3:7])
+        assert [(array.kind, array.name) for array in polydata.point_data] == \
+            [('SCALARS', 'FA'), ('TENSORS', 'tensor1'), ('FIELD', 'tensor1'),
+             ('FIELD', 'tensor2'), ('FIELD', 'FreeWater'), ('FIELD', 'ids')]
+        assert np.array_equal(polydata.point_data[1].values, np.nan_to_num(tensors))
+        assert np.array_equal(polydata.point_array('tensor1'), tensors, equal_nan=True)
+        assert polydata.point_array('FreeWater').shape == (9,)
+        assert polydata.cell_data[0].values.tolist() == [0, 1, 2]
+
+        polydata = read_polydata(tmpdir / 'activated.vtk', arrays=['tensor2'], mmap=False)
+        assert polydata.point_array_names() == ['tensor2']
+        assert not isinstance(polydata.points, np.memmap)
+        assert read_polydata(tmpdir / 'activated.vtk', cells=False).num_lines == 0
+        assert read_point_array_headers(tmpdir / 'activated.vtk')[:2] == \
+            [('SCALARS', 'FA'), ('TENSORS', 'tensor1')]
+
+
+def test_select_lines():
+    points = np.array([[0, 0, 0], [1, 0, 0], [5, 5, 5], [5, 5, 6], [5, 5, 8], [9, 9, 9]],
+                      dtype=np.float32)
+    lines = (np.array([0, 2, 5, 6]), np.array([1, 0, 2, 3, 4, 5]))
+    fa = DataArray('FA', np.arange(6, dtype=np.float32))
+    polydata = PolyData(points, {'LINES': lines}, [fa], [DataArray('id', np.arange(3))])
+    assert polydata.line_lengths().tolist() == [1, 3, 0]
+    selected = polydata.select_lines(polydata.line_lengths() > 0.5)
+    assert selected.lines[0].tolist() == [0, 2, 5]
+    assert selected.lines[1].tolist() == [1, 0, 2, 3, 4]
+    assert selected.point_array('FA').tolist() == [0, 1, 2, 3, 4]
+    assert selected.cell_data[0].values.tolist() == [0, 1]
+    assert np.allclose(selected.line_lengths(), [1, 3])
+
+
+def test_polydata_legacy_version():
+    import vtk
+
+    vtk_polydata, tensors = _vtk_test_polydata()
+    with local.tempdir() as tmpdir:
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileTypeToBinary()
+        writer.SetFileName(str(tmpdir / 'vtk.vtk'))
+        writer.SetFileVersion(42)
+        writer.SetInputData(vtk_polydata)
+        writer.Write()
+        polydata = read_polydata(tmpdir / 'vtk.vtk')
+        assert read_num_lines(tmpdir / 'vtk.vtk') == 3
+    offsets, connectivity = polydata.lines
+    assert offsets.tolist() == [0, 3, 7, 9]
+    assert connectivity.tolist() == list(range(9))
+    assert np.array_equal(polydata.point_array('tensor1'), tensors, equal_nan=True)
+
+
+def test_decode_legacy_cells():
+    # equal length, numbered in order, numbered out of order, and with an empty cell
+    for lines in [[[0, 1], [2, 3], [4, 5]],
+                  [[0, 1, 2], [3], [4, 5, 6, 7], [8, 9]],
+                  [[3, 4, 5], [0], [9, 1, 2], [6, 7, 8]],
+                  [[0, 1], [], [2, 3, 4]]]:
+        legacy = np.concatenate([[len(line)] + line for line in lines])
+        offsets, connectivity = decode_legacy_cells(legacy.astype('>i4'), len(lines))
+        assert offsets.tolist() == [0] + np.cumsum([len(line) for line in lines]).tolist()
+        assert connectivity.tolist() == sum(lines, [])
+    offsets, connectivity = decode_legacy_cells(np.zeros(0, dtype='>i4'), 0)
+    assert offsets.tolist() == [0] and connectivity.tolist() == []
@@ -0,0 +1,230 @@
+import os
+import logging
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from plumbum import local
+
+from . import polydata
+from . import util
+from .measuretracts.measureTractsFunctions import computeMeasures
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_NUM_POSITIONS = 100
+PROFILE_MEASURES = ['FA', 'MD', 'axial', 'radial']
+
+
+def point_measures(tensors):
+    """
+    FA, MD, axial and radial diffusivity at each point of an (N,9) tensor
+    array.  Like getData's, the diffusivities are scaled by 1000.  Points
+    whose tensors are not finite get NaN measures.
+    """
+    finite = np.isfinite(tensors).all(axis=1)
+    measures = computeMeasures(tensors[finite])
+    values = {'FA': measures['FA'],
+              'MD': 1000 * measures['trace'] / 3,
+              'axial': measures['axial'],
+              'radial': measures['radial']}
+    result = {}
+    for (name, value) in values.items():
+        result[name] = np.full(len(tensors), np.nan)
+        result[name][finite] = value
+    return result
+
+
+def drop_points(offsets, connectivity, keep):
+    """
+    Removes the points where keep is False from lines (given by their
+    offsets and connectivity), returning the new offsets and connectivity.
+    """
+    counts = np.diff(offsets)
+    line_ids = np.repeat(np.arange(len(counts)), counts)
+    kept = np.asarray(keep)[connectivity]
+    new_offsets = np.zeros_like(offsets)
+    new_offsets[1:] = np.cumsum(np.bincount(line_ids[kept], minlength=len(counts)))
+    return new_offsets, connectivity[kept]
+
+
+def orient_lines(points, offsets, connectivity):
+    """
+    Returns a boolean array that is True for the lines to reverse so that all
+    lines run the same way: along the principal direction of their
+    end-to-end vectors, signed so that its largest component is positive.
+    """
+    starts, ends = offsets[:-1], offsets[1:] - 1
+    nonempty = ends >= starts
+    spans = np.zeros((len(starts), 3))
+    spans[nonempty] = (points[connectivity[ends[nonempty]]] -
+                       points[connectivity[starts[nonempty]]])
+    direction = np.linalg.eigh(spans.T @ spans)[1][:, -1]
+    direction *= np.sign(direction[np.argmax(np.abs(direction))])
+    return spans @ direction < 0
+
+
+def resample_lines(points, offsets, connectivity, values, num_positions=DEFAULT_NUM_POSITIONS,
+                   reverse=None):
+    """
+    Linearly interpolates per point values at num_positions equidistant (by
+    arc length) positions along each line, from its first point to its last
+    (or the other way for lines where reverse is True).
+
+    values is a dict of per point arrays.  Returns the indices of the lines
+    that could be resampled (those with a non-zero length) and a dict of
+    (lines, num_positions) arrays.
+    """
+    points = np.asarray(points, dtype=np.float64)[connectivity]
+    counts = np.diff(offsets)
+    line_ids = np.repeat(np.arange(len(counts)), counts)
+    segments = np.zeros(len(connectivity))
+    segments[1:] = np.linalg.norm(points[1:] - points[:-1], axis=1)
+    segments[offsets[:-1][counts > 0]] = 0
+    arc_length = np.cumsum(segments)
+    arc_length -= arc_length[offsets[:-1][counts > 0]].repeat(counts[counts > 0])
+    lengths = np.zeros(len(counts))
+    lengths[counts > 0] = arc_length[offsets[1:][counts > 0] - 1]
+    valid = np.flatnonzero(lengths > 0)
+
+    # Each point's key is its line's index * 2 plus its fraction of the
+    # line's length, so that the keys of all lines increase together and one
+    # searchsorted finds the segment of every position of every line
+    keys = line_ids * 2 + arc_length / np.where(lengths > 0, lengths, 1)[line_ids]
+    fractions = np.linspace(0, 1, num_positions)
+    targets = np.tile(fractions, (len(valid), 1))
+    if reverse is not None:
+        targets[reverse[valid]] = fractions[::-1]
+    targets += 2 * valid[:, np.newaxis]
+    left = np.searchsorted(keys, targets, side='right') - 1
+    left = np.clip(left, offsets[valid, np.newaxis], offsets[valid + 1, np.newaxis] - 2)
+    span = keys[left + 1] - keys[left]
+    weights = np.clip((targets - keys[left]) / np.where(span > 0, span, 1), 0, 1)
+    resampled = {name: (1 - weights) * np.asarray(value)[connectivity][left] +
+                 weights * np.asarray(value)[connectivity][left + 1]
+                 for (name, value) in values.items()}
+    return valid, resampled
+
+
+def _tensor_array(tracts, tensor_name):
+    if tensor_name is None:
+        attributes = [array for array in tracts.point_data if array.kind == 'TENSORS']
+        if attributes:
+            return attributes[-1].values
+        tensor_name = 'tensor1'
+    return tracts.point_array(tensor_name)
+
+
+def tract_profile(vtk_file, num_positions=DEFAULT_NUM_POSITIONS, tensor_name=None):
+    """
+    Returns a DataFrame with the mean and standard deviation, over a tract's
+    streamlines, of each of PROFILE_MEASURES at num_positions equidistant
+    points along the (consistently oriented) streamlines.
+    """
+    tracts = polydata.read_polydata(vtk_file)
+    offsets, connectivity = tracts.lines
+    values = point_measures(np.asarray(_tensor_array(tracts, tensor_name)).reshape(-1, 9))
+    finite = np.isfinite(values['FA'])
+    num_dropped = np.count_nonzero(~finite[connectivity])
+    if num_dropped:
+        log.warning(f'Dropped {num_dropped} points with non-finite tensors from {vtk_file}')
+        offsets, connectivity = drop_points(offsets, connectivity, finite)
+    reverse = orient_lines(tracts.points, offsets, connectivity) if tracts.num_lines else None
+    valid, resampled = resample_lines(tracts.points, offsets, connectivity, values,
+                                      num_positions, reverse)
+    rows = []
+    for measure in PROFILE_MEASURES:
+        profiles = resampled[measure]
+        rows.append(pd.DataFrame({'position': np.arange(num_positions),
+                                  'measure': measure,
+                                  'value': profiles.mean(axis=0) if len(valid) else np.nan,
+                                  'stDev': profiles.std(axis=0) if len(valid) else np.nan,
+                                  'num_fibers': len(valid)}))
+    return pd.concat(rows, ignore_index=True)
+
+
+def _tract_profile(args):
+    vtk_file, num_positions, tensor_name = args
+    profile = tract_profile(vtk_file, num_positions, tensor_name)
+    profile.insert(0, 'tract', os.path.splitext(os.path.basename(str(vtk_file)))[0])
+    return profile
+
+
+def tract_profiles(vtk_files, output_csv=None, num_positions=DEFAULT_NUM_POSITIONS,
+                   tensor_name=None, num_proc=None):
+    """
+    Computes the tract_profile of each vtk file, on a pool of num_proc
+    processes (default: the available cpus), and returns them as one
+    (tract, position, measure) indexed DataFrame, saved to output_csv if given.
+    """
+    jobs = [(vtk_file, num_positions, tensor_name) for vtk_file in vtk_files]
+    num_proc = max(1, min(num_proc or util.available_cpus(), len(jobs)))
+    if num_proc == 1:
+        profiles = [_tract_profile(job) for job in jobs]
+    else:
+        with Pool(num_proc) as pool:
+            profiles = pool.map(_tract_profile, jobs)
+    result = pd.concat(profiles, ignore_index=True).set_index(['tract', 'position', 'measure'])
+    if output_csv is not None:
+        result.to_csv(str(output_csv))
+        log.info(f'Made {output_csv}')
+    return result
+
+
+def test_resample_lines():
+    points = np.array([[0, 0, 0], [1, 0, 0], [3, 0, 0],
+                       [0, 1, 0], [0, 1, 0],
+                       [3, 2, 0], [0, 2, 0]], dtype=np.float32)
+    offsets = np.array([0, 3, 5, 7])
+    connectivity = np.arange(7)
+    values = {'x': points[:, 0]}
+    reverse = orient_lines(points, offsets, connectivity)
+    assert reverse.tolist() == [False, False, True]
+    valid, resampled = resample_lines(points, offsets, connectivity, values, 4, reverse)
+    # the second line has no length
+    assert valid.tolist() == [0, 2]
+    assert np.allclose(resampled['x'], [[0, 1, 2, 3], [0, 1, 2, 3]])
+
+    new_offsets, new_connectivity = drop_points(offsets, connectivity,
+                                                [True, False, True, True, True, False, True])
+    assert new_offsets.tolist() == [0, 2, 4, 5]
+    assert new_connectivity.tolist() == [0, 2, 3, 4, 6]
+
+
+def test_tract_profiles():
+    rng = np.random.RandomState(0)
+    lines = []
+    for i in range(20):
+        x = np.sort(rng.uniform(0, 10, 15))
+        x[0], x[-1] = 0, 10
+        line = np.column_stack([x, np.full(15, i * 0.1), np.zeros(15)])
+        lines.append(line[::-1] if i % 2 else line)
+    points = np.concatenate(lines).astype(np.float32)
+    # prolate tensors that get more anisotropic along x
+    axial = 1e-3 * (1 + points[:, 0] / 10)
+    tensors = np.zeros((len(points), 3, 3))
+    tensors[:, 0, 0] = axial
+    tensors[:, 1, 1] = tensors[:, 2, 2] = 1e-3
+    tracts = polydata.PolyData(points, {'LINES': (np.arange(21) * 15, np.arange(len(points)))},
+                               [polydata.DataArray('tensor1', tensors.reshape(-1, 9))])
+    with local.tempdir() as tmpdir:
+        polydata.write_polydata(tmpdir / 'af.left.vtk', tracts)
+        profiles = tract_profiles([tmpdir / 'af.left.vtk'], tmpdir / 'profiles.csv',
+                                  num_positions=11, num_proc=1)
+        assert (tmpdir / 'profiles.csv').exists()
+    axial_profile = profiles.loc[('af.left', slice(None), 'axial'), 'value'].values
+    assert np.allclose(axial_profile, 1000 * 1e-3 * (1 + np.arange(11) / 10))
+    assert np.allclose(profiles.loc[('af.left', slice(None), 'radial'), 'value'], 1)
+    assert (profiles['num_fibers'] == 20).all()
+
+    # points with NaN tensors are left out of the profiles
+    nan_tensors = tensors.reshape(-1, 9).copy()
+    nan_tensors[np.arange(len(points)) % 15 == 7] = np.nan
+    tracts.point_data[0] = polydata.DataArray('tensor1', nan_tensors)
+    with local.tempdir() as tmpdir:
+        polydata.write_polydata(tmpdir / 'af.left.vtk', tracts)
+        nan_profiles = tract_profiles([tmpdir / 'af.left.vtk'], num_positions=11, num_proc=1)
+    assert np.allclose(nan_profiles.loc[('af.left', slice(None), 'axial'), 'value'].values,
+                       axial_profile)
+    assert (nan_profiles['num_fibers'] == 20).all()
@@ -1,13 +1,23 @@
+import os
+import sys
 import logging
 import json
+import hashlib
+import itertools
+from multiprocessing.pool import ThreadPool
+
 import toolz
 
 import pytest
 import coloredlogs
 from plumbum import local, cli
 import nibabel as nib
+import numpy as np
+import vtk
 
 from . import nifti2nhdr
+from . import util
+from .dwi_volume import DwiVolume
 from . import TEST_DATA
 
 
@@ -24,51 +34,269 @@ UKF_DEFAULT_PARAMS = {'numTensor': 2,
                       'stoppingThreshold': 0.1,
                       'seedsPerVoxel': 10}
 
+PARTITIONS_MANIFEST = 'manifest.json'
+
+# Maximum size of the blocks of volumes read and cast to short at once
+DEFAULT_SLAB_BYTES = 64 * 1024**2
+
+
+def _cast_short(slabs, counts):
+    """
+    Casts each slab to int16, clipping values outside its range (non-finite
+    values become 0), and adds the number of clipped voxels to counts.
+    """
+    info = np.iinfo(np.int16)
+    for slab in slabs:
+        finite = np.isfinite(slab)
+        clipped = ~finite | (slab < info.min) | (slab > info.max)
+        num_clipped = int(np.count_nonzero(clipped))
+        if num_clipped:
+            slab = np.clip(np.where(finite, slab, 0), info.min, info.max)
+            counts['clipped'] += num_clipped
+        yield slab.astype(np.int16)
+
+
+def short_nifti(input_file, output_file, max_bytes=DEFAULT_SLAB_BYTES):
+    """
+    Saves input_file as short (int16) to output_file, and returns the path of
+    the short nifti.  An unscaled int16 input isn't cast: it's returned as is
+    if it has the same compression as output_file, otherwise it's copied.
+
+    The image is streamed to output_file in slabs of at most max_bytes along
+    its last axis, so memory use doesn't depend on the image size.  Values
+    outside the int16 range are clipped, with a warning.
+    """
+    input_file = local.path(input_file)
+    img = DwiVolume(input_file)
+    if img.dtype == np.int16 and not img.scaled:
+        if input_file.name.endswith('.gz') == str(output_file).endswith('.gz'):
+            log.info(f'{input_file} is already short, using it as is')
+            return input_file
+        log.info(f'{input_file} is already short, copying it to {output_file}')
+        util.write_nifti_chunks(output_file, img.header, img.iter_slabs(max_bytes))
+        return local.path(output_file)
+    header = img.header.copy()
+    header.set_data_dtype('int16')
+    counts = {'clipped': 0}
+    util.write_nifti_chunks(output_file, header,
+                            _cast_short(img.iter_slabs(max_bytes), counts))
+    if counts['clipped']:
+        log.warning(f'{counts["clipped"]} voxels of {input_file} are outside the short (int16) '
+                    f'range [{np.iinfo(np.int16).min}, {np.iinfo(np.int16).max}] and were '
+                    'clipped')
+    return local.path(output_file)
+
+
+def prepare_inputs(dwi_file, dwi_mask_file, tmpdir, raw=False):
+    """
+    Makes the short (int16) nrrd DWI and mask that UKFTractography reads, in
+    tmpdir.  Returns the DWI and mask nhdr paths, and the short mask nifti.
+    """
+    dwi_file = local.path(dwi_file)
+    suffix = '.nii' if raw else '.nii.gz'
+    dwi_short = tmpdir / f'dwi_short{suffix}'
+    dwi_mask_short = tmpdir / f'mask_short{suffix}'
+
+    dwi_nrrd = tmpdir / 'dwi.nhdr'
+    dwi_mask_nrrd = tmpdir / 'dwimask.nhdr'
+
+    log.info('Typecast the DWI and mask to short (int16)')
+    dwi_short = short_nifti(dwi_file, dwi_short)
+    dwi_mask_short = short_nifti(dwi_mask_file, dwi_mask_short)
+
+    log.info('Convert the DWI and mask to nrrd')
+    nifti2nhdr.nifti2nhdr(str(dwi_short),
+                          dwi_file.with_suffix('.bval', depth=2),
+                          dwi_file.with_suffix('.bvec', depth=2),
+                          dwi_nrrd,
+                          data_file=str(dwi_short))
+    nifti2nhdr.nifti2nhdr(str(dwi_mask_short), None, None, dwi_mask_nrrd,
+                          data_file=str(dwi_mask_short))
+    return dwi_nrrd, dwi_mask_nrrd, dwi_mask_short
+
+
+def full_ukf_params(ukf_params=None):
+    """
+    Returns ukf_params on top of UKF_DEFAULT_PARAMS.
+    """
+    return UKF_DEFAULT_PARAMS if not ukf_params else {**UKF_DEFAULT_PARAMS, **ukf_params}
+
+
+def ukf_params_hash(ukf_params=None):
+    """
+    Short hash of the full set of UKF parameters, to name the outputs of
+    different parameter sets.  numThreads is left out as it doesn't change
+    the tracts.
+    """
+    params = {param: val for (param, val) in full_ukf_params(ukf_params).items()
+              if param != 'numThreads'}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def ukf_output_name(dwi_file, ukf_params=None):
+    """
+    The name of the tracts of a DWI for a set of UKF parameters:
+    <dwi>_ukf-<params hash>.vtk, where <dwi> is the DWI's name without its
+    .nii or .nii.gz suffix.
+    """
+    name = local.path(dwi_file).name
+    for suffix in ['.nii.gz', '.nii']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return f'{name}_ukf-{ukf_params_hash(ukf_params)}.vtk'
+
+
+def _ukf_command(ukf_tractography_bin, dwi_nrrd, dwi_mask_nrrd, seeds_nrrd, tracts,
+                 ukf_params=None):
+    ukf_params = full_ukf_params(ukf_params)
+    ukf_param_args = toolz.concat([[f'--{param}', val] for (param, val) in ukf_params.items()])
+    return local[ukf_tractography_bin].bound_command('--dwiFile', dwi_nrrd,
+                                                     '--maskFile', dwi_mask_nrrd,
+                                                     '--seedsFile', seeds_nrrd,
+                                                     '--tracts', tracts,
+                                                     '--recordTensors',
+                                                     '--freeWater',
+                                                     '--recordFreeWater',
+                                                     *ukf_param_args)
+
 
 def ukf(dwi_file, dwi_mask_file, output_vtk, ukf_params=None,
         ukf_tractography_bin='UKFTractography',
-        tmpdir=None):
+        tmpdir=None, raw=False, num_partitions=1):
     """
     Run UKFTractography given a DWI and DWI mask in NIFTI format.
+
+    If raw is True, the inputs to UKFTractography are uncompressed, so it can
+    read them directly instead of decompressing them first.
+
+    If num_partitions is more than 1, the seed voxels are split into that many
+    partitions (see partition_seeds) which are tracked by concurrent
+    UKFTractography processes, and their tracts are merged into output_vtk.
+    Each process gets an equal share of the available cpus as its numThreads
+    unless ukf_params sets it.
+    Each partition's tracts are kept in tmpdir until all are done, so a
+    failed run can be restarted with the same tmpdir and only the unfinished
+    partitions are run again.  The partitions' manifest records the inputs
+    they were made from, and finished partitions are thrown away if the DWI,
+    mask, number of partitions or UKF parameters change.
     """
 
     with local.tempdir() as tmpdir_:
         if not tmpdir:
             tmpdir = tmpdir_
-        dwi_short = tmpdir / 'dwi_short.nii.gz'
-        dwi_mask_short = tmpdir / 'mask_short.nii.gz'
-
-        dwi_nrrd = tmpdir / 'dwi.nhdr'
-        dwi_mask_nrrd = tmpdir / 'dwimask.nhdr'
-
-        log.info('Typecast the DWI and mask to short (int16)')
-        for (input_file, output_file) in [(dwi_file, dwi_short), (dwi_mask_file, dwi_mask_short)]:
-            img = nib.load(str(input_file))
-            nib.Nifti1Image(img.get_data().astype('int16'), img.affine, img.header) \
-                .to_filename(str(output_file))
-
-        log.info('Convert the DWI and mask to nrrd')
-        nifti2nhdr.nifti2nhdr(str(dwi_short),
-                              dwi_file.with_suffix('.bval', depth=2),
-                              dwi_file.with_suffix('.bvec', depth=2),
-                              dwi_nrrd)
-        nifti2nhdr.nifti2nhdr(str(dwi_mask_short), None, None, dwi_mask_nrrd)
-
-        ukf_params = UKF_DEFAULT_PARAMS if not ukf_params else {**UKF_DEFAULT_PARAMS, **ukf_params}
-        ukf_param_args = toolz.concat([[f'--{param}', val] for (param, val) in ukf_params.items()])
-
-        log.info('Run UKF tractography')
-        UKFTractography = local[ukf_tractography_bin]
-        cmd = UKFTractography.bound_command('--dwiFile', dwi_nrrd,
-                                            '--maskFile', dwi_mask_nrrd,
-                                            '--seedsFile', dwi_mask_nrrd,
-                                            '--tracts', output_vtk,
-                                            '--recordTensors',
-                                            '--freeWater',
-                                            '--recordFreeWater',
-                                            *ukf_param_args)
-        log.info(f'Running: {cmd}')
-        cmd()
+        dwi_nrrd, dwi_mask_nrrd, dwi_mask_short = prepare_inputs(dwi_file, dwi_mask_file, tmpdir,
+                                                                 raw=raw)
+
+        def ukf_command(seeds_nrrd, tracts):
+            return _ukf_command(ukf_tractography_bin, dwi_nrrd, dwi_mask_nrrd, seeds_nrrd,
+                                tracts, ukf_params)
+
+        if num_partitions <= 1:
+            log.info('Run UKF tractography')
+            cmd = ukf_command(dwi_mask_nrrd, output_vtk)
+            log.info(f'Running: {cmd}')
+            cmd()
+            return
+
+        partitions_dir = tmpdir / 'partitions'
+        dwi_stat = local.path(dwi_file).stat()
+        manifest = dict(dwi=str(local.path(dwi_file)), dwi_mtime=dwi_stat.st_mtime,
+                        dwi_size=dwi_stat.st_size, mask_sha1=_file_sha1(dwi_mask_file),
+                        num_partitions=num_partitions, ukf_params_hash=ukf_params_hash(ukf_params))
+        manifest_file = partitions_dir / PARTITIONS_MANIFEST
+        if manifest_file.exists() and json.loads(manifest_file.read()) == manifest:
+            log.info(f'Reusing the finished partitions in {partitions_dir}')
+        elif partitions_dir.exists():
+            log.info(f'The inputs changed, removing the previous partitions in {partitions_dir}')
+            for tracts in partitions_dir // 'tracts_*.vtk':
+                tracts.delete()
+        log.info(f'Split the seed mask into {num_partitions} partitions')
+        seeds_nrrds = partition_seeds(dwi_mask_short, num_partitions, partitions_dir)
+        manifest_file.write(json.dumps(manifest, indent=2))
+        num_threads = max(1, util.available_cpus() // num_partitions)
+        partition_params = {'numThreads': num_threads, **(ukf_params or {})}
+
+        def run_partition(index):
+            tracts = partitions_dir / f'tracts_{index:03d}.vtk'
+            if tracts.exists():
+                log.info(f'{tracts} already exists, skipping partition {index}')
+                return tracts
+            tmp_tracts = partitions_dir / f'tracts_{index:03d}.tmp.vtk'
+            cmd = _ukf_command(ukf_tractography_bin, dwi_nrrd, dwi_mask_nrrd,
+                               seeds_nrrds[index], tmp_tracts, partition_params)
+            log.info(f'Running: {cmd}')
+            cmd()
+            tmp_tracts.move(tracts)
+            return tracts
+
+        log.info(f'Run UKF tractography on {num_partitions} partitions of the seeds')
+        with ThreadPool(num_partitions) as pool:
+            partition_vtks = pool.map(run_partition, range(num_partitions))
+
+        log.info(f'Merge the partitions\' tracts into {output_vtk}')
+        merge_vtks(partition_vtks, output_vtk)
+
+
+def _file_sha1(filename):
+    sha1 = hashlib.sha1()
+    with open(str(filename), 'rb') as f:
+        for block in iter(lambda: f.read(1024**2), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def partition_seeds(mask_file, num_partitions, output_dir):
+    """
+    Splits the non-zero voxels of a mask into num_partitions disjoint seed
+    masks, the i'th voxel (in C order) going to partition i % num_partitions,
+    so that the partitions are the same on every run and cover the mask
+    evenly.  Saves the seed masks as output_dir/seeds_NNN.nii.gz with nrrd
+    headers, and returns the headers' paths.
+    """
+    output_dir = local.path(output_dir)
+    output_dir.mkdir()
+    img = nib.load(str(mask_file))
+    voxels = np.flatnonzero(np.asanyarray(img.dataobj))
+    header = img.header.copy()
+    header.set_data_dtype('int16')
+    header.set_slope_inter(1, 0)
+    nhdrs = []
+    for index in range(num_partitions):
+        seeds = np.zeros(img.shape, dtype=np.int16)
+        seeds.flat[voxels[index::num_partitions]] = 1
+        seeds_nifti = output_dir / f'seeds_{index:03d}.nii.gz'
+        nib.Nifti1Image(seeds, img.affine, header).to_filename(str(seeds_nifti))
+        nhdr = output_dir / f'seeds_{index:03d}.nhdr'
+        nifti2nhdr.nifti2nhdr(str(seeds_nifti), None, None, nhdr)
+        nhdrs.append(nhdr)
+    return nhdrs
+
+
+def merge_vtks(input_vtks, output_vtk):
+    """
+    Appends the polydata (points, lines and point data arrays) of the
+    input VTK files into one binary VTK file.  Inputs without any points are
+    skipped, as they would have none of the other inputs' point data arrays.
+    """
+    append = vtk.vtkAppendPolyData()
+    for input_vtk in input_vtks:
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(str(input_vtk))
+        reader.Update()
+        polydata = reader.GetOutput()
+        if polydata.GetNumberOfPoints() == 0:
+            log.info(f'{input_vtk} has no tracts')
+            continue
+        append.AddInputData(polydata)
+    if append.GetNumberOfInputConnections(0) == 0:
+        append.AddInputData(vtk.vtkPolyData())
+    append.Update()
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetFileTypeToBinary()
+    writer.SetFileName(str(output_vtk))
+    writer.SetInputData(append.GetOutput())
+    writer.Write()
 
 
 @pytest.mark.slow
@@ -82,6 +310,232 @@ def test_ukf(ukf_tractography_bin):
         ukf(input_dwi, input_mask, output, ukf_tractography_bin=ukf_tractography_bin)
 
 
+def test_short_nifti():
+    data = np.arange(24).reshape(2, 3, 4)
+    with local.tempdir() as tmpdir:
+        nib.Nifti1Image(data.astype(np.int16), np.identity(4)).to_filename(str(tmpdir / 'a.nii.gz'))
+        nib.Nifti1Image(data.astype(np.float32), np.identity(4)) \
+            .to_filename(str(tmpdir / 'b.nii.gz'))
+        assert short_nifti(tmpdir / 'a.nii.gz', tmpdir / 'out.nii.gz') == tmpdir / 'a.nii.gz'
+        for name in ['a', 'b']:
+            short = short_nifti(tmpdir / f'{name}.nii.gz', tmpdir / f'{name}_short.nii')
+            assert short == tmpdir / f'{name}_short.nii'
+            img = nib.load(str(short))
+            assert img.get_data_dtype() == np.int16
+            assert np.array_equal(np.asanyarray(img.dataobj), data)
+
+
+def test_short_nifti_clipping(caplog):
+    data = np.arange(2 * 3 * 4 * 5, dtype=np.float64).reshape(2, 3, 4, 5) - 60.5
+    data[0, 0, 0, 1] = 1e6
+    data[1, 0, 0, 4] = -1e6
+    data[1, 1, 0, 3] = np.nan
+    expected = data.copy()
+    expected[0, 0, 0, 1] = 32767
+    expected[1, 0, 0, 4] = -32768
+    expected[1, 1, 0, 3] = 0
+    with local.tempdir() as tmpdir:
+        nib.Nifti1Image(data, np.identity(4)).to_filename(str(tmpdir / 'dwi.nii.gz'))
+        # 2 volumes per slab
+        short = short_nifti(tmpdir / 'dwi.nii.gz', tmpdir / 'short.nii.gz',
+                            max_bytes=2 * 2 * 3 * 4 * 8)
+        assert np.array_equal(np.asanyarray(nib.load(str(short)).dataobj),
+                              expected.astype(np.int16))
+    assert '3 voxels' in caplog.text
+
+
+FAKE_UKF = """
+import os
+import sys
+import vtk
+import nibabel as nib
+
+args = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+seeds_nhdr = args['--seedsFile']
+with open(seeds_nhdr.replace('.nhdr', '.log'), 'a') as f:
+    f.write('ran\\n')
+with open(seeds_nhdr.replace('.nhdr', '.threads'), 'w') as f:
+    f.write(sys.argv[sys.argv.index('--numThreads') + 1])
+seeds_nifti = [line.split(': ')[1] for line in open(seeds_nhdr).read().splitlines()
+               if line.startswith('data file: ')][0]
+seeds = nib.load(os.path.join(os.path.dirname(seeds_nhdr), seeds_nifti)).get_fdata()
+points = vtk.vtkPoints()
+lines = vtk.vtkCellArray()
+fa = vtk.vtkFloatArray()
+fa.SetName('FA')
+for (x, y, z) in zip(*seeds.nonzero()):
+    lines.InsertNextCell(2)
+    for offset in (0, 0.5):
+        lines.InsertCellPoint(points.InsertNextPoint(x, y, z + offset))
+        fa.InsertNextValue(x * 100 + y * 10 + z)
+polydata = vtk.vtkPolyData()
+polydata.SetPoints(points)
+polydata.SetLines(lines)
+polydata.GetPointData().AddArray(fa)
+writer = vtk.vtkPolyDataWriter()
+writer.SetFileName(args['--tracts'])
+writer.SetInputData(polydata)
+writer.Write()
+"""
+
+
+def test_ukf_partitions(monkeypatch):
+    monkeypatch.setattr(util, 'available_cpus', lambda: 7)
+    mask = np.zeros((4, 4, 3), dtype=np.uint8)
+    mask[1:3, 1:4, :2] = 1
+    with local.tempdir() as tmpdir:
+        (tmpdir / 'dwi.bval').write('0 1000')
+        (tmpdir / 'dwi.bvec').write('0 1\n0 0\n0 0\n')
+        nib.Nifti1Image(np.ones((4, 4, 3, 2), dtype=np.int16), np.identity(4)) \
+            .to_filename(str(tmpdir / 'dwi.nii.gz'))
+        nib.Nifti1Image(mask, np.identity(4)).to_filename(str(tmpdir / 'mask.nii.gz'))
+        fake_ukf = tmpdir / 'UKFTractography'
+        fake_ukf.write(f'#!{sys.executable}\n{FAKE_UKF}')
+        os.chmod(fake_ukf, 0o755)
+
+        nhdrs = partition_seeds(tmpdir / 'mask.nii.gz', 3, tmpdir / 'seeds')
+        seeds = [nib.load(str(nhdr.with_suffix('.nii.gz'))).get_fdata() for nhdr in nhdrs]
+        assert np.array_equal(sum(seeds), mask)
+        assert [int(s.sum()) for s in seeds] == [4, 4, 4]
+
+        def run(**kwargs):
+            ukf(tmpdir / 'dwi.nii.gz', tmpdir / 'mask.nii.gz', tmpdir / 'tracts.vtk',
+                ukf_tractography_bin=fake_ukf, tmpdir=work_dir, num_partitions=3, **kwargs)
+            reader = vtk.vtkPolyDataReader()
+            reader.SetFileName(str(tmpdir / 'tracts.vtk'))
+            reader.Update()
+            return reader.GetOutput()
+
+        def runs(index):
+            return (work_dir / 'partitions' / f'seeds_{index:03d}.log').read().count('ran')
+
+        work_dir = tmpdir / 'work'
+        work_dir.mkdir()
+        run()
+        assert [runs(i) for i in range(3)] == [1, 1, 1]
+        assert (work_dir / 'partitions' / 'seeds_002.threads').read() == '2'
+
+        # a failed run that only finished partitions 0 and 2
+        (work_dir / 'partitions' / 'tracts_001.vtk').delete()
+        polydata = run(ukf_params={'numThreads': 5})
+        assert [runs(i) for i in range(3)] == [1, 2, 1]
+        assert (work_dir / 'partitions' / 'seeds_001.threads').read() == '5'
+        assert polydata.GetNumberOfLines() == 12
+        fa = polydata.GetPointData().GetArray('FA')
+        assert sorted({int(fa.GetValue(i)) for i in range(fa.GetNumberOfTuples())}) == \
+            sorted(x * 100 + y * 10 + z for (x, y, z) in zip(*mask.nonzero()))
+
+        # new parameters or a new mask make all the partitions again
+        run(ukf_params={'stoppingFA': 0.2})
+        assert [runs(i) for i in range(3)] == [2, 3, 2]
+        mask[1, 1, 0] = 0
+        nib.Nifti1Image(mask, np.identity(4)).to_filename(str(tmpdir / 'mask.nii.gz'))
+        assert run(ukf_params={'stoppingFA': 0.2}).GetNumberOfLines() == 11
+        assert [runs(i) for i in range(3)] == [3, 4, 3]
+
+
+def param_grid(grid):
+    """
+    Expands a dict of lists of parameter values, e.g. {'stoppingFA': [0.1,
+    0.15], 'Qm': [0.001]}, into the list of all combinations of parameters.
+    """
+    params = sorted(grid)
+    return [dict(zip(params, values))
+            for values in itertools.product(*(grid[param] for param in params))]
+
+
+def ukf_sweep(dwi_file, dwi_mask_file, output_dir, ukf_param_sets,
+              ukf_tractography_bin='UKFTractography', num_proc=None, raw=False, tmpdir=None):
+    """
+    Runs UKFTractography with each of ukf_param_sets (a list of dicts of
+    parameters, see param_grid) on the same inputs, which are only converted
+    once.  The runs share a budget of num_proc cpus (default: the available
+    cpus): up to num_proc variants run at once, and each gets an equal share
+    of the cpus as its numThreads unless the parameters set it.
+
+    The tracts of each parameter set are saved as
+    output_dir/<dwi>_ukf-<params hash>.vtk with the parameters in a .json next
+    to them.  Parameter sets that already have tracts are skipped.
+
+    Returns a dict of the output vtk of each parameter set's hash.
+    """
+    dwi_file = local.path(dwi_file)
+    output_dir = local.path(output_dir)
+    output_dir.mkdir()
+    variants = {}
+    outputs = {}
+    for ukf_params in ukf_param_sets:
+        params_hash = ukf_params_hash(ukf_params)
+        variants[params_hash] = full_ukf_params(ukf_params)
+        outputs[params_hash] = output_dir / ukf_output_name(dwi_file, ukf_params)
+    todo = [params_hash for params_hash in variants if not outputs[params_hash].exists()]
+    log.info(f'{len(variants) - len(todo)} of {len(variants)} UKF parameter sets are done')
+    if not todo:
+        return outputs
+
+    num_proc = num_proc or util.available_cpus()
+    num_concurrent = min(num_proc, len(todo))
+    num_threads = max(1, num_proc // num_concurrent)
+
+    with local.tempdir() as tmpdir_:
+        if not tmpdir:
+            tmpdir = tmpdir_
+        dwi_nrrd, dwi_mask_nrrd, _ = prepare_inputs(dwi_file, dwi_mask_file, tmpdir, raw=raw)
+
+        def run(params_hash):
+            ukf_params = {'numThreads': num_threads, **variants[params_hash]}
+            output_vtk = outputs[params_hash]
+            tmp_vtk = output_vtk.with_suffix('.tmp.vtk')
+            cmd = _ukf_command(ukf_tractography_bin, dwi_nrrd, dwi_mask_nrrd, dwi_mask_nrrd,
+                               tmp_vtk, ukf_params)
+            log.info(f'Running: {cmd}')
+            cmd()
+            with open(output_vtk.with_suffix('.json'), 'w') as f:
+                json.dump(variants[params_hash], f, indent=2, sort_keys=True)
+            tmp_vtk.move(output_vtk)
+
+        log.info(f'Run {len(todo)} UKF parameter sets, {num_concurrent} at a time with '
+                 f'{num_threads} threads each')
+        with ThreadPool(num_concurrent) as pool:
+            pool.map(run, todo)
+
+    return outputs
+
+
+def test_ukf_sweep():
+    with local.tempdir() as tmpdir:
+        (tmpdir / 'dwi.bval').write('0 1000')
+        (tmpdir / 'dwi.bvec').write('0 1\n0 0\n0 0\n')
+        nib.Nifti1Image(np.ones((4, 4, 3, 2), dtype=np.int16), np.identity(4)) \
+            .to_filename(str(tmpdir / 'dwi.nii.gz'))
+        nib.Nifti1Image(np.ones((4, 4, 3), dtype=np.uint8), np.identity(4)) \
+            .to_filename(str(tmpdir / 'mask.nii.gz'))
+        fake_ukf = tmpdir / 'UKFTractography'
+        fake_ukf.write(f'#!{sys.executable}\n{FAKE_UKF}')
+        os.chmod(fake_ukf, 0o755)
+
+        (tmpdir / 'work').mkdir()
+        grid = param_grid({'stoppingFA': [0.1, 0.15], 'seedsPerVoxel': [1, 2]})
+        assert len(grid) == 4
+        assert ukf_params_hash({'stoppingFA': 0.15}) == ukf_params_hash({})
+        assert ukf_params_hash({'numThreads': 4}) == ukf_params_hash({})
+        outputs = ukf_sweep(tmpdir / 'dwi.nii.gz', tmpdir / 'mask.nii.gz', tmpdir / 'sweep',
+                            grid[:2], ukf_tractography_bin=fake_ukf, num_proc=2,
+                            tmpdir=tmpdir / 'work')
+        assert all(output.exists() for output in outputs.values())
+        output = outputs[ukf_params_hash(grid[0])]
+        assert output.name == ukf_output_name(tmpdir / 'dwi.nii.gz', grid[0])
+        assert ukf_output_name('/data/sub.01/dwi.run-1.nii', grid[0]) == \
+            f'dwi.run-1_ukf-{ukf_params_hash(grid[0])}.vtk'
+        assert json.loads(output.with_suffix('.json').read())['seedsPerVoxel'] == 1
+        assert (tmpdir / 'work' / 'dwimask.log').read() == 'ran\nran\n'
+        outputs = ukf_sweep(tmpdir / 'dwi.nii.gz', tmpdir / 'mask.nii.gz', tmpdir / 'sweep',
+                            grid, ukf_tractography_bin=fake_ukf, num_proc=2,
+                            tmpdir=tmpdir / 'work')
+        assert len(outputs) == 4
+        assert (tmpdir / 'work' / 'dwimask.log').read() == 'ran\n' * 4
+
+
 class Cli(cli.Application):
 
     __doc__ = ukf.__doc__
@@ -115,6 +569,16 @@ class Cli(cli.Application):
         argtype=str,
         help="JSON dictionary of parameters for UKF, e.g. '{arg1:val1, arg2:val2}")
 
+    raw = cli.Flag(
+        ['--raw'],
+        help='give UKFTractography uncompressed inputs that it can read directly')
+
+    num_partitions = cli.SwitchAttr(
+        ['-k', '--partitions'],
+        argtype=int,
+        default=1,
+        help='number of seed partitions to track with concurrent UKFTractography processes')
+
     tmpdir = cli.SwitchAttr(
         ['--tmpdir'],
         argtype=cli.ExistingDirectory,
@@ -135,4 +599,6 @@ class Cli(cli.Application):
             output_vtk=self.output_vtk,
             ukf_tractography_bin=self.ukf_bin,
             ukf_params=ukf_params,
-            tmpdir=self.tmpdir)
+            tmpdir=self.tmpdir,
+            raw=self.raw,
+            num_partitions=self.num_partitions)
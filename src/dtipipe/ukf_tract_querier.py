@@ -1,11 +1,14 @@
 import filecmp
 import logging
-from multiprocessing import Pool
 
 import coloredlogs
+import numpy as np
+import vtk
 from plumbum import cli, local
 
 from . import activate_tensors
+from . import polydata
+from .measuretracts import getTensorData
 from . import TEST_DATA
 
 
@@ -13,12 +16,48 @@ log = logging.getLogger(__name__)
 
 
 DEFAULT_NUM_PROC = 10
+DEFAULT_MIN_TRACT_LENGTH = 2
 
 
-def _activate_tensors(vtk_file):
-    new_vtk_file = vtk_file.dirname / (vtk_file.stem[2:] + ''.join(vtk_file.suffixes))
-    activate_tensors.activate_tensors(vtk_file, new_vtk_file)
-    vtk_file.delete()
+def _read_ascii_polydata(input_vtk):
+    """
+    Reads an ASCII VTK file with vtkPolyDataReader, through a binary copy.
+    """
+    reader = vtk.vtkPolyDataReader()
+    reader.SetFileName(str(input_vtk))
+    reader.Update()
+    activate_tensors._check_error(reader, f'read {input_vtk}')
+    with local.tempdir() as tmpdir:
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileTypeToBinary()
+        writer.SetFileName(str(tmpdir / 'binary.vtk'))
+        writer.SetInputData(reader.GetOutput())
+        writer.Write()
+        activate_tensors._check_error(writer, f'write a binary copy of {input_vtk}')
+        return polydata.read_polydata(tmpdir / 'binary.vtk', mmap=False)
+
+
+def remove_short_tracts(input_vtk, output_vtk, min_length=DEFAULT_MIN_TRACT_LENGTH):
+    """
+    Saves the tracts of input_vtk that are longer than min_length (mm) to
+    output_vtk, like tract_math's tract_remove_short_tracts.  If no tract is
+    removed, nothing is written and input_vtk is returned, otherwise
+    output_vtk is.
+
+    ASCII files (e.g. from UKF's writeAsciiTracts) are read with VTK, and
+    the tracts that are kept are written in binary.
+    """
+    if getTensorData._is_binary(input_vtk):
+        tracts = polydata.read_polydata(input_vtk)
+    else:
+        tracts = _read_ascii_polydata(input_vtk)
+    keep = tracts.line_lengths() > min_length
+    log.info(f'Removing {np.count_nonzero(~keep)} of {len(keep)} tracts shorter than '
+             f'{min_length}mm')
+    if keep.all():
+        return local.path(input_vtk)
+    polydata.write_polydata(output_vtk, tracts.select_lines(keep))
+    return local.path(output_vtk)
 
 
 def ukf_tract_querier(ukf_vtk, atlas_file, query_file, output_dir, num_proc=DEFAULT_NUM_PROC):
@@ -41,12 +80,8 @@ def ukf_tract_querier(ukf_vtk, atlas_file, query_file, output_dir, num_proc=DEFA
         tmp_output_dir = tmpdir / 'output'
         tmp_output_dir.mkdir()
 
-        log.info(f'Remove short tracts from the tractography file (Make {pruned_ukf_vtk})')
-        r = local['tract_math'].run([ukf_vtk, 'tract_remove_short_tracts', '2', pruned_ukf_vtk])
-        log.debug(f'tract_math output: {r}')
-        if not pruned_ukf_vtk.exists():
-            raise Exception(f'tract_math failed to make {pruned_ukf_vtk}\n'
-                            f'tract_math output: {r}')
+        log.info('Remove short tracts from the tractography file')
+        pruned_ukf_vtk = remove_short_tracts(ukf_vtk, pruned_ukf_vtk)
 
         log.info(f'Run tract_querier (Make {tmp_output_dir}/*.vtk)')
         local['tract_querier'].run(['-t', pruned_ukf_vtk,
@@ -56,16 +91,43 @@ def ukf_tract_querier(ukf_vtk, atlas_file, query_file, output_dir, num_proc=DEFA
 
         log.info(f"Update the tensor data format in each output vtk and replace nan's with 0 "
                  "and inf's with large finite numbers")
-        pool = Pool(int(num_proc))
-        pool.map_async(_activate_tensors, tmp_output_dir.glob('*.vtk'))
-        pool.close()
-        pool.join()
+        vtk_files = tmp_output_dir.glob('*.vtk')
+        activate_tensors.activate_tensors_batch(
+            [(vtk_file, vtk_file.dirname / (vtk_file.stem[2:] + ''.join(vtk_file.suffixes)))
+             for vtk_file in vtk_files],
+            num_proc=int(num_proc))
+        for vtk_file in vtk_files:
+            vtk_file.delete()
 
         log.info(f'Copy {tmp_output_dir} to {output_dir}')
         output_dir.parent.mkdir()
         tmp_output_dir.copy(output_dir)
 
 
+def test_remove_short_tracts():
+    points = np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [5, 5, 5], [5, 5, 8]], dtype=np.float32)
+    tracts = polydata.PolyData(points, {'LINES': (np.array([0, 2, 3, 5]),
+                                                  np.array([0, 1, 2, 3, 4]))})
+    with local.tempdir() as tmpdir:
+        polydata.write_polydata(tmpdir / 'tracts.vtk', tracts)
+        assert remove_short_tracts(tmpdir / 'tracts.vtk', tmpdir / 'pruned.vtk', 0.5) == \
+            tmpdir / 'pruned.vtk'
+        assert polydata.read_polydata(tmpdir / 'pruned.vtk').lines[0].tolist() == [0, 2, 4]
+        assert remove_short_tracts(tmpdir / 'pruned.vtk', tmpdir / 'pruned2.vtk', 0.5) == \
+            tmpdir / 'pruned.vtk'
+        assert not (tmpdir / 'pruned2.vtk').exists()
+
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(str(tmpdir / 'tracts.vtk'))
+        reader.Update()
+        writer = vtk.vtkPolyDataWriter()
+        writer.SetFileName(str(tmpdir / 'ascii.vtk'))
+        writer.SetInputData(reader.GetOutput())
+        writer.Write()
+        remove_short_tracts(tmpdir / 'ascii.vtk', tmpdir / 'ascii_pruned.vtk', 0.5)
+        assert polydata.read_polydata(tmpdir / 'ascii_pruned.vtk').lines[0].tolist() == [0, 2, 4]
+
+
 def test_ukf_tract_querier(num_proc_ukf_tract_querier):
     input_vtk = TEST_DATA / 'dwi.vtk'
     input_query_file = TEST_DATA / 'wmql-2.0.qry'
@@ -1,11 +1,27 @@
+import os
+import sys
+import json
+import hashlib
+import logging
+
 import pandas as pd
 import numpy as np
 import nibabel as nib
+from nibabel.openers import ImageOpener
 from plumbum import local
 
+from .dwi_volume import DwiVolume
 
-def env_from_bash_file(source_file, init=None):
-    init = '' if not init else init
+
+log = logging.getLogger(__name__)
+
+ENV_CACHE_DIR = os.path.join(os.environ.get('DTIPIPE_CACHE_DIR',
+                                            os.path.expanduser('~/.cache/dtipipe')), 'env')
+
+_env_cache = {}
+
+
+def _source_bash_file(source_file, init):
     lines = local['env']('-i', 'bash', '-c', f"{init} source {source_file} && env").strip() \
                                                                                    .split('\n')
     result = {}
@@ -15,6 +31,60 @@ def env_from_bash_file(source_file, init=None):
     return result
 
 
+def env_from_bash_file(source_file, init=None):
+    """
+    Returns the environment made by sourcing source_file in a clean bash shell.
+
+    The result is cached in this process and on disk (in ENV_CACHE_DIR),
+    keyed by the file's path and modification time, so the file is only
+    sourced again after it changes.
+    """
+    init = '' if not init else init
+    source_file = local.path(source_file)
+    if not source_file.exists():
+        return _source_bash_file(source_file, init)
+
+    key = json.dumps([str(source_file), source_file.stat().st_mtime, init])
+    if key in _env_cache:
+        return dict(_env_cache[key])
+
+    cache_file = os.path.join(ENV_CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.json')
+    try:
+        with open(cache_file) as f:
+            result = json.load(f)
+    except (OSError, ValueError):
+        result = _source_bash_file(source_file, init)
+        try:
+            os.makedirs(ENV_CACHE_DIR, exist_ok=True)
+            tmp_cache_file = f'{cache_file}.{os.getpid()}'
+            with open(tmp_cache_file, 'w') as f:
+                json.dump(result, f)
+            os.replace(tmp_cache_file, cache_file)
+        except OSError as e:
+            log.debug(f'Could not write environment cache {cache_file}: {e}')
+
+    _env_cache[key] = result
+    return dict(result)
+
+
+def test_env_from_bash_file(monkeypatch):
+    with local.tempdir() as tmpdir:
+        monkeypatch.setattr(sys.modules[__name__], 'ENV_CACHE_DIR', tmpdir / 'env')
+        setup_file = tmpdir / 'setup.sh'
+        setup_file.write('export DTIPIPE_TEST=1\n')
+        os.utime(setup_file, (1000, 1000))
+        assert env_from_bash_file(setup_file)['DTIPIPE_TEST'] == '1'
+
+        # unchanged mtime, so the cached environment is used
+        setup_file.write('export DTIPIPE_TEST=2\n')
+        os.utime(setup_file, (1000, 1000))
+        _env_cache.clear()
+        assert env_from_bash_file(setup_file)['DTIPIPE_TEST'] == '1'
+
+        os.utime(setup_file, (2000, 2000))
+        assert env_from_bash_file(setup_file)['DTIPIPE_TEST'] == '2'
+
+
 def get_fsl_env(fsldir):
     if not fsldir:
         return {}
@@ -58,6 +128,59 @@ def ants_env(ants_dir):
     return local.env(**env)
 
 
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def available_cpus():
+    """
+    Number of CPUs this process may use, taking into account its CPU affinity
+    and any cgroup (v1 or v2) CPU quota.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota, period = None, None
+    cpu_max = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if cpu_max:
+        quota, _, period = cpu_max.partition(' ')
+    else:
+        quota = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and quota not in ('max', '-1'):
+        cpus = min(cpus, max(1, int(np.ceil(int(quota) / int(period)))))
+    return cpus
+
+
+def available_memory():
+    """
+    Bytes of memory available to this process: the smaller of the system's
+    available memory and what is left of any cgroup (v1 or v2) memory limit.
+    """
+    memory = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit = _read_first_line(limit_file)
+        if limit and limit != 'max':
+            cgroup_memory = int(limit) - int(_read_first_line(usage_file) or 0)
+            memory = cgroup_memory if memory is None else min(memory, cgroup_memory)
+            break
+    return memory
+
+
 def save_nifti(output_name, data, affine, hdr):
     if data.dtype.name == 'uint8':
         hdr.set_data_dtype('uint8')
@@ -69,10 +192,42 @@ def save_nifti(output_name, data, affine, hdr):
     result_img.to_filename(output_name)
 
 
+def write_nifti_chunks(output_name, header, chunks):
+    """
+    Writes a nifti one chunk at a time, where the chunks are consecutive blocks
+    along the image's last axis (e.g. the volumes of a DWI), so that only one
+    chunk is held in memory and a '.nii.gz' is compressed in a single pass.
+
+    The header must already have the full output shape and data type; the
+    chunks' values are written as is (scaling is reset).
+    """
+    header = nib.Nifti1Header.from_header(header)
+    header['vox_offset'] = 0
+    header.set_slope_inter(1, 0)
+    shape = header.get_data_shape()
+    dtype = header.get_data_dtype()
+    num_written = 0
+    with ImageOpener(str(output_name), 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * (int(header['vox_offset']) - f.tell()))
+        for chunk in chunks:
+            chunk = np.asanyarray(chunk)
+            if chunk.ndim == len(shape) - 1:
+                chunk = chunk[..., np.newaxis]
+            if chunk.shape[:-1] != shape[:-1]:
+                raise Exception(f'Chunk shape {chunk.shape} does not match image shape {shape}')
+            f.write(chunk.astype(dtype).tobytes(order='F'))
+            num_written += chunk.shape[-1]
+    if num_written != shape[-1]:
+        raise Exception(f'Wrote {num_written} of {shape[-1]} slices to {output_name}')
+
+
 def compare_niftis(nifti_file1, nifti_file2):
-    nifti1 = nib.load(str(nifti_file1))
-    nifti2 = nib.load(str(nifti_file2))
-    data_is_equal = (np.count_nonzero(nifti1.get_data() - nifti2.get_data()) == 0)
+    nifti1 = DwiVolume(nifti_file1, dtype=np.float64, cache_bytes=0)
+    nifti2 = DwiVolume(nifti_file2, dtype=np.float64, cache_bytes=0)
+    data_is_equal = nifti1.shape == nifti2.shape and \
+        all(np.count_nonzero(volume1 - volume2) == 0
+            for (volume1, volume2) in zip(nifti1.volumes(), nifti2.volumes()))
     if not data_is_equal:
         print("Nifti data are not the same:")
         print(nifti_file1)
@@ -90,45 +245,37 @@ def compare_niftis(nifti_file1, nifti_file2):
     return True
 
 
-def read_bvecs(bvec_file, normalize=False):
-    with open(bvec_file, 'r') as f:
-        bvecs = [[float(num) for num in line.split()] for line in f.read().split('\n') if line]
-
-    # bvec_file can be 3xN or Nx3
-    # we want to return as Nx3
-    if len(bvecs) == 3:
-        bvecs = transpose(bvecs)
-
-    if normalize:
-        for i in range(len(bvecs)):
-            L_2 = np.linalg.norm(bvecs[i])
-            if L_2:
-                bvecs[i] /= L_2
-            else:
-                bvecs[i] = [0, 0, 0]
-    return bvecs
-
-
-def read_bvals(bval_file):
-    return [float(i) for i in bval_file.read().strip().split()]
-
-
 def write_bvecs(bvecs, bvec_file):
+    if isinstance(bvecs, np.ndarray):
+        bvecs = bvecs.tolist()
     with open(bvec_file, 'w') as f:
         f.write(('\n').join((' ').join(str(i) for i in row) for row in bvecs))
 
 
-def bvec_scaling(bval, bvec, b_max):
-    if bval:
-        factor = np.sqrt(bval / b_max)
-        if np.linalg.norm(bvec) != factor:
-            bvec = np.array(bvec) * factor
-    bvec = [str(x) for x in bvec]
-    return ('   ').join(bvec)
+def polar_rotations(transforms):
+    """
+    Extracts the rotation component of a stack of affine transforms.
+
+    Uses the polar decomposition A = R S of each 3x3 linear part, which is
+    the same as the finite strain rotation R = (A A^T)^(-1/2) A, computed here
+    for all transforms at once from their SVD (A = U S V^T => R = U V^T).
+    """
+    transforms = np.asarray(transforms, dtype=float)
+    u, _, vt = np.linalg.svd(transforms[..., :3, :3])
+    return u @ vt
 
 
-def transpose(bvecs):
-    return list(map(list, zip(*bvecs)))
+def rotate_bvecs(bvecs, transforms):
+    """
+    Rotates each b-vector by the rotation part of its corresponding transform.
+
+    bvecs is Nx3 and transforms is (N,4,4) (or (N,3,3)); returns an Nx3 array.
+    """
+    bvecs = np.asarray(bvecs, dtype=float)
+    rotations = polar_rotations(transforms)
+    if len(rotations) != len(bvecs):
+        raise Exception(f'Got {len(rotations)} transforms for {len(bvecs)} b-vectors')
+    return np.einsum('nij,nj->ni', rotations, bvecs)
 
 
 def read_freesurfer_stats_header(stats_file):
@@ -145,3 +292,35 @@ def read_freesurfer_stats(stats_file):
     if not header:
         raise Exception(f'Failed to find header in stats file: {stats_file}')
     return pd.read_csv(stats_file, names=header, comment='#', delim_whitespace=True)
+
+
+def test_rotate_bvecs():
+    rng = np.random.RandomState(0)
+    transforms = np.tile(np.identity(4), (5, 1, 1))
+    transforms[:, :3, :] += 0.1 * rng.randn(5, 3, 4)
+    bvecs = rng.randn(5, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, None]
+    expected = []
+    for tra, bvec in zip(transforms, bvecs):
+        aff = tra[:3, :3]
+        el, ev = np.linalg.eig(aff @ aff.T)
+        sq = ev @ np.diag(np.sqrt(el)) @ np.linalg.inv(ev)
+        expected.append(np.linalg.inv(sq) @ aff @ bvec)
+    assert np.allclose(rotate_bvecs(bvecs, transforms), expected)
+    rotations = polar_rotations(transforms)
+    assert np.allclose(rotations @ rotations.transpose(0, 2, 1), np.identity(3))
+
+
+def test_compare_niftis():
+    data = np.arange(2 * 3 * 4 * 5, dtype=np.int16).reshape(2, 3, 4, 5)
+    with local.tempdir() as tmpdir:
+        for (name, values) in [('a', data), ('b', data), ('c', data + (data == 7))]:
+            nib.Nifti1Image(values, np.identity(4)).to_filename(str(tmpdir / f'{name}.nii.gz'))
+        assert compare_niftis(tmpdir / 'a.nii.gz', tmpdir / 'b.nii.gz')
+        assert not compare_niftis(tmpdir / 'a.nii.gz', tmpdir / 'c.nii.gz')
+        # scaled images that only differ by less than float32 can tell apart
+        for (name, values) in [('d', data * 0), ('e', data * 0 + 1)]:
+            img = nib.Nifti1Image(values, np.identity(4))
+            img.header.set_slope_inter(0.01, 1e6)
+            img.to_filename(str(tmpdir / f'{name}.nii.gz'))
+        assert not compare_niftis(tmpdir / 'd.nii.gz', tmpdir / 'e.nii.gz')